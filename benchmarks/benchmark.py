@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Benchmark ingest, query, export and delete paths of BlanketDB using
+   synthetic IoT data. Results are written as JSON, such that runs on
+   different commits can be compared using `--compare`.'''
+
+
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from wsgiref.util import setup_testing_defaults
+
+import blanketdb
+from blanketdb import BlanketDB
+
+
+class Clock:
+    '''Replacement for `datetime.now` spreading the synthetic entries
+       evenly over the time span of the dataset.'''
+
+    def __init__(self, start: datetime, step: timedelta) -> None:
+        self.current = start
+        self.step = step
+
+    def __call__(self) -> datetime:
+        current = self.current
+        self.current += self.step
+        return current
+
+
+def payloads(rng: random.Random, n: int,
+             payload_size: int) -> Iterator[Dict[str, Any]]:
+    '''Generate `n` sensor readings padded to roughly `payload_size`
+       bytes of JSON.'''
+    for i in range(n):
+        reading = dict(device='sensor-{}'.format(rng.randrange(100)),
+                       temp=round(rng.gauss(21, 3), 2),
+                       hum=round(rng.uniform(30, 70), 1),
+                       seq=i)
+        padding = payload_size - len(json.dumps(reading))
+        if padding > 0:
+            reading['note'] = 'x' * padding
+        yield reading
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    '''Summarize latencies (in seconds) as milliseconds.'''
+    ordered = sorted(samples)
+
+    def at(p: float) -> float:
+        return 1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return dict(p50_ms=at(0.5), p90_ms=at(0.9), p99_ms=at(0.99),
+                max_ms=1000 * ordered[-1], n=len(ordered))
+
+
+def timed(func: Callable[[], Any], repeat: int) -> List[float]:
+    '''Call `func` `repeat` times and return the duration of each call.'''
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def wsgi_request(db: BlanketDB, method: str, path: str,
+                 query: str = '', body: bytes = b'') -> bytes:
+    '''Call the WSGI callable of `db` in process and return the body.'''
+    env = dict(REQUEST_METHOD=method, PATH_INFO=path, QUERY_STRING=query,
+               CONTENT_TYPE='application/json',
+               CONTENT_LENGTH=str(len(body)))  # type: Dict[str, Any]
+    env['wsgi.input'] = io.BytesIO(body)
+    setup_testing_defaults(env)
+    status = []  # type: List[str]
+
+    def start_response(s: str, headers: List[Any],
+                       exc_info: Any = None) -> Callable[[bytes], None]:
+        status.append(s)
+        return lambda data: None
+    chunks = list(db(env, start_response))
+    assert status[0][0] in '23', status[0]
+    return b''.join(chunks)
+
+
+def run(args: Any) -> Dict[str, Any]:
+    '''Run all benchmarks and return their results.'''
+    rng = random.Random(args.seed)
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+    buckets = ['bucket{}'.format(i) for i in range(args.buckets)]
+    start = datetime(2020, 1, 1)
+    clock = Clock(start, timedelta(seconds=args.spread / args.rows))
+    results = dict()  # type: Dict[str, Any]
+    try:
+        filename = os.path.join(tmpdir, 'benchmark.sqlite')
+        db = BlanketDB(filename, clock, profile=args.profile,
+                       schema=args.schema, partition=args.partition)
+        data = payloads(rng, args.rows, args.payload_size)
+
+        # single entries, one transaction each
+        single = min(args.single_rows, args.rows)
+        begin = time.perf_counter()
+        for _, item in zip(range(single), data):
+            db.store(item, rng.choice(buckets))
+        seconds = time.perf_counter() - begin
+        results['store_single'] = dict(rows=single, seconds=seconds,
+                                       rows_per_s=single / seconds)
+
+        # compress the remaining entries using dictionaries trained on
+        # the entries stored so far
+        if args.compression:
+            for bucket in buckets:
+                db.set_compression(bucket, args.compression)
+
+        # remaining entries in batches, one bucket per batch
+        stored, begin = 0, time.perf_counter()
+        while stored < args.rows - single:
+            n = min(args.batch_size, args.rows - single - stored)
+            batch = [item for _, item in zip(range(n), data)]
+            db.store_many(batch, rng.choice(buckets))
+            clock.current += clock.step * (n - 1)
+            stored += n
+        seconds = time.perf_counter() - begin
+        results['store_batch'] = dict(rows=stored, seconds=seconds,
+                                      rows_per_s=stored / seconds
+                                      if stored else None,
+                                      batch_size=args.batch_size)
+
+        # size of the database file holding all entries
+        db.checkpoint('truncate')
+        size = os.path.getsize(filename)
+        results['file_size'] = dict(rows=args.rows, bytes=size,
+                                    bytes_per_row=size / args.rows)
+        if args.compression:
+            infos = [db.compression_info(bucket, samples=args.rows)
+                     for bucket in buckets]
+            raw = sum(info['raw_bytes'] for info in infos)
+            stored = sum(info['stored_bytes'] for info in infos)
+            results['compression'] = dict(
+                level=args.compression, raw_bytes=raw, stored_bytes=stored,
+                ratio=raw / stored,
+                compressed_rows=sum(info['compressed_entries']
+                                    for info in infos))
+
+        # filtered queries over random windows of a random bucket
+        def window_query() -> None:
+            since = start + timedelta(seconds=rng.uniform(0, args.spread))
+            list(db.query(rng.choice(buckets), since=since,
+                          before=since + timedelta(seconds=args.window),
+                          limit=args.limit))
+        results['query_window'] = percentiles(
+            timed(window_query, args.queries))
+        results['query_latest'] = percentiles(timed(
+            lambda: list(db.query(rng.choice(buckets), limit=args.limit)),
+            args.queries))
+
+        # full bucket exports, decoded and through WSGI
+        begin = time.perf_counter()
+        n = sum(1 for _ in db.query(buckets[0]))
+        seconds = time.perf_counter() - begin
+        results['export_python'] = dict(rows=n, seconds=seconds,
+                                        rows_per_s=n / seconds)
+        for fmt in ('json', 'ndjson', 'columnar'):
+            begin = time.perf_counter()
+            size = len(wsgi_request(db, 'GET', '/' + buckets[0],
+                                    'format=' + fmt))
+            seconds = time.perf_counter() - begin
+            results['export_wsgi_' + fmt] = dict(
+                rows=n, bytes=size, seconds=seconds, rows_per_s=n / seconds,
+                mb_per_s=size / seconds / 1e6)
+
+        # end-to-end requests through the WSGI callable
+        results['wsgi_get'] = percentiles(timed(
+            lambda: wsgi_request(db, 'GET', '/' + rng.choice(buckets),
+                                 'limit={}'.format(args.limit)),
+            args.queries))
+        body = json.dumps(next(payloads(rng, 1, args.payload_size))) \
+            .encode('utf8')
+        results['wsgi_post'] = percentiles(timed(
+            lambda: wsgi_request(db, 'POST', '/' + rng.choice(buckets),
+                                 body=body),
+            args.queries))
+
+        # expiry of the oldest quarter of the time span
+        for bucket in buckets:
+            db.set_retention(bucket, max_age=int(args.spread * 3 / 4))
+        begin = time.perf_counter()
+        deleted = sum(db.enforce_retention(
+            chunk_size=args.batch_size, pause=0).values())
+        seconds = time.perf_counter() - begin
+        results['retention_expire'] = dict(rows=deleted, seconds=seconds,
+                                           rows_per_s=deleted / seconds
+                                           if deleted else None)
+
+        # retention deletes of the older half of every bucket
+        for bucket in buckets:
+            count = sum(1 for _ in db.query(bucket, raw=True))
+            db.set_retention(bucket, max_rows=count // 2)
+        begin = time.perf_counter()
+        deleted = sum(db.enforce_retention(
+            chunk_size=args.batch_size, pause=0).values())
+        seconds = time.perf_counter() - begin
+        results['retention_delete'] = dict(rows=deleted, seconds=seconds,
+                                           rows_per_s=deleted / seconds
+                                           if deleted else None)
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def git_commit() -> Optional[str]:
+    '''Return the commit of the working directory (if it is a git
+       repository).'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(blanketdb.__file__)),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    '''Describe the change of throughput and median latency relative
+       to `baseline`.'''
+    lines = []
+    for name, metrics in results.items():
+        previous = baseline.get(name, {})
+        for key in ('rows_per_s', 'p50_ms', 'p99_ms', 'bytes_per_row'):
+            if metrics.get(key) and previous.get(key):
+                lines.append('{:<20} {:<10} {:>12.3f} -> {:>12.3f} ({:+.1%})'
+                             .format(name, key, previous[key], metrics[key],
+                                     metrics[key] / previous[key] - 1))
+    return lines
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Benchmark BlanketDB using ' +
+                                        'synthetic IoT data.')
+    parser.add_argument('--buckets', help='Number of buckets',
+                        default=8, type=int)
+    parser.add_argument('--rows', help='Number of entries to store',
+                        default=100000, type=int)
+    parser.add_argument('--single-rows', help='Number of entries stored ' +
+                        'one by one (the rest is stored in batches)',
+                        default=2000, type=int)
+    parser.add_argument('--batch-size', help='Number of entries per batch',
+                        default=1000, type=int)
+    parser.add_argument('--payload-size', help='Approximate size of the ' +
+                        'JSON data of each entry in bytes',
+                        default=100, type=int)
+    parser.add_argument('--spread', help='Seconds between the first and ' +
+                        'the last entry', default=30 * 86400, type=float)
+    parser.add_argument('--window', help='Seconds covered by each ' +
+                        'filtered query', default=3600, type=float)
+    parser.add_argument('--limit', help='Limit of queries',
+                        default=100, type=int)
+    parser.add_argument('--queries', help='Number of queries and requests ' +
+                        'per latency benchmark', default=200, type=int)
+    parser.add_argument('--profile', help='Durability/performance profile',
+                        default='safe',
+                        choices=sorted(blanketdb._PROFILES))
+    parser.add_argument('--schema', help='Storage layout of the database',
+                        default='text', choices=sorted(blanketdb._SCHEMAS))
+    parser.add_argument('--partition', help='Store entries in one table ' +
+                        'per period', default=None,
+                        choices=sorted(blanketdb._PARTITION_FORMATS))
+    parser.add_argument('--compression', help='Compress the data of ' +
+                        'the entries at this level (1-9)', default=None,
+                        type=int, choices=range(1, 10))
+    parser.add_argument('--seed', help='Seed of the random dataset',
+                        default=42, type=int)
+    parser.add_argument('--tmpdir', help='Directory for the database',
+                        default=None, type=str)
+    parser.add_argument('-o', '--output', help='Write results as JSON ' +
+                        'to this file (default: stdout)',
+                        default=None, type=str)
+    parser.add_argument('--compare', help='Results of a previous run ' +
+                        'to compare with', default=None, type=str)
+    args = parser.parse_args()
+    if args.rows < 1 or args.buckets < 1 or args.queries < 1:
+        parser.error('--rows, --buckets and --queries must be positive')
+    results = run(args)
+    report = dict(commit=git_commit(),
+                  version=blanketdb.__version__,
+                  python=platform.python_version(),
+                  sqlite=sqlite3.sqlite_version,
+                  platform=platform.platform(),
+                  date=datetime.now().isoformat(),
+                  parameters={key: value for key, value in vars(args).items()
+                              if key not in ('output', 'compare', 'tmpdir')},
+                  results=results)  # type: Dict[str, Any]
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != report['parameters']:
+            print('Warning: parameters differ from the baseline',
+                  file=sys.stderr)
+        for line in compare(results, baseline['results']):
+            print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
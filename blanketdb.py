@@ -7,15 +7,43 @@ __author__ = 'luphord'
 __email__ = 'luphord@protonmail.com'
 __version__ = '0.4.0'
 
+import asyncio
+import base64
+import bisect
+import cProfile
+import csv
+import hashlib
+import hmac
+import io
+import itertools
 import json
+import logging
+import os
+import queue
+import signal
+import socket
 import sqlite3
+import re
+import struct
+import threading
+import time
 import urllib.parse
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, date, timedelta
-from typing import Dict, Union, Any, Callable, Iterable, List, Optional
+from http import HTTPStatus
+from typing import Dict, Union, Any, Awaitable, BinaryIO, Callable, \
+    Iterable, Iterator, List, Optional, Tuple, cast
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
-    from wsgiref.types import StartResponse  # noqa: F401
+    from typing import Set  # noqa: F401
+    from wsgiref.types import StartResponse, \
+        WSGIApplication  # noqa: F401
 DateLike = Union[str, datetime, date]
 
 
@@ -80,6 +108,103 @@ def _parse_dt(s: Optional[DateLike]) -> DateLike:
     return s
 
 
+def _resolved_dt(s: Optional[DateLike]) -> Optional[str]:
+    '''Parse `s` (see `_parse_dt`) to a fixed bound in the string form
+       stored by SQLite, or None if not given.'''
+    # relative times are resolved once, such that all pages of a cursor
+    # (and the ETag) use the same bounds, as strings compared by SQLite
+    # like the stored timestamps and serializable in cursors
+    value = _parse_dt(s)
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value or None
+
+
+def _parse_interval(s: Union[str, int]) -> int:
+    '''Parse interval like "15min" or "1h" to a positive number of seconds.
+       Plain numbers are interpreted as seconds.'''
+    s = str(s).strip().lower()
+    for suffixes, factor in [(('days', 'day', 'd'), 24 * 60 * 60),
+                             (('hours', 'hour', 'h'), 60 * 60),
+                             (('min', 'm'), 60),
+                             (('sec', 's'), 1),
+                             (('',), 1)]:
+        suffix = next((suffix for suffix in suffixes
+                       if s.endswith(suffix)), None)
+        if suffix is not None:
+            try:
+                seconds = int(s[:len(s) - len(suffix)]) * factor
+            except ValueError:
+                continue
+            if seconds > 0:
+                return seconds
+            break
+    raise ValueError('Invalid interval "{}"'.format(s))
+
+
+_FIELD_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+
+def _json_path(field: str) -> str:
+    '''Convert a (dotted) field name like "meta.device" to a JSON path.'''
+    if not _FIELD_RE.match(field):
+        raise ValueError('Invalid field "{}"'.format(field))
+    return '$.' + field
+
+
+_MAX_FIELDS = 50
+Fields = Union[str, Iterable[str]]
+
+
+def _projection_sql(fields: Fields, data: str = 'data') -> str:
+    '''Build an SQL expression selecting only the (dotted) `fields` of the
+       data as JSON object, nested like the data (e.g. "meta.device" as
+       {"meta": {"device": ...}}). Fields missing in the data are null.
+       `fields` may be given as comma separated string. `data` is the SQL
+       of the JSON text of the data (see `_DATA_SQL`).'''
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    fields = [field.strip() for field in fields]
+    if len(fields) > _MAX_FIELDS:
+        raise ValueError('At most {} fields can be selected'
+                         .format(_MAX_FIELDS))
+    tree = dict()  # type: Dict[str, Any]
+    for field in fields:
+        _json_path(field)  # raises ValueError for invalid fields
+        *parents, name = field.split('.')
+        node = tree  # type: Optional[Dict[str, Any]]
+        for parent in parents:
+            assert node is not None
+            node = node.setdefault(parent, dict())
+            if node is None:
+                break  # the whole parent is selected
+        else:
+            assert node is not None
+            node[name] = None
+
+    def build(node: Dict[str, Any], prefix: str) -> str:
+        values = []
+        for name, children in node.items():
+            if children is None:
+                # json_extract returns true and false as 1 and 0
+                path = _json_path(prefix + name)
+                value = "CASE json_type({1}, '{0}') " \
+                        "WHEN 'true' THEN json('true') " \
+                        "WHEN 'false' THEN json('false') " \
+                        "ELSE json_extract({1}, '{0}') END" \
+                        .format(path, data)
+            else:
+                value = build(children, prefix + name + '.')
+            values.append("'{}', {}".format(name, value))
+        return 'json_object(' + ', '.join(values) + ')'
+    return build(tree, '')
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
 def _json_default(obj: Union[datetime, date]) -> str:
     if isinstance(obj, datetime) or isinstance(obj, date):
         return obj.isoformat()
@@ -99,52 +224,2408 @@ def _j(obj_to_serialize: Any = None, **kwargs: Any) -> bytes:
     return _serialize_json(obj_to_serialize).encode('utf8')
 
 
+_EntryRow = Tuple[int, str, datetime, str]
+
+
+def _row_entry(row: _EntryRow, raw: bool = False) -> Dict[str, Any]:
+    '''Convert a row of ID, bucket, timestamp and JSON text of the data
+       to an entry, keeping the JSON text of the data if `raw`.'''
+    id, bucket, timestamp, data = row
+    return dict(id=id, bucket=bucket, timestamp=timestamp,
+                data=data if raw else json.loads(data))
+
+
+def _stream_envelope(head: Dict[str, Any],
+                     entries: Iterable[str],
+                     tail: Callable[[], Dict[str, Any]]) -> Iterable[bytes]:
+    '''Serialize a json object consisting of the fields in `head`,
+       an "entries" list and the fields returned by `tail` chunk by chunk.
+       Each entry is already serialized and encoded as its own chunk,
+       `tail` is called after the last entry has been consumed.'''
+    yield (_serialize_json(head)[:-2] + ',\n  "entries": [').encode('utf8')
+    sep = '\n    '
+    for entry in entries:
+        yield (sep + entry.replace('\n', '\n    ')).encode('utf8')
+        sep = ',\n    '
+    yield ('\n  ],\n' + _serialize_json(tail())[2:]).encode('utf8')
+
+
+_EXPORT_FORMATS = {
+    'json': 'application/json',
+    'compact': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'columnar': 'application/vnd.blanketdb.columnar'
+}
+_MEDIA_FORMATS = {'application/json': 'json',
+                  'application/x-ndjson': 'ndjson',
+                  'text/csv': 'csv',
+                  'application/vnd.blanketdb.columnar': 'columnar'}
+
+
+def _negotiate_format(qs: Dict[str, Any], env: Dict[str, Any]) -> str:
+    '''Select the export format requested by the "format" query
+       parameter or else by the Accept header, defaulting to json.'''
+    if 'format' in qs:
+        fmt = str(qs['format']).lower()
+        if fmt not in _EXPORT_FORMATS:
+            raise ValueError('Unknown format "{}", use one of {}'
+                             .format(fmt, ', '.join(_EXPORT_FORMATS)))
+        return fmt
+    best, best_q = 'json', 0.0
+    for media_range in str(env.get('HTTP_ACCEPT', '')).split(','):
+        media_type, *params = media_range.split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        fmt = _MEDIA_FORMATS.get(media_type.strip().lower(), '')
+        if fmt and q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def _raw_entry(row: _EntryRow, show_meta: bool,
+               indent: Optional[int] = None) -> str:
+    '''Serialize a row to JSON (indenting the metadata by `indent`),
+       passing the stored JSON text of the data through verbatim.'''
+    id, bucket, timestamp, data = row
+    if not show_meta:
+        return data
+    fields = ['"id": {}'.format(id),
+              '"bucket": ' + json.dumps(bucket),
+              '"timestamp": ' + json.dumps(timestamp.isoformat()),
+              '"data": ' + data]
+    if indent is None:
+        return '{' + ', '.join(fields) + '}'
+    pad = '\n' + ' ' * indent
+    return '{' + pad + (',' + pad).join(fields) + '\n}'
+
+
+def _raw_line(row: _EntryRow, show_meta: bool) -> str:
+    '''Like `_raw_entry`, but guaranteed to be a single line.'''
+    line = _raw_entry(row, show_meta)
+    if '\n' in line:  # data stored by versions before 0.5 is indented
+        line = _serialize_json(json.loads(line), indent=None)
+    return line
+
+
+def _compact_envelope(head: Dict[str, Any],
+                      entries: Iterable[str],
+                      tail: Callable[[], Dict[str, Any]]) -> Iterable[bytes]:
+    '''Like `_stream_envelope`, but without indentation and for entries
+       which are already serialized.'''
+    yield (_serialize_json(head, indent=None)[:-1] + ', "entries": [') \
+        .encode('utf8')
+    sep = ''
+    for entry in entries:
+        yield (sep + entry).encode('utf8')
+        sep = ', '
+    yield ('], ' + _serialize_json(tail(), indent=None)[1:]).encode('utf8')
+
+
+def _ndjson_lines(rows: Iterable[_EntryRow],
+                  show_meta: bool) -> Iterable[bytes]:
+    '''Serialize rows to newline delimited JSON.'''
+    for row in rows:
+        yield (_raw_line(row, show_meta) + '\n').encode('utf8')
+
+
+def _flatten(value: Any, key: str = '') -> Dict[str, str]:
+    '''Flatten nested objects in `value` to a single level using dotted
+       keys. Leaves are converted to CSV cell text, i.e. strings are kept,
+       None becomes empty and anything else (including arrays) JSON.'''
+    if isinstance(value, dict) and value:
+        result = {}  # type: Dict[str, str]
+        for k, v in value.items():
+            result.update(_flatten(v, key + '.' + k if key else k))
+        return result
+    if isinstance(value, str):
+        return {key or 'data': value}
+    return {key or 'data': '' if value is None
+            else _serialize_json(value, indent=None)}
+
+
+def _csv_lines(rows: Iterable[_EntryRow], show_meta: bool) -> Iterable[bytes]:
+    '''Serialize rows to CSV with one column per flattened data key. As
+       the header requires all keys, the rows are read before the first
+       line is produced.'''
+    meta = ['id', 'bucket', 'timestamp'] if show_meta else []
+    records = []  # type: List[Dict[str, str]]
+    columns = dict.fromkeys(meta)  # ordered set of column names
+    for id, bucket, timestamp, data in rows:
+        record = _flatten(json.loads(data), 'data' if show_meta else '')
+        if show_meta:
+            record.update(id=str(id), bucket=bucket,
+                          timestamp=timestamp.isoformat())
+        columns.update(dict.fromkeys(record))
+        records.append(record)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, list(columns), restval='')
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue().encode('utf8')
+        buffer.seek(0)
+        buffer.truncate()
+    if not records:
+        yield buffer.getvalue().encode('utf8')
+
+
+# binary columnar format: magic, number of columns, type and name of each
+# column, then batches of rows, each consisting of the number of rows
+# followed by one buffer per column: little endian int64 values for int64
+# and timestamp (microseconds since 1970-01-01) columns, n + 1 uint32
+# offsets followed by the concatenated UTF-8 bytes for string and json
+# columns; a batch of zero rows ends the stream
+_COLUMNAR_MAGIC = b'BDBCOL1\n'
+_COLUMNAR_INT64, _COLUMNAR_TIMESTAMP, _COLUMNAR_STRING, _COLUMNAR_JSON = \
+    1, 2, 3, 4
+
+
+def _columnar_chunks(rows: Iterable[_EntryRow], show_meta: bool,
+                     batch_size: int = 1024) -> Iterable[bytes]:
+    '''Serialize rows to the binary columnar format, one batch of at most
+       `batch_size` rows per chunk.'''
+    # name, type and index in the row per column
+    columns = [('id', _COLUMNAR_INT64, 0), ('bucket', _COLUMNAR_STRING, 1),
+               ('timestamp', _COLUMNAR_TIMESTAMP, 2)] if show_meta else []
+    columns.append(('data', _COLUMNAR_JSON, 3))
+    yield _COLUMNAR_MAGIC + struct.pack('<H', len(columns)) + b''.join(
+        struct.pack('<BH', kind, len(name)) + name.encode('utf8')
+        for name, kind, _ in columns)
+    rows = iter(rows)
+    while True:
+        batch = [row for _, row in zip(range(batch_size), rows)]
+        chunk = [struct.pack('<I', len(batch))]
+        if not batch:
+            yield chunk[0]
+            return
+        values = list(zip(*batch))
+        for _, kind, index in columns:
+            if kind == _COLUMNAR_INT64:
+                chunk.append(struct.pack('<{}q'.format(len(batch)),
+                                         *values[index]))
+            elif kind == _COLUMNAR_TIMESTAMP:
+                chunk.append(struct.pack(
+                    '<{}q'.format(len(batch)),
+                    *((ts - _EPOCH) // timedelta(microseconds=1)
+                      for ts in values[index])))
+            else:
+                encoded = [value.encode('utf8') for value in values[index]]
+                offsets = [0]
+                for value in encoded:
+                    offsets.append(offsets[-1] + len(value))
+                chunk.append(struct.pack('<{}I'.format(len(offsets)),
+                                         *offsets))
+                chunk.append(b''.join(encoded))
+        yield b''.join(chunk)
+
+
+def read_columnar(fp: BinaryIO) -> Dict[str, List[Any]]:
+    '''Read the binary columnar export format of BlanketDB from the
+       binary file-like object `fp`. Return a list of values per column,
+       i.e. "id", "bucket", "timestamp" (datetimes) and "data" (decoded
+       JSON) or only "data" for exports without metadata.'''
+    def read(n: int) -> bytes:
+        data = fp.read(n)
+        if len(data) != n:
+            raise ValueError('Unexpected end of columnar data')
+        return data
+    if read(len(_COLUMNAR_MAGIC)) != _COLUMNAR_MAGIC:
+        raise ValueError('Not in columnar format of BlanketDB')
+    columns = []  # type: List[Tuple[str, int]]
+    for _ in range(struct.unpack('<H', read(2))[0]):
+        kind, length = struct.unpack('<BH', read(3))
+        columns.append((read(length).decode('utf8'), kind))
+    result = {name: [] for name, _ in columns}  # type: Dict[str, List[Any]]
+    while True:
+        n = struct.unpack('<I', read(4))[0]
+        if not n:
+            return result
+        for name, kind in columns:
+            if kind in (_COLUMNAR_INT64, _COLUMNAR_TIMESTAMP):
+                values = struct.unpack('<{}q'.format(n), read(8 * n))
+                result[name].extend(
+                    values if kind == _COLUMNAR_INT64 else
+                    (_EPOCH + timedelta(microseconds=v) for v in values))
+            else:
+                offsets = struct.unpack('<{}I'.format(n + 1),
+                                        read(4 * (n + 1)))
+                buffer = read(offsets[-1])
+                strings = [buffer[start:end].decode('utf8') for start, end
+                           in zip(offsets, offsets[1:])]
+                result[name].extend(
+                    strings if kind == _COLUMNAR_STRING else
+                    (json.loads(s) for s in strings))
+
+
+def _buffered(chunks: Iterable[bytes], size: int = 65536) -> Iterable[bytes]:
+    '''Join small `chunks` to chunks of at least `size` bytes.'''
+    buffer = []  # type: List[bytes]
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+_PROFILES = {
+    # durable commits, i.e. every commit is synced to disk
+    'safe': [('journal_mode', 'WAL'),
+             ('synchronous', 'FULL'),
+             ('cache_size', -2000),
+             ('mmap_size', 0),
+             ('temp_store', 'DEFAULT'),
+             ('busy_timeout', 5000),
+             ('wal_autocheckpoint', 1000)],
+    # consistent after power loss, but the latest commits may be lost
+    'balanced': [('journal_mode', 'WAL'),
+                 ('synchronous', 'NORMAL'),
+                 ('cache_size', -16000),
+                 ('mmap_size', 64 * 1024 * 1024),
+                 ('temp_store', 'MEMORY'),
+                 ('busy_timeout', 5000),
+                 ('wal_autocheckpoint', 1000)],
+    # no syncs at all, database may be corrupted by power loss
+    'fast': [('journal_mode', 'WAL'),
+             ('synchronous', 'OFF'),
+             ('cache_size', -64000),
+             ('mmap_size', 256 * 1024 * 1024),
+             ('temp_store', 'MEMORY'),
+             ('busy_timeout', 10000),
+             ('wal_autocheckpoint', 4000)]
+}  # type: Dict[str, List[Tuple[str, Any]]]
+
+
+# storage layouts: "text" stores bucket names and ISO timestamps in every
+# row, "compact" bucket IDs (see blanketdb_bucket) and microseconds since
+# the epoch
+_SCHEMAS = {
+    'text': ['CREATE TABLE IF NOT EXISTS blanketdb ' +
+             '(bucket text, timestamp timestamp, data text);',
+             # an index on bucket implicitly ends with rowid,
+             # i.e. it serves as (bucket, rowid) index
+             'CREATE INDEX IF NOT EXISTS blanketdb_bucket_rowid ' +
+             'ON blanketdb (bucket);',
+             'CREATE INDEX IF NOT EXISTS blanketdb_bucket_timestamp ' +
+             'ON blanketdb (bucket, timestamp);'],
+    'compact': ['CREATE TABLE IF NOT EXISTS blanketdb_bucket ' +
+                '(id integer PRIMARY KEY, name text NOT NULL UNIQUE);',
+                'CREATE TABLE IF NOT EXISTS blanketdb_entry ' +
+                '(id integer PRIMARY KEY, bucket integer NOT NULL, ' +
+                'timestamp epoch_us NOT NULL, data text);',
+                'CREATE INDEX IF NOT EXISTS blanketdb_entry_bucket_id ' +
+                'ON blanketdb_entry (bucket);',
+                'CREATE INDEX IF NOT EXISTS ' +
+                'blanketdb_entry_bucket_timestamp ' +
+                'ON blanketdb_entry (bucket, timestamp);']
+}  # type: Dict[str, List[str]]
+_SCHEMA_TABLES = dict(text='blanketdb', compact='blanketdb_entry')
+# ID, bucket name and timestamp of the rows of each schema
+_SCHEMA_META = dict(text='rowid AS id, bucket, timestamp',
+                    compact='id, (SELECT name FROM blanketdb_bucket ' +
+                            'WHERE blanketdb_bucket.id=bucket) AS bucket, ' +
+                            'timestamp')
+
+
+def _epoch_us(value: DateLike) -> int:
+    '''Convert a timestamp (as returned by `_parse_dt`) to microseconds
+       since the epoch.'''
+    if isinstance(value, str):
+        text = value
+        for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f',
+                    '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d',
+                    '%Y-%m', '%Y'):
+            try:
+                value = datetime.strptime(text, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError('Invalid timestamp "{}"'.format(text))
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return (value.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+
+
+def _convert_epoch_us(value: bytes) -> datetime:
+    '''Convert timestamps of the compact schema back to datetime.'''
+    return _EPOCH + timedelta(microseconds=int(value))
+
+
+sqlite3.register_converter('epoch_us', _convert_epoch_us)
+
+
+# tables of the partitions of partitioned databases ({name} is the table of
+# the schema followed by the start of the period), AUTOINCREMENT allows
+# seeding the IDs of a new partition with the last ID of its predecessor
+_PARTITION_SCHEMAS = {
+    'text': ['CREATE TABLE IF NOT EXISTS {name} ' +
+             '(id integer PRIMARY KEY AUTOINCREMENT, bucket text, ' +
+             'timestamp timestamp, data text);',
+             'CREATE INDEX IF NOT EXISTS {name}_bucket_id ' +
+             'ON {name} (bucket);',
+             'CREATE INDEX IF NOT EXISTS {name}_bucket_timestamp ' +
+             'ON {name} (bucket, timestamp);'],
+    'compact': ['CREATE TABLE IF NOT EXISTS {name} ' +
+                '(id integer PRIMARY KEY AUTOINCREMENT, ' +
+                'bucket integer NOT NULL, timestamp epoch_us NOT NULL, ' +
+                'data text);',
+                'CREATE INDEX IF NOT EXISTS {name}_bucket_id ' +
+                'ON {name} (bucket);',
+                'CREATE INDEX IF NOT EXISTS {name}_bucket_timestamp ' +
+                'ON {name} (bucket, timestamp);']
+}  # type: Dict[str, List[str]]
+_PARTITION_FORMATS = dict(day='%Y%m%d', month='%Y%m')
+
+
+def _partition_period(period: str,
+                      timestamp: datetime) -> Tuple[datetime, datetime]:
+    '''Return start and end of the partition `period` ("day" or "month")
+       containing `timestamp`.'''
+    if period == 'day':
+        start = datetime(timestamp.year, timestamp.month, timestamp.day)
+        return start, start + timedelta(days=1)
+    start = datetime(timestamp.year, timestamp.month, 1)
+    return start, datetime(start.year + start.month // 12,
+                           start.month % 12 + 1, 1)
+
+
+# compressed data is stored as blob starting with the format and the ID of
+# the preset dictionary (0 for none, see blanketdb_dictionary) followed by
+# the raw deflate stream, uncompressed data as JSON text
+_COMPRESSION_HEADER = struct.Struct('>BI')
+_COMPRESSION_FORMAT = 1
+# deflate only refers back 32 KiB, i.e. to the end of larger dictionaries
+_DICTIONARY_SIZE = 16 * 1024
+# SQL of the JSON text of the data of compressed and uncompressed rows,
+# blanketdb_inflate is registered on every connection
+_DATA_SQL = "CASE typeof(data) WHEN 'blob' THEN blanketdb_inflate(data) " + \
+            "ELSE data END"
+
+
+def _train_dictionary(samples: Iterable[bytes],
+                      size: int = _DICTIONARY_SIZE) -> bytes:
+    '''Build a preset dictionary of at most `size` bytes from `samples`
+       (newest first), i.e. distinct samples concatenated such that the
+       newest ones end up at the end, closest to the compressed data.'''
+    chosen = []  # type: List[bytes]
+    seen = set()  # type: Set[bytes]
+    length = 0
+    for sample in samples:
+        if sample in seen:
+            continue
+        if length + len(sample) > size:
+            break
+        seen.add(sample)
+        chosen.append(sample)
+        length += len(sample)
+    return b''.join(reversed(chosen))
+
+
+def _deflater(level: int, dictionary: bytes) -> Any:
+    '''Return a raw deflate compressor of `level` primed with `dictionary`
+       to be copied for each payload (priming is the expensive part).'''
+    if dictionary:
+        return zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL,
+                                zlib.Z_DEFAULT_STRATEGY, dictionary)
+    return zlib.compressobj(level, zlib.DEFLATED, -15)
+
+
+def _deflate(deflater: Any, dictionary_id: int,
+             text: str) -> Union[str, bytes]:
+    '''Compress the JSON `text` using a copy of `deflater` (see
+       `_deflater`). Return `text` itself if compression does not pay
+       off.'''
+    data = text.encode('utf8')
+    compressor = deflater.copy()
+    payload = _COMPRESSION_HEADER.pack(_COMPRESSION_FORMAT, dictionary_id) + \
+        compressor.compress(data) + compressor.flush()
+    return payload if len(payload) < len(data) else text
+
+
+_AGGREGATE_FUNCTIONS = ('avg', 'min', 'max', 'sum', 'count')
+
+
+_ROLLUP_UPSERT = 'INSERT INTO blanketdb_rollup ' + \
+                 'SELECT ?, ?, ?, ?, 1, value, value, value ' + \
+                 'FROM (SELECT json_extract(?, ?) AS value) ' + \
+                 'WHERE typeof(value) IN (\'integer\', \'real\') ' + \
+                 'ON CONFLICT (bucket, field, interval, bin) ' + \
+                 'DO UPDATE SET ' + \
+                 'n=n+1, total=total+excluded.total, ' + \
+                 'minimum=min(minimum, excluded.minimum), ' + \
+                 'maximum=max(maximum, excluded.maximum);'
+_ROLLUP_BACKFILL = 'INSERT INTO blanketdb_rollup ' + \
+                   'SELECT ?, ?, ?, {seconds} / ? ' + \
+                   'AS bin, count(value), sum(value), min(value), ' + \
+                   'max(value) FROM (SELECT timestamp, ' + \
+                   'json_extract({data}, ?) AS value FROM {table} ' + \
+                   'WHERE bucket=?) ' + \
+                   'WHERE typeof(value) IN (\'integer\', \'real\') ' + \
+                   'GROUP BY bin ' + \
+                   'ON CONFLICT (bucket, field, interval, bin) ' + \
+                   'DO UPDATE SET ' + \
+                   'n=n+excluded.n, total=total+excluded.total, ' + \
+                   'minimum=min(minimum, excluded.minimum), ' + \
+                   'maximum=max(maximum, excluded.maximum);'
+# SQL converting the timestamp column of each schema to epoch seconds
+_SCHEMA_SECONDS = dict(text='CAST(strftime(\'%s\', timestamp) AS INTEGER)',
+                       compact='(timestamp / 1000000)')
+_ROLLUP_FUNCTIONS = dict(avg='total / n', min='minimum', max='maximum',
+                         sum='total', count='n')
+
+
+def _read_body(env: Dict[str, Any]) -> bytes:
+    '''Read the request body from WSGI environment `env`.'''
+    try:
+        request_body_size = int(env.get('CONTENT_LENGTH', 0))
+    except ValueError:
+        request_body_size = 0
+    return env['wsgi.input'].read(request_body_size)
+
+
+def _sse_event(row: _EntryRow, show_meta: bool) -> bytes:
+    '''Serialize `row` as server-sent event.'''
+    return 'id: {}\nevent: entry\ndata: {}\n\n'.format(
+        row[0], _raw_line(row, show_meta)).encode('utf8')
+
+
+_SSE_HEARTBEAT = b': heartbeat\n\n'
+_SSE_HEADERS = [('Content-Type', 'text/event-stream'),
+                ('Cache-Control', 'no-cache')]
+
+
 _HTTP_STATUS_CODES = {
     200: '200 OK',
     201: '201 Created',
+    304: '304 Not Modified',
     400: '400 Bad Request',
     404: '404 Not found',
     405: '405 Method Not Allowed',
-    415: '415 Unsupported Media Type'
+    415: '415 Unsupported Media Type',
+    500: '500 Internal Server Error',
+    503: '503 Service Unavailable'
 }
 
 
+# compressed and encoded as gzip or zlib stream (the "deflate" encoding)
+_ENCODINGS = {'gzip': 31, 'deflate': 15}
+_COMPRESSIBLE_TYPES = {'application/json', 'application/x-ndjson',
+                       'text/csv', 'text/event-stream', 'text/plain'}
+
+
+def _accepted_encoding(env: Dict[str, Any]) -> Optional[str]:
+    '''Select gzip or deflate if accepted according to the
+       Accept-Encoding header, preferring gzip for equal weights.'''
+    best, best_q = None, 0.0
+    for coding in str(env.get('HTTP_ACCEPT_ENCODING', '')).split(','):
+        name, *params = coding.split(';')
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        name = name.strip().lower()
+        if name in _ENCODINGS and q > 0 \
+                and (q > best_q or q == best_q and name == 'gzip'):
+            best, best_q = name, q
+    return best
+
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    '''Return whether `etag` matches one of the tags of an If-None-Match
+       header, using the weak comparison (i.e. ignoring "W/") required
+       for that header.'''
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return any((tag[2:] if tag.startswith('W/') else tag) ==
+               (etag[2:] if etag.startswith('W/') else etag)
+               for tag in tags)
+
+
+def _encode_response(app: 'WSGIApplication',
+                     env: Dict[str, Any],
+                     start_response: 'StartResponse') -> Iterable[bytes]:
+    '''Call WSGI application `app` and compress its response chunk by
+       chunk if the client accepts it. Event streams are flushed after
+       every chunk, other responses whenever the compressor emits data.'''
+    encoding = _accepted_encoding(env)
+    state = dict(compressor=None, flush=False)  # type: Dict[str, Any]
+
+    def start(status: str, headers: List[Tuple[str, str]],
+              exc_info: Any = None) -> Callable[[bytes], Any]:
+        content_type = dict((name.lower(), value) for name, value
+                            in headers).get('content-type', '')
+        content_type = content_type.split(';')[0].strip()
+        if content_type in _COMPRESSIBLE_TYPES:
+            headers = headers + [('Vary', 'Accept-Encoding')]
+            if encoding and status[:3] not in ('204', '304'):
+                state['compressor'] = zlib.compressobj(
+                    wbits=_ENCODINGS[encoding])
+                state['flush'] = content_type == 'text/event-stream'
+                headers.append(('Content-Encoding', encoding))
+        if exc_info:
+            return start_response(status, headers, exc_info)
+        return start_response(status, headers)
+
+    app_iter = app(env, start)
+    try:
+        for chunk in app_iter:
+            compressor = state['compressor']
+            if compressor is None:
+                yield chunk
+                continue
+            data = compressor.compress(chunk)
+            if state['flush']:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        if state['compressor'] is not None:
+            yield state['compressor'].flush()
+    finally:
+        getattr(app_iter, 'close', lambda: None)()
+
+
+_UNAVAILABLE_HEADERS = [('Content-Type', 'application/json'),
+                        ('Retry-After', '1')]
+_UNAVAILABLE_MESSAGE = 'Too many pending requests, try again later'
+
+
+_WHERE_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<string>"(?:[^"\\]|\\.)*")'
+    r'|(?P<number>-?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)'
+    r'|(?P<symbol>==|!=|<=|>=|<|>|\(|\)|\[|\]|,)'
+    r'|(?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*))')
+_WHERE_MAX_LENGTH = 2000
+_WHERE_MAX_COMPARISONS = 32
+_WHERE_MAX_DEPTH = 16
+_WHERE_LITERALS = {'true': True, 'false': False, 'null': None}
+_WHERE_ORDERING = ('<', '<=', '>', '>=')
+
+
+def _field_sql(field: str, data: str = 'data') -> str:
+    '''SQL expression extracting the (dotted) `field` from the data of an
+       entry. The path is inlined (it is restricted to identifiers by
+       `_json_path`), such that SQLite can match indexes on the same
+       expression created by `BlanketDB.set_indexed_fields`.'''
+    return "json_extract({}, '{}')".format(data, _json_path(field))
+
+
+class _WhereParser:
+    '''Compile a `where` predicate like `device == "x" and temp > 30` to
+       SQL. Comparisons of a (dotted) field of the data with a JSON literal
+       (==, !=, <, <=, >, >= and `in [...]`) can be combined using and, or,
+       not and parentheses. Fields missing in the data of an entry only
+       match `== null`. `data` is the SQL of the JSON text of the data.'''
+
+    def __init__(self, where: str, data: str = 'data') -> None:
+        if len(where) > _WHERE_MAX_LENGTH:
+            raise ValueError('where must not be longer than {} characters'
+                             .format(_WHERE_MAX_LENGTH))
+        self.tokens = []  # type: List[Tuple[str, str]]
+        position, end = 0, len(where.rstrip())
+        while position < end:
+            match = _WHERE_TOKEN_RE.match(where, position)
+            if not match or match.end() == position:
+                raise ValueError('Invalid where "{}" at position {}'
+                                 .format(where, position))
+            kind = cast(str, match.lastgroup)
+            self.tokens.append((kind, match.group(kind)))
+            position = match.end()
+        self.position = 0
+        self.comparisons = 0
+        self.params = []  # type: List[Any]
+        self.data = data
+
+    def compile(self) -> Tuple[str, List[Any]]:
+        '''Return the SQL expression and its parameters.'''
+        sql = self._disjunction(0)
+        if self.position < len(self.tokens):
+            raise ValueError('Unexpected "{}" in where'
+                             .format(self.tokens[self.position][1]))
+        return sql, self.params
+
+    def _peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][1]
+        return None
+
+    def _next(self) -> Tuple[str, str]:
+        if self.position >= len(self.tokens):
+            raise ValueError('Unexpected end of where')
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def _expect(self, symbol: str) -> None:
+        if self._next()[1] != symbol:
+            raise ValueError('Expected "{}" in where'.format(symbol))
+
+    def _disjunction(self, depth: int) -> str:
+        if depth > _WHERE_MAX_DEPTH:
+            raise ValueError('where must not be nested deeper than {} levels'
+                             .format(_WHERE_MAX_DEPTH))
+        terms = [self._conjunction(depth)]
+        while self._peek() == 'or':
+            self.position += 1
+            terms.append(self._conjunction(depth))
+        return terms[0] if len(terms) == 1 else \
+            '(' + ' OR '.join(terms) + ')'
+
+    def _conjunction(self, depth: int) -> str:
+        terms = [self._negation(depth)]
+        while self._peek() == 'and':
+            self.position += 1
+            terms.append(self._negation(depth))
+        return terms[0] if len(terms) == 1 else \
+            '(' + ' AND '.join(terms) + ')'
+
+    def _negation(self, depth: int) -> str:
+        if self._peek() == 'not':
+            self.position += 1
+            return 'NOT ' + self._negation(depth + 1)
+        if self._peek() == '(':
+            self.position += 1
+            sql = self._disjunction(depth + 1)
+            self._expect(')')
+            return sql
+        return self._comparison()
+
+    def _literal(self) -> Any:
+        kind, text = self._next()
+        if kind in ('string', 'number'):
+            return json.loads(text)
+        if kind == 'name' and text in _WHERE_LITERALS:
+            return _WHERE_LITERALS[text]
+        raise ValueError('Expected a literal instead of "{}" in where'
+                         .format(text))
+
+    def _comparison(self) -> str:
+        kind, field = self._next()
+        if kind != 'name' or field in _WHERE_LITERALS \
+                or field in ('and', 'or', 'not', 'in'):
+            raise ValueError('Expected a field instead of "{}" in where'
+                             .format(field))
+        self.comparisons += 1
+        if self.comparisons > _WHERE_MAX_COMPARISONS:
+            raise ValueError('where must not contain more than {} '
+                             'comparisons'.format(_WHERE_MAX_COMPARISONS))
+        expr = _field_sql(field, self.data)
+        op = self._next()[1]
+        if op == 'in':
+            self._expect('[')
+            values = [self._literal()]
+            while self._peek() == ',':
+                self.position += 1
+                values.append(self._literal())
+            self._expect(']')
+            if not all(isinstance(value, (str, int, float))
+                       and not isinstance(value, bool) for value in values):
+                raise ValueError('in requires strings or numbers')
+            self.params.extend(values)
+            return expr + ' IN (' + ', '.join('?' * len(values)) + ')'
+        if op not in ('==', '!=') + _WHERE_ORDERING:
+            raise ValueError('Unknown operator "{}" in where'.format(op))
+        value = self._literal()
+        equality = '=' if op == '==' else '!='
+        if value is None:
+            if op not in ('==', '!='):
+                raise ValueError('null can only be compared by == and !=')
+            return expr + (' IS NULL' if op == '==' else ' IS NOT NULL')
+        if isinstance(value, bool):
+            if op not in ('==', '!='):
+                raise ValueError('true and false can only be compared ' +
+                                 'by == and !=')
+            self.params.append('true' if value else 'false')
+            return "json_type({}, '{}'){}?".format(self.data,
+                                                   _json_path(field),
+                                                   equality)
+        self.params.append(value)
+        if op in ('==', '!='):
+            return expr + equality + '?'
+        # SQLite orders numbers before text, i.e. only compare values of
+        # the same type as the literal
+        return '(' + expr + op + '? AND typeof(' + expr + ') IN ' + \
+            ("('text')" if isinstance(value, str)
+             else "('integer', 'real')") + ')'
+
+
+def _where_sql(where: str, data: str = 'data') -> Tuple[str, List[Any]]:
+    '''Compile the `where` predicate to SQL (see `_WhereParser`).'''
+    return _WhereParser(where, data).compile()
+
+
+def _filter_sql(bucket: Optional[Union[str, int]] = None,
+                since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                where: Optional[str] = None,
+                compact: bool = False,
+                data: str = 'data') -> Tuple[str, List[Any]]:
+    '''Build a WHERE clause (and its parameters) containing only the
+       filters actually in use, such that SQLite can pick a matching index.
+       For the `compact` schema, `bucket` must be the ID of the bucket.
+       `where` refers to the data using the SQL `data` (see `_DATA_SQL`).
+    '''
+    clauses = []  # type: List[str]
+    params = []  # type: List[Any]
+    if isinstance(bucket, int):
+        clauses.append('bucket=?')
+        params.append(bucket)
+    elif bucket:
+        clauses.append('bucket=?')
+        params.append(bucket.lower())
+    if since_id:
+        clauses.append('rowid>=?')
+        params.append(since_id)
+    if before_id:
+        clauses.append('rowid<?')
+        params.append(before_id)
+    since = _parse_dt(since)
+    if since:
+        clauses.append('timestamp>=?')
+        params.append(_epoch_us(since) if compact else since)
+    before = _parse_dt(before)
+    if before:
+        clauses.append('timestamp<?')
+        params.append(_epoch_us(before) if compact else before)
+    if where:
+        sql, where_params = _where_sql(where, data)
+        clauses.append(sql)
+        params.extend(where_params)
+    if not clauses:
+        return '', params
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+
+_CURSOR_KEYS = {'bucket', 'since_id', 'since', 'before_id', 'before',
+                'where', 'limit', 'newest_first', 'edge', 'older'}
+
+
+def _encode_cursor(cursor: Dict[str, Any]) -> str:
+    '''Encode the filters and page boundary in `cursor` as opaque,
+       url-safe string.'''
+    return base64.urlsafe_b64encode(
+        _serialize_json(cursor, indent=None).encode('utf8')) \
+        .decode('ascii').rstrip('=')
+
+
+def _decode_cursor(s: str) -> Dict[str, Any]:
+    '''Decode a cursor created by `_encode_cursor`.'''
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(
+            s + '=' * (-len(s) % 4)).decode('utf8'))
+    except ValueError:
+        cursor = None
+    if not isinstance(cursor, dict) or set(cursor) != _CURSOR_KEYS \
+            or not all(isinstance(cursor[key], int)
+                       and not isinstance(cursor[key], bool)
+                       for key in ('edge', 'limit')) \
+            or not all(isinstance(cursor[key], bool)
+                       for key in ('newest_first', 'older')) \
+            or not all(isinstance(cursor[key], (int, type(None)))
+                       for key in ('since_id', 'before_id')) \
+            or not all(isinstance(cursor[key], (str, type(None)))
+                       for key in ('bucket', 'since', 'before', 'where')):
+        raise ValueError('Invalid cursor "{}"'.format(s))
+    if cursor['where']:
+        _where_sql(cursor['where'])  # raises ValueError if invalid
+    return cursor
+
+
+def _edge_bounds(since_id: Optional[int], before_id: Optional[int],
+                 edge: Optional[int], older: bool) \
+        -> Tuple[Optional[int], Optional[int]]:
+    '''Narrow `since_id` and `before_id` to the IDs older (or newer) than
+       `edge`, which is excluded.'''
+    if edge is None:
+        return since_id, before_id
+    if older:
+        return since_id, edge if before_id is None else min(before_id, edge)
+    return max(since_id or 0, edge + 1), before_id
+
+
+class _ConnectionPool:
+    '''Bounded pool of SQLite connections shared between threads.
+       Nested use within one thread reuses the connection already held
+       by that thread, writes are serialized by `transaction`.'''
+
+    def __init__(self,
+                 connect: Callable[[], sqlite3.Connection],
+                 size: int) -> None:
+        self._connect = connect
+        self.size = size
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []  # type: List[sqlite3.Connection]
+        self._held = dict()  # type: Dict[int, List[Any]]
+        self._write_lock = threading.RLock()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        '''Lease a connection from the pool for the current thread.'''
+        thread_id = threading.get_ident()
+        with self._lock:
+            held = self._held.get(thread_id)
+            if held:
+                held[1] += 1
+        if not held:
+            self._slots.acquire()
+            try:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    conn = self._connect()
+            except BaseException:
+                self._slots.release()
+                raise
+            held = [conn, 1]
+            with self._lock:
+                self._held[thread_id] = held
+        try:
+            yield held[0]
+        finally:
+            with self._lock:
+                held[1] -= 1
+                released = held[1] == 0
+                if released:
+                    del self._held[thread_id]
+                    self._idle.append(held[0])
+            if released:
+                self._slots.release()
+
+    def held(self) -> bool:
+        '''Return whether the current thread holds a connection.'''
+        with self._lock:
+            return threading.get_ident() in self._held
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        '''Lease a connection and run a serialized write transaction.'''
+        with self.connection() as conn, self._write_lock, conn:
+            yield conn
+
+    def close(self) -> None:
+        '''Close all connections currently not in use.'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_Row = Tuple[str, datetime, str]
+# SELECT statement and its parameters
+_Statement = Tuple[str, List[Any]]
+
+
+class _GroupCommitWriter:
+    '''Background thread committing rows handed over by `submit` in groups
+       of at most `max_rows` rows, at the latest `max_latency` seconds
+       after the first row of a group has been submitted.'''
+
+    def __init__(self,
+                 pool: _ConnectionPool,
+                 insert: Callable[[sqlite3.Connection, _Row], int],
+                 max_latency: float,
+                 max_rows: int) -> None:
+        self._pool = pool
+        self._insert = insert
+        self.max_latency = max_latency
+        self.max_rows = max(1, max_rows)
+        self.commits = 0
+        self._queue = queue.Queue()  # type: queue.Queue[Any]
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='blanketdb-group-commit',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, row: _Row) -> 'Future[int]':
+        '''Queue `row` for the next group commit. The returned future
+           resolves to the ID of the row once it has been committed.'''
+        future = Future()  # type: Future[int]
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Group commit writer is closed')
+            self._queue.put((row, future))
+        return future
+
+    def _run(self) -> None:
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            group = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(group) < self.max_rows:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit(group)
+
+    def _commit(self, group: List[Tuple[_Row, 'Future[int]']]) -> None:
+        try:
+            with self._pool.transaction() as conn:
+                ids = [self._insert(conn, row) for row, _ in group]
+        except BaseException as e:
+            for _, future in group:
+                future.set_exception(e)
+        else:
+            self.commits += 1
+            for (_, future), entry_id in zip(group, ids):
+                future.set_result(entry_id)
+
+    def close(self) -> None:
+        '''Commit all rows submitted so far and stop the writer thread.'''
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+
+class _ResponseCache:
+    '''Thread-safe LRU cache of serialized responses per bucket using at
+       most `max_size` bytes. Writes invalidate the responses of the
+       bucket written to (and of queries across all buckets). Responses
+       produced while a write happened are not cached, see `token`.'''
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> bucket, expiry (monotonic), ETag, body
+        self._entries = OrderedDict()  # type: OrderedDict[Any, Any]
+        # number of invalidations per bucket, None counts all of them
+        self._generations = dict()  # type: Dict[Optional[str], int]
+        self._cleared = 0
+
+    def token(self, bucket: Optional[str]) -> Tuple[int, int]:
+        '''Return a token to pass to `put` for a response of `bucket`
+           which is computed after calling this method.'''
+        with self._lock:
+            return self._token(bucket)
+
+    def _token(self, bucket: Optional[str]) -> Tuple[int, int]:
+        return self._cleared, self._generations.get(bucket, 0)
+
+    def get(self, key: Any) -> Optional[Tuple[str, bytes]]:
+        '''Return ETag and body cached for `key` (None if missing).'''
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] is not None \
+                    and cached[1] < time.monotonic():
+                self._remove(key)
+                cached = None
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return cached[2], cached[3]
+
+    def put(self, key: Any, bucket: Optional[str], token: Tuple[int, int],
+            max_age: Optional[float], etag: str, body: bytes) -> None:
+        '''Cache `etag` and `body` for `key` (at most `max_age` seconds),
+           unless `bucket` has been written to since `token` was taken.'''
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            if token != self._token(bucket):
+                return
+            if key in self._entries:
+                self._remove(key)
+            expiry = None if max_age is None else time.monotonic() + max_age
+            self._entries[key] = (bucket, expiry, etag, body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, bucket: Optional[str] = None) -> None:
+        '''Drop the responses of `bucket` (all responses if None).'''
+        with self._lock:
+            if bucket is None:
+                self._cleared += 1
+            else:
+                self._generations[bucket] = \
+                    self._generations.get(bucket, 0) + 1
+            self._generations[None] = self._generations.get(None, 0) + 1
+            for key, cached in list(self._entries.items()):
+                if bucket is None or cached[0] in (None, bucket):
+                    self._remove(key)
+
+    def _remove(self, key: Any) -> None:
+        self.size -= len(self._entries.pop(key)[3])
+
+
+_Labels = Tuple[Tuple[str, str], ...]
+_METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+
+def _route(path: str) -> str:
+    '''Map a request path to its route, i.e. without bucket names and
+       IDs, such that the number of distinct routes is bounded.'''
+    path = path.lower()
+    if path.startswith('/_entry'):
+        return '/_entry'
+    if path == '/_metrics':
+        return path
+    if '/_rollup/' in path:
+        return '/{bucket}/_rollup/{interval}'
+    for suffix in ('/_aggregate', '/_stream', '/_batch', '/_rollup',
+                   '/_retention', '/_indexes', '/_compression'):
+        if path == suffix or path.endswith(suffix):
+            return '/{bucket}' + suffix
+    return '/{bucket}'
+
+
+_PROFILING_PARAM = '_profile'
+_PROFILING_HEADER = 'HTTP_X_BLANKETDB_PROFILE'
+_PROFILING_IDS = itertools.count()
+
+
+def _profiled(app: 'WSGIApplication', env: Dict[str, Any],
+              start_response: 'StartResponse', directory: str,
+              token: str) -> Iterable[bytes]:
+    '''Call WSGI application `app`. If the request passes `token` in the
+       X-BlanketDB-Profile header or the `_profile` query parameter,
+       profile the request (until the response has been produced
+       completely) with cProfile and dump the statistics to a file in
+       `directory`, named in the X-BlanketDB-Profile-File header.'''
+    params = urllib.parse.parse_qsl(str(env.get('QUERY_STRING', '')),
+                                    keep_blank_values=True)
+    flags = [str(env.get(_PROFILING_HEADER, ''))] + \
+        [value for key, value in params if key == _PROFILING_PARAM]
+    if not any(hmac.compare_digest(flag.encode('utf8'), token.encode('utf8'))
+               for flag in flags):
+        return app(env, start_response)
+    env = dict(env, QUERY_STRING=urllib.parse.urlencode(
+        [(key, value) for key, value in params if key != _PROFILING_PARAM]))
+    env.pop(_PROFILING_HEADER, None)
+    route = _route(str(env.get('PATH_INFO', '')) or '/')
+    name = '{}-{}-{}-{}{}.prof'.format(
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(_PROFILING_IDS),
+        str(env.get('REQUEST_METHOD', '')).upper(),
+        re.sub('[^a-z_]+', '', route.replace('/', '_')))
+    return _profile_response(app, env, start_response,
+                             os.path.join(directory, name))
+
+
+def _profile_response(app: 'WSGIApplication', env: Dict[str, Any],
+                      start_response: 'StartResponse',
+                      path: str) -> Iterable[bytes]:
+    '''Call WSGI application `app` with cProfile enabled while the
+       response is produced and dump the statistics to `path`.'''
+    def start_profiled(status: str, headers: List[Tuple[str, str]],
+                       exc_info: Any = None) -> Callable[[bytes], Any]:
+        headers = headers + [('X-BlanketDB-Profile-File',
+                              os.path.basename(path))]
+        if exc_info:
+            return start_response(status, headers, exc_info)
+        return start_response(status, headers)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        app_iter = app(env, start_profiled)
+        chunks = iter(app_iter)
+    finally:
+        profiler.disable()
+    try:
+        while True:
+            profiler.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            yield chunk
+    finally:
+        getattr(app_iter, 'close', lambda: None)()
+        profiler.dump_stats(path)
+
+
+def _prometheus_labels(labels: _Labels) -> str:
+    '''Format labels like `{name="value"}` for the Prometheus text format.'''
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for name, value in labels) + '}'
+
+
+class _Trace:
+    '''Rows and time per phase of the request handled by a thread.'''
+
+    def __init__(self) -> None:
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_deleted = 0
+        self.sqlite = 0.0
+        self.wait = 0.0
+        self.send = 0.0
+
+
+def _normalized_params(query_string: str) -> Dict[str, List[str]]:
+    '''Sorted query parameters of a request for the slow request log,
+       without the (secret) profiling flag.'''
+    params = dict()  # type: Dict[str, List[str]]
+    for key, value in sorted(urllib.parse.parse_qsl(query_string,
+                                                    keep_blank_values=True)):
+        if key != _PROFILING_PARAM:
+            params.setdefault(key, []).append(value)
+    return params
+
+
+class _Metrics:
+    '''Thread-safe counters and latency histograms of requests, rows and
+       SQLite time, rendered in the Prometheus text format by `render`.
+       Requests taking at least `slow_threshold` seconds (not counting
+       time waiting for new entries) are logged with their rows and time
+       per phase.'''
+
+    def __init__(self, slow_threshold: Optional[float] = None) -> None:
+        self.slow_threshold = slow_threshold
+        self._traces = threading.local()
+        self._lock = threading.Lock()
+        # (method, route, status) -> number of requests
+        self.requests = dict()  # type: Dict[Tuple[str, str, str], int]
+        # (method, route) -> count per latency bucket (last is +Inf), sum
+        self.latencies = dict()  # type: Dict[Tuple[str, str], List[Any]]
+        self.bytes_out = dict()  # type: Dict[str, int]
+        self.rows_written = dict()  # type: Dict[str, int]
+        self.rows_read = 0
+        self.rows_deleted = 0
+        self.read_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def instrument(self, app: 'WSGIApplication', env: Dict[str, Any],
+                   start_response: 'StartResponse') -> Iterable[bytes]:
+        '''Call WSGI application `app` and record status, latency (until
+           the response has been sent completely) and size of the
+           response.'''
+        start = time.perf_counter()
+        status = ['']
+
+        def start_instrumented(status_line: str,
+                               headers: List[Tuple[str, str]],
+                               exc_info: Any = None) -> Callable[[bytes], Any]:
+            status[0] = status_line[:3]
+            if exc_info:
+                return start_response(status_line, headers, exc_info)
+            return start_response(status_line, headers)
+
+        size = 0
+        trace = self._traces.trace = _Trace()
+        app_iter = app(env, start_instrumented)
+        try:
+            for chunk in app_iter:
+                size += len(chunk)
+                sending = time.perf_counter()
+                yield chunk
+                trace.send += time.perf_counter() - sending
+        finally:
+            getattr(app_iter, 'close', lambda: None)()
+            self._traces.trace = None
+            method = str(env.get('REQUEST_METHOD', '')).upper()
+            route = _route(str(env.get('PATH_INFO', '')) or '/')
+            seconds = time.perf_counter() - start
+            self.request(method, route, status[0], seconds, size)
+            if self.slow_threshold is not None and \
+                    seconds - trace.wait >= self.slow_threshold:
+                self._log_slow(env, method, route, status[0],
+                               seconds, size, trace)
+
+    def _log_slow(self, env: Dict[str, Any], method: str, route: str,
+                  status: str, seconds: float, size: int,
+                  trace: _Trace) -> None:
+        '''Log a slow request as a single line of JSON.'''
+        def ms(seconds: float) -> float:
+            return round(1000 * seconds, 3)
+        python = seconds - trace.wait - trace.sqlite - trace.send
+        logging.getLogger(__name__ + '.slow').warning(
+            'Slow request %s', _serialize_json(dict(
+                method=method, route=route, path=env.get('PATH_INFO'),
+                params=_normalized_params(str(env.get('QUERY_STRING', ''))),
+                status=status, bytes=size,
+                rows=dict(read=trace.rows_read, written=trace.rows_written,
+                          deleted=trace.rows_deleted),
+                ms=dict(total=ms(seconds), wait=ms(trace.wait),
+                        sqlite=ms(trace.sqlite), send=ms(trace.send),
+                        python=ms(max(python, 0.0)))), indent=None))
+
+    def _trace(self) -> Optional[_Trace]:
+        '''Return the trace of the request handled by this thread.'''
+        return getattr(self._traces, 'trace', None)
+
+    def waited(self, seconds: float) -> None:
+        '''Record `seconds` spent waiting for new entries.'''
+        trace = self._trace()
+        if trace:
+            trace.wait += seconds
+
+    def request(self, method: str, route: str, status: str,
+                seconds: float, size: int) -> None:
+        '''Record a request.'''
+        index = bisect.bisect_left(_LATENCY_BUCKETS, seconds)
+        with self._lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            latency = self.latencies.get((method, route))
+            if latency is None:
+                latency = self.latencies[method, route] = \
+                    [[0] * (len(_LATENCY_BUCKETS) + 1), 0.0]
+            latency[0][index] += 1
+            latency[1] += seconds
+            self.bytes_out[route] = self.bytes_out.get(route, 0) + size
+
+    def read(self, rows: int, seconds: float) -> None:
+        '''Record `rows` read from SQLite in `seconds`.'''
+        with self._lock:
+            self.rows_read += rows
+            self.read_seconds += seconds
+        trace = self._trace()
+        if trace:
+            trace.rows_read += rows
+            trace.sqlite += seconds
+
+    def written(self, bucket: str, rows: int, seconds: float) -> None:
+        '''Record `rows` stored in `bucket` in `seconds`.'''
+        with self._lock:
+            self.rows_written[bucket] = self.rows_written.get(bucket, 0) + rows
+            self.write_seconds += seconds
+        trace = self._trace()
+        if trace:
+            trace.rows_written += rows
+            trace.sqlite += seconds
+
+    def deleted(self, rows: int, seconds: float = 0.0) -> None:
+        '''Record `rows` deleted in `seconds`.'''
+        with self._lock:
+            self.rows_deleted += rows
+        trace = self._trace()
+        if trace:
+            trace.rows_deleted += rows
+            trace.sqlite += seconds
+
+    def render(self, extra: Iterable[Tuple[str, str, str,
+                                           List[Tuple[_Labels, Any]]]]) \
+            -> str:
+        '''Render all metrics and `extra` metrics (name, type, help text
+           and value per labels) in the Prometheus text format.'''
+        lines = []  # type: List[str]
+
+        def metric(name: str, kind: str, text: str,
+                   values: Iterable[Tuple[_Labels, Any]]) -> None:
+            lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in values:
+                lines.append('{}{} {}'.format(name, _prometheus_labels(labels),
+                                              value))
+        with self._lock:
+            metric('blanketdb_requests_total', 'counter',
+                   'Requests by method, route and status',
+                   [((('method', m), ('route', r), ('status', s)), n)
+                    for (m, r, s), n in sorted(self.requests.items())])
+            lines.append('# HELP blanketdb_request_duration_seconds ' +
+                         'Time until the response has been sent')
+            lines.append('# TYPE blanketdb_request_duration_seconds ' +
+                         'histogram')
+            for (m, r), (counts, total) in sorted(self.latencies.items()):
+                labels = (('method', m), ('route', r))
+                cumulative = 0
+                for le, n in zip(_LATENCY_BUCKETS, counts):
+                    cumulative += n
+                    lines.append('blanketdb_request_duration_seconds_bucket' +
+                                 '{} {}'.format(_prometheus_labels(
+                                     labels + (('le', repr(le)),)),
+                                     cumulative))
+                lines.append('blanketdb_request_duration_seconds_bucket' +
+                             '{} {}'.format(_prometheus_labels(
+                                 labels + (('le', '+Inf'),)), sum(counts)))
+                lines.append('blanketdb_request_duration_seconds_sum' +
+                             '{} {}'.format(_prometheus_labels(labels), total))
+                lines.append('blanketdb_request_duration_seconds_count' +
+                             '{} {}'.format(_prometheus_labels(labels),
+                                            sum(counts)))
+            metric('blanketdb_response_bytes_total', 'counter',
+                   'Bytes of response bodies by route',
+                   [((('route', r),), n)
+                    for r, n in sorted(self.bytes_out.items())])
+            metric('blanketdb_rows_written_total', 'counter',
+                   'Entries stored by bucket',
+                   [((('bucket', b),), n)
+                    for b, n in sorted(self.rows_written.items())])
+            metric('blanketdb_rows_read_total', 'counter',
+                   'Entries read from SQLite', [((), self.rows_read)])
+            metric('blanketdb_rows_deleted_total', 'counter',
+                   'Entries deleted', [((), self.rows_deleted)])
+            metric('blanketdb_sqlite_read_seconds_total', 'counter',
+                   'Time spent reading entries from SQLite',
+                   [((), self.read_seconds)])
+            metric('blanketdb_sqlite_write_seconds_total', 'counter',
+                   'Time spent storing entries',
+                   [((), self.write_seconds)])
+        for name, kind, text, values in extra:
+            metric(name, kind, text, values)
+        return '\n'.join(lines) + '\n'
+
+
+class _Notifier:
+    '''Keeps track of the latest entry ID per bucket to wake up threads
+       waiting for new entries (and to inform registered listeners).'''
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._last_ids = dict()  # type: Dict[Optional[str], int]
+        self.listeners = []  # type: List[Callable[[str, int], None]]
+
+    def notify(self, bucket: str, last_id: int) -> None:
+        '''Announce that entries up to `last_id` exist in `bucket`.'''
+        with self._condition:
+            for key in (bucket, None):
+                self._last_ids[key] = max(last_id, self._last_ids.get(key, 0))
+            self._condition.notify_all()
+        for listener in list(self.listeners):
+            try:
+                listener(bucket, last_id)
+            except Exception:
+                # the entries have been committed, a failing listener
+                # must not turn the write into an error
+                logging.getLogger(__name__).exception(
+                    'Error notifying listener')
+
+    def wait(self, bucket: Optional[str], since_id: int,
+             timeout: Optional[float]) -> bool:
+        '''Wait until an entry with ID `since_id` or higher has been
+           announced for `bucket` (any bucket if None) or `timeout` seconds
+           have passed. Return whether such an entry has been announced.'''
+        since_id = max(since_id, 1)
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._last_ids.get(bucket, 0) >= since_id, timeout)
+
+
+def _poll_step(deadline: Optional[float],
+               poll_interval: Optional[float]) -> Optional[float]:
+    '''Return the number of seconds to wait for a notification before
+       polling again (None meaning forever) given the `deadline` on the
+       monotonic clock and `poll_interval`.'''
+    remaining = None if deadline is None else deadline - time.monotonic()
+    if poll_interval is None or remaining is not None and \
+            remaining <= poll_interval:
+        return remaining
+    return poll_interval
+
+
+class _PeriodicTask:
+    '''Background thread calling `func` every `interval` seconds
+       until stopped.'''
+
+    def __init__(self, interval: float,
+                 func: Callable[[], Any],
+                 name: str) -> None:
+        self.interval = interval
+        self._func = func
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self._func()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'Periodic task %s failed', self._thread.name)
+
+    def stop(self) -> None:
+        '''Stop the task, waiting for a running call to `func`.'''
+        self._stopped.set()
+        self._thread.join()
+
+
 class BlanketDB:
     '''A simple HTTP accessible database for IoT projects'''
 
-    _SOURCE = 'FROM blanketdb WHERE (? OR bucket=?) AND rowid>=? ' + \
-              'AND timestamp>=? AND (? OR rowid<?) AND (? OR timestamp<?)'
-    _QUERY = 'SELECT rowid, * ' + _SOURCE + \
-             ' ORDER BY (? * rowid) DESC LIMIT ?;'
-    _DELETE = 'DELETE ' + _SOURCE + ';'
-
     def __init__(self,
                  connection_string: str,
-                 now: Callable[[], datetime] = datetime.now) -> None:
+                 now: Callable[[], datetime] = datetime.now,
+                 pool_size: int = 4,
+                 profile: str = 'safe',
+                 commit_latency: Optional[float] = None,
+                 commit_rows: int = 256,
+                 retention_interval: Optional[float] = None,
+                 retention_chunk_size: int = 1000,
+                 retention_pause: float = 0.05,
+                 poll_interval: Optional[float] = None,
+                 cache_size: int = 0,
+                 cache_freshness: float = 1.0,
+                 slow_request_threshold: Optional[float] = None,
+                 profiling_dir: Optional[str] = None,
+                 profiling_token: Optional[str] = None,
+                 schema: Optional[str] = None,
+                 partition: Optional[str] = None) -> None:
         '''Initialize `BlanketDB` instance using a `connection_string`
            that can be understood by SQLite. `now` should be a function
            returning the current datetime (or a suitable test replacement).
+           At most `pool_size` connections are opened to serve concurrent
+           threads (in-memory databases always use a single connection).
+           `profile` selects the durability/performance trade-off of the
+           SQLite connections and is one of "safe", "balanced" and "fast".
+           If `commit_latency` (in seconds) is given, `store` hands rows to
+           a background writer which commits them in groups of at most
+           `commit_rows` rows, delaying each row by at most `commit_latency`.
+           If `retention_interval` (in seconds) is given, retention policies
+           are enforced periodically by a background thread, see
+           `enforce_retention` for `retention_chunk_size` and
+           `retention_pause`.
+           Waiting for new entries is only woken up by writes of this
+           instance, if other processes write to the same database file,
+           pass `poll_interval` (in seconds) to check for their entries
+           periodically.
+           If `cache_size` (in bytes) is positive, query responses are
+           cached up to that size until a write to their bucket by this
+           instance (do not use it if other processes write to the same
+           database file). Responses to queries with relative times like
+           "1h" are reused for at most `cache_freshness` seconds.
+           HTTP requests taking at least `slow_request_threshold` seconds
+           (not counting time waiting for new entries) are logged to the
+           "blanketdb.slow" logger. If `profiling_dir` is given, requests
+           passing `profiling_token` in the X-BlanketDB-Profile header or
+           the `_profile` query parameter are profiled with cProfile and
+           the statistics are dumped to that directory.
+           `schema` selects the storage layout of new databases: "text"
+           (default) stores bucket names and ISO timestamps in every row,
+           "compact" integer bucket IDs and microseconds since the epoch,
+           saving space and comparing integers. Existing databases keep
+           their layout.
+           `partition` ("day" or "month") stores the entries of a new
+           database in one table per period instead, such that queries
+           only read the tables of the periods they cover and expired
+           periods are dropped as a whole (see `enforce_retention`).
         '''
-        self.connection = sqlite3.connect(connection_string,
-                                          detect_types=sqlite3.PARSE_DECLTYPES)
-        with self.connection as conn:
-            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb ' +
-                         '(bucket text, timestamp timestamp, data text);')
+        if profile not in _PROFILES:
+            raise ValueError('Unknown profile "{}", use one of {}'
+                             .format(profile, ', '.join(_PROFILES)))
+        if pool_size < 1:
+            raise ValueError('pool_size must be at least 1')
+        if profiling_dir is not None and not profiling_token:
+            raise ValueError('profiling_dir requires a profiling_token')
+        if schema is not None and schema not in _SCHEMAS:
+            raise ValueError('Unknown schema "{}", use one of {}'
+                             .format(schema, ', '.join(_SCHEMAS)))
+        if partition is not None and partition not in _PARTITION_FORMATS:
+            raise ValueError('Unknown partition period "{}", use one of {}'
+                             .format(partition,
+                                     ', '.join(_PARTITION_FORMATS)))
+        if connection_string in (':memory:', ''):
+            pool_size = 1  # each connection would get its own database
+
+        def connect() -> sqlite3.Connection:
+            conn = sqlite3.connect(connection_string,
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   check_same_thread=False)
+            # only effective for new databases (and only before switching
+            # to WAL), allows giving space of deleted entries back to
+            # the file system
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+            for pragma, value in _PROFILES[profile]:
+                conn.execute('PRAGMA {}={};'.format(pragma, value))
+            # the dictionaries are loaded before running SQL using
+            # _DATA_SQL (see `_data_sql`), the function cannot query them
+            conn.create_function('blanketdb_inflate', 1, self._inflate)
+            return conn
+        self._pool = _ConnectionPool(connect, pool_size)
+        self._file = None if connection_string in (':memory:', '') \
+            or connection_string.startswith('file:') else connection_string
+        self._metrics = _Metrics(slow_request_threshold)
+        self._bucket_ids = dict()  # type: Dict[str, int]
+        # preset dictionaries and primed compressors (by dictionary ID and
+        # level), dictionaries are never changed or deleted once stored
+        self._dictionaries = {0: b''}  # type: Dict[int, bytes]
+        self._deflaters = dict()  # type: Dict[Tuple[int, int], Any]
+        self.profiling_dir = profiling_dir
+        self.profiling_token = profiling_token
+        with self._pool.transaction() as conn:
+            existing = [name for name, table in _SCHEMA_TABLES.items()
+                        if conn.execute('SELECT 1 FROM sqlite_master ' +
+                                        'WHERE type=\'table\' AND name=?;',
+                                        (table,)).fetchone()]
+            if existing and schema not in (None, existing[0]):
+                raise ValueError('The database uses the "{}" schema'
+                                 .format(existing[0]))
+            self._schema = existing[0] if existing else schema or 'text'
+            for sql in _SCHEMAS[self._schema]:
+                conn.execute(sql)
+            # the table of the schema stays empty in partitioned databases
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_setting ' +
+                         '(name text PRIMARY KEY, value text) WITHOUT ROWID;')
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_partition ' +
+                         '(first_id integer PRIMARY KEY, ' +
+                         'name text NOT NULL UNIQUE, ' +
+                         'start_time integer NOT NULL, ' +
+                         'end_time integer NOT NULL);')
+            row = conn.execute('SELECT value FROM blanketdb_setting ' +
+                               'WHERE name=\'partition\';').fetchone()
+            if existing and partition not in (None, row and row[0]):
+                raise ValueError('The database is ' + (
+                    'partitioned by "{}"'.format(row[0]) if row
+                    else 'not partitioned'))
+            if not existing and partition:
+                conn.execute('INSERT INTO blanketdb_setting ' +
+                             'VALUES (\'partition\', ?);', (partition,))
+            self._partition = (row[0] if row else None) if existing \
+                else partition  # type: Optional[str]
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_rollup_spec ' +
+                         '(bucket text, field text, interval integer, ' +
+                         'funcs text, PRIMARY KEY (bucket, field, interval))' +
+                         ' WITHOUT ROWID;')
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_rollup ' +
+                         '(bucket text, field text, interval integer, ' +
+                         'bin integer, n integer, total real, ' +
+                         'minimum real, maximum real, ' +
+                         'PRIMARY KEY (bucket, field, interval, bin))' +
+                         ' WITHOUT ROWID;')
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_retention ' +
+                         '(bucket text PRIMARY KEY, max_age integer, ' +
+                         'max_rows integer) WITHOUT ROWID;')
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_field_index ' +
+                         '(bucket text, field text, name text, ' +
+                         'PRIMARY KEY (bucket, field)) WITHOUT ROWID;')
+            # number of deletions per bucket ('' for all buckets), which
+            # change the ETags of query responses (see `_etag`)
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_deletion ' +
+                         '(bucket text PRIMARY KEY, n integer NOT NULL) ' +
+                         'WITHOUT ROWID;')
+            # a NULL level disables compressing new entries of the bucket,
+            # while its existing entries may still be compressed
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_compression ' +
+                         '(bucket text PRIMARY KEY, dictionary integer ' +
+                         'NOT NULL, level integer) WITHOUT ROWID;')
+            conn.execute('CREATE TABLE IF NOT EXISTS blanketdb_dictionary ' +
+                         '(id integer PRIMARY KEY AUTOINCREMENT, ' +
+                         'bucket text NOT NULL, dictionary blob NOT NULL);')
+        self._compact = self._schema == 'compact'
+        self._table = _SCHEMA_TABLES[self._schema]
+        self._meta = _SCHEMA_META[self._schema]
         self.now = now
+        self.poll_interval = poll_interval
+        self.cache_freshness = cache_freshness
+        self._cache = _ResponseCache(cache_size) if cache_size > 0 else None
+        self._notifier = _Notifier()
+        self._writer = _GroupCommitWriter(self._pool, self._insert,
+                                          commit_latency, commit_rows) \
+            if commit_latency is not None else None
+        self._retention = _PeriodicTask(
+            retention_interval,
+            lambda: self.enforce_retention(retention_chunk_size,
+                                           retention_pause),
+            'blanketdb-retention') \
+            if retention_interval is not None else None
+
+    def close(self) -> None:
+        '''Commit pending writes and close all database connections
+           of this `BlanketDB` instance.'''
+        if self._retention:
+            self._retention.stop()
+        if self._writer:
+            self._writer.close()
+        self._pool.close()
+
+    def __enter__(self) -> 'BlanketDB':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> List[int]:
+        '''Checkpoint the write-ahead log using `mode` (one of PASSIVE,
+           FULL, RESTART or TRUNCATE). Return the result of SQLite\'s
+           wal_checkpoint pragma, i.e. busy flag, WAL frames and frames
+           checkpointed. SQLite also checkpoints automatically according
+           to the selected profile.'''
+        mode = mode.upper()
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError('Unknown checkpoint mode "{}"'.format(mode))
+        with self._pool.connection() as conn:
+            return list(conn.execute('PRAGMA wal_checkpoint({});'
+                                     .format(mode)).fetchone())
+
+    def _bucket_id(self, bucket: str, create: bool = False) -> int:
+        '''Return the ID of `bucket` in the compact schema, -1 for buckets
+           without entries unless `create`. IDs are never reassigned, i.e.
+           they can be cached.'''
+        name = bucket.lower()
+        bucket_id = self._bucket_ids.get(name)
+        if bucket_id is not None:
+            return bucket_id
+        with self._pool.transaction() if create \
+                else self._pool.connection() as conn:
+            if create:
+                conn.execute('INSERT OR IGNORE INTO blanketdb_bucket ' +
+                             '(name) VALUES (?);', (name,))
+            row = conn.execute('SELECT id FROM blanketdb_bucket ' +
+                               'WHERE name=?;', (name,)).fetchone()
+        if row is None:
+            return -1
+        bucket_id = self._bucket_ids[name] = row[0]
+        return bucket_id
+
+    def _bucket_key(self, bucket: Optional[str]) \
+            -> Optional[Union[str, int]]:
+        '''Return the value of the bucket column for `bucket`.'''
+        if self._compact and bucket:
+            return self._bucket_id(bucket)
+        return bucket
+
+    def _filter(self, bucket: Optional[str] = None,
+                since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                where: Optional[str] = None,
+                data: Optional[str] = None) -> Tuple[str, List[Any]]:
+        '''Build the WHERE clause of the filters (see `_filter_sql`) for
+           the schema of this database.'''
+        if where and data is None:
+            data = self._data_sql(bucket)
+        return _filter_sql(self._bucket_key(bucket), since_id, since,
+                           before_id, before, where, self._compact,
+                           data or 'data')
+
+    def _stored_row(self, row: _Row,
+                    compress: Optional[Callable[[str], Union[str, bytes]]]
+                    = None) -> Tuple[Any, ...]:
+        '''Convert `row` to the values of the columns of the schema,
+           compressing its data using `compress` (see `_compressor`).'''
+        bucket, timestamp, data = row
+        stored = compress(data) if compress else data
+        if not self._compact:
+            return bucket, timestamp, stored
+        return (self._bucket_id(bucket, create=True), _epoch_us(timestamp),
+                stored)
+
+    def _load_dictionaries(self, conn: sqlite3.Connection) -> None:
+        '''Load the preset dictionaries stored since the last call (by
+           this or other processes) using `conn`.'''
+        for dictionary_id, dictionary in conn.execute(
+                'SELECT id, dictionary FROM blanketdb_dictionary ' +
+                'WHERE id>?;', (max(self._dictionaries),)):
+            self._dictionaries[dictionary_id] = dictionary
+
+    def _inflate(self, payload: bytes,
+                 conn: Optional[sqlite3.Connection] = None) -> str:
+        '''Decompress the stored `payload` of an entry to its JSON text,
+           loading its dictionary using `conn` if not known yet.'''
+        fmt, dictionary_id = _COMPRESSION_HEADER.unpack_from(payload)
+        if fmt != _COMPRESSION_FORMAT:
+            raise ValueError('Unknown compression format {}'.format(fmt))
+        if dictionary_id not in self._dictionaries and conn is not None:
+            self._load_dictionaries(conn)
+        dictionary = self._dictionaries[dictionary_id]
+        decompressor = zlib.decompressobj(-15, zdict=dictionary) \
+            if dictionary else zlib.decompressobj(-15)
+        data = decompressor.decompress(payload[_COMPRESSION_HEADER.size:])
+        return (data + decompressor.flush()).decode('utf8')
+
+    def _inflated(self, conn: sqlite3.Connection,
+                  row: _EntryRow) -> _EntryRow:
+        '''Return `row` with its data decompressed (if compressed).'''
+        if isinstance(row[3], bytes):
+            return row[0], row[1], row[2], self._inflate(row[3], conn)
+        return row
+
+    def _data_sql(self, bucket: Optional[str]) -> str:
+        '''Return the SQL of the JSON text of the data of entries of
+           `bucket` (all buckets if None). Buckets with indexed fields never
+           hold compressed entries (see `set_compression`) and use plain
+           "data", which the expressions of their indexes refer to. Loads
+           the dictionaries required by `_DATA_SQL` otherwise.'''
+        with self._pool.connection() as conn:
+            if bucket and conn.execute('SELECT 1 FROM blanketdb_field_index ' +
+                                       'WHERE bucket=? LIMIT 1;',
+                                       (bucket.lower(),)).fetchone():
+                return 'data'
+            self._load_dictionaries(conn)
+        return _DATA_SQL
+
+    def _compressor(self, conn: sqlite3.Connection, bucket: str) \
+            -> Optional[Callable[[str], Union[str, bytes]]]:
+        '''Return a function compressing the data of new entries of
+           `bucket` (None if disabled) using `conn`. The setting is not
+           cached as other processes sharing the database may change it.'''
+        row = conn.execute('SELECT dictionary, level ' +
+                           'FROM blanketdb_compression ' +
+                           'WHERE bucket=? AND level IS NOT NULL;',
+                           (bucket,)).fetchone()
+        if row is None:
+            return None
+        dictionary_id, level = row
+        deflater = self._deflaters.get((dictionary_id, level))
+        if deflater is None:
+            if dictionary_id not in self._dictionaries:
+                self._load_dictionaries(conn)
+            deflater = self._deflaters[dictionary_id, level] = _deflater(
+                level, self._dictionaries[dictionary_id])
+        return lambda text: _deflate(deflater, dictionary_id, text)
+
+    def _tables(self, since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                newest_first: bool = True) -> List[str]:
+        '''Return the tables which may hold entries within the bounds,
+           i.e. the table of the schema or the overlapping partitions
+           ordered by the IDs of their entries.'''
+        if not self._partition:
+            return [self._table]
+        clauses, params = [], []  # type: Tuple[List[str], List[Any]]
+        since = _parse_dt(since)
+        if since:
+            clauses.append('end_time>?')
+            params.append(_epoch_us(since))
+        before = _parse_dt(before)
+        if before:
+            clauses.append('start_time<?')
+            params.append(_epoch_us(before))
+        if since_id:
+            clauses.append('first_id>=(SELECT coalesce(max(first_id), 0) ' +
+                           'FROM blanketdb_partition WHERE first_id<=?)')
+            params.append(since_id)
+        if before_id:
+            clauses.append('first_id<?')
+            params.append(before_id)
+        sql = 'SELECT name FROM blanketdb_partition' + \
+              (' WHERE ' + ' AND '.join(clauses) if clauses else '') + \
+              ' ORDER BY first_id ' + ('DESC' if newest_first else 'ASC')
+        with self._pool.connection() as conn:
+            return [name for name, in conn.execute(sql + ';', params)]
+
+    def _partition_table(self, conn: sqlite3.Connection,
+                         timestamp: datetime) -> str:
+        '''Return the partition to insert entries stored at `timestamp`
+           into using `conn`. This is always the newest partition (which
+           starts earlier if the clock went back), such that IDs increase
+           across partitions, or a new one after the end of its period.'''
+        us = _epoch_us(timestamp)
+        # as a write, the update also starts the transaction, i.e. the
+        # newest partition cannot change until the commit
+        conn.execute('UPDATE blanketdb_partition SET start_time=? ' +
+                     'WHERE first_id=(SELECT max(first_id) ' +
+                     'FROM blanketdb_partition) AND start_time>?;', (us, us))
+        row = conn.execute('SELECT first_id, name, end_time ' +
+                           'FROM blanketdb_partition ' +
+                           'ORDER BY first_id DESC LIMIT 1;').fetchone()
+        if row and us < row[2]:
+            return cast(str, row[1])
+        last_id = 0
+        if row:
+            seq = conn.execute('SELECT seq FROM sqlite_sequence ' +
+                               'WHERE name=?;', (row[1],)).fetchone()
+            last_id = max(row[0] - 1, seq[0] if seq else 0)
+        start, end = _partition_period(cast(str, self._partition), timestamp)
+        name = self._table + '_' + \
+            start.strftime(_PARTITION_FORMATS[cast(str, self._partition)])
+        for sql in _PARTITION_SCHEMAS[self._schema]:
+            conn.execute(sql.format(name=name))
+        conn.execute('INSERT INTO sqlite_sequence (name, seq) ' +
+                     'VALUES (?, ?);', (name, last_id))
+        conn.execute('INSERT INTO blanketdb_partition VALUES (?, ?, ?, ?);',
+                     (last_id + 1, name, _epoch_us(start), _epoch_us(end)))
+        for bucket, field, index in conn.execute(
+                'SELECT * FROM blanketdb_field_index;').fetchall():
+            self._create_field_index(conn, name, index, bucket, field)
+        return name
+
+    def _drop_partition(self, conn: sqlite3.Connection, name: str) -> None:
+        '''Drop the partition `name` (with its indexes) using `conn`.'''
+        conn.execute('DROP TABLE IF EXISTS {};'.format(name))
+        conn.execute('DELETE FROM sqlite_sequence WHERE name=?;', (name,))
+        conn.execute('DELETE FROM blanketdb_partition WHERE name=?;',
+                     (name,))
+
+    def _insert(self, conn: sqlite3.Connection, row: _Row) -> int:
+        '''Insert `row` using `conn` and return its ID.'''
+        table = self._partition_table(conn, row[1]) if self._partition \
+            else self._table
+        c = conn.execute('INSERT INTO ' + table +
+                         ' (bucket, timestamp, data) VALUES (?, ?, ?);',
+                         self._stored_row(row,
+                                          self._compressor(conn, row[0])))
+        entry_id = cast(int, c.lastrowid)
+        self._update_rollups(conn, [row])
+        return entry_id
+
+    def _rollup_specs(self, conn: sqlite3.Connection,
+                      bucket: str) -> List[Tuple[str, int, List[str]]]:
+        '''Load the rollup specs of `bucket`, i.e. field, interval and
+           functions. Specs are not cached as other processes sharing
+           the database file may change them.'''
+        return [(field, interval, funcs.split(','))
+                for field, interval, funcs in conn.execute(
+                    'SELECT field, interval, funcs ' +
+                    'FROM blanketdb_rollup_spec WHERE bucket=?;', (bucket,))]
+
+    def _update_rollups(self, conn: sqlite3.Connection,
+                        rows: List[_Row]) -> None:
+        '''Add `rows` to the rollups of their buckets using `conn`.'''
+        params = []  # type: List[Tuple[Any, ...]]
+        specs = dict()  # type: Dict[str, List[Tuple[str, int, List[str]]]]
+        for bucket, timestamp, data in rows:
+            if bucket not in specs:
+                specs[bucket] = self._rollup_specs(conn, bucket)
+            seconds = int((timestamp - _EPOCH).total_seconds())
+            for field, interval, _ in specs[bucket]:
+                params.append((bucket, field, interval, seconds // interval,
+                               data, _json_path(field)))
+        if params:
+            conn.executemany(_ROLLUP_UPSERT, params)
+
+    def configure_rollup(self, bucket: str,
+                         fields: Union[str, Iterable[str]],
+                         intervals: Union[str, int,
+                                          Iterable[Union[str, int]]] = (
+                             '1min', '1h', '1d'),
+                         funcs: Union[str, Iterable[str]] = ('avg', 'min',
+                                                             'max')) \
+            -> None:
+        '''Maintain rollups of the numeric (dotted) `fields` of entries
+           stored under `bucket` per time bin of each of the `intervals`.
+           The rollups are updated by every write to `bucket` and support
+           the aggregate functions avg, min, max, sum and count, of which
+           `funcs` are returned by default. Rollups are (re-)computed from
+           the existing entries of `bucket`, deleting entries afterwards
+           does not affect them. Pass no `fields` to remove all rollups
+           of `bucket`. A single field, interval or function may be given
+           instead of a list.'''
+        bucket = bucket.lower()
+        fields = [fields] if isinstance(fields, str) else list(fields)
+        for field in fields:
+            _json_path(field)  # raises ValueError for invalid fields
+        if isinstance(intervals, (str, int)):
+            intervals = [intervals]
+        seconds = sorted(set(_parse_interval(i) for i in intervals))
+        funcs = [func.lower() for func in
+                 ([funcs] if isinstance(funcs, str) else funcs)]
+        for func in funcs:
+            if func not in _AGGREGATE_FUNCTIONS:
+                raise ValueError('Unknown aggregate function "{}"'
+                                 .format(func))
+        key = self._bucket_key(bucket)
+        tables = self._tables()
+        data = self._data_sql(bucket)
+        with self._pool.transaction() as conn:
+            conn.execute('DELETE FROM blanketdb_rollup_spec WHERE bucket=?;',
+                         (bucket,))
+            conn.execute('DELETE FROM blanketdb_rollup WHERE bucket=?;',
+                         (bucket,))
+            for field in fields:
+                for interval in seconds:
+                    conn.execute('INSERT INTO blanketdb_rollup_spec ' +
+                                 'VALUES (?, ?, ?, ?);',
+                                 (bucket, field, interval, ','.join(funcs)))
+                    for table in tables:
+                        conn.execute(_ROLLUP_BACKFILL.format(
+                            seconds=_SCHEMA_SECONDS[self._schema],
+                            data=data, table=table),
+                            (bucket, field, interval, interval,
+                             _json_path(field), key))
+
+    def set_retention(self, bucket: str,
+                      max_age: Optional[Union[str, int]] = None,
+                      max_rows: Optional[int] = None) -> None:
+        '''Set the retention policy of `bucket`: entries older than
+           `max_age` (e.g. "30d" or a number of seconds) and all but the
+           latest `max_rows` entries expire. Without both arguments, the
+           retention policy of `bucket` is removed.'''
+        bucket = bucket.lower()
+        seconds = _parse_interval(max_age) if max_age is not None else None
+        if max_rows is not None and max_rows < 0:
+            raise ValueError('max_rows must not be negative')
+        with self._pool.transaction() as conn:
+            if seconds is None and max_rows is None:
+                conn.execute('DELETE FROM blanketdb_retention ' +
+                             'WHERE bucket=?;', (bucket,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO blanketdb_retention ' +
+                             'VALUES (?, ?, ?);', (bucket, seconds, max_rows))
+
+    def retention_policies(self) -> Dict[str, Dict[str, Optional[int]]]:
+        '''Return max_age (in seconds) and max_rows per bucket.'''
+        with self._pool.connection() as conn:
+            return {bucket: dict(max_age=max_age, max_rows=max_rows)
+                    for bucket, max_age, max_rows
+                    in conn.execute('SELECT * FROM blanketdb_retention;')}
+
+    def set_indexed_fields(self, bucket: str, fields: Iterable[str]) -> None:
+        '''Index the (dotted) `fields` of the data of entries stored under
+           `bucket`, such that `where` filters on these fields within
+           `bucket` are answered by index lookups instead of scanning the
+           bucket. Each index only holds the entries of `bucket` and is
+           built from its existing entries (blocking writes meanwhile).
+           Indexes of `bucket` on fields not in `fields` are dropped.
+           Buckets which have ever been compressed (see `set_compression`)
+           cannot be indexed.'''
+        bucket = bucket.lower()
+        fields = list(fields)
+        for field in fields:
+            _json_path(field)  # raises ValueError for invalid fields
+        if self._compact:
+            self._bucket_id(bucket, create=True)
+        tables = self._tables()
+        with self._pool.transaction() as conn:
+            if fields and conn.execute('SELECT 1 FROM blanketdb_compression ' +
+                                       'WHERE bucket=?;',
+                                       (bucket,)).fetchone():
+                raise ValueError('Fields of compressed buckets cannot be ' +
+                                 'indexed')
+            for field, name in conn.execute(
+                    'SELECT field, name FROM blanketdb_field_index ' +
+                    'WHERE bucket=?;', (bucket,)).fetchall():
+                if field not in fields:
+                    for table in tables:
+                        conn.execute('DROP INDEX IF EXISTS {};'.format(
+                            self._index_name(table, name)))
+                    conn.execute('DELETE FROM blanketdb_field_index ' +
+                                 'WHERE bucket=? AND field=?;',
+                                 (bucket, field))
+            for field in fields:
+                name = 'blanketdb_field_' + hashlib.sha1(
+                    (bucket + '\0' + field).encode('utf8')).hexdigest()[:16]
+                for table in tables:
+                    self._create_field_index(conn, table, name, bucket, field)
+                conn.execute('INSERT OR REPLACE INTO blanketdb_field_index ' +
+                             'VALUES (?, ?, ?);', (bucket, field, name))
+
+    def _index_name(self, table: str, name: str) -> str:
+        '''Return the name of the field index `name` on `table`, i.e.
+           with the period of partitions appended.'''
+        return name + table[len(self._table):]
+
+    def _create_field_index(self, conn: sqlite3.Connection, table: str,
+                            name: str, bucket: str, field: str) -> None:
+        '''Create the field index `name` (see `set_indexed_fields`) on
+           `table` using `conn`.'''
+        if self._compact:
+            condition = str(conn.execute('SELECT id FROM blanketdb_bucket ' +
+                                         'WHERE name=?;',
+                                         (bucket,)).fetchone()[0])
+        else:
+            condition = "'" + bucket.replace("'", "''") + "'"
+        # the partial index is matched by queries on this bucket (SQLite
+        # considers the bound parameter of "bucket=?"), its expression by
+        # the SQL of `_field_sql`
+        conn.execute('CREATE INDEX IF NOT EXISTS ' +
+                     self._index_name(table, name) + ' ON ' + table +
+                     ' (' + _field_sql(field) + ') WHERE bucket=' +
+                     condition + ';')
+
+    def indexed_fields(self) -> Dict[str, List[str]]:
+        '''Return the indexed fields per bucket.'''
+        indexed = dict()  # type: Dict[str, List[str]]
+        with self._pool.connection() as conn:
+            for bucket, field in conn.execute(
+                    'SELECT bucket, field FROM blanketdb_field_index;'):
+                indexed.setdefault(bucket, []).append(field)
+        return indexed
+
+    def set_compression(self, bucket: str, level: Optional[int] = 6,
+                        samples: int = 1000) -> None:
+        '''Compress the data of entries stored under `bucket` from now on
+           using deflate at `level` (1 to 9) with a preset dictionary built
+           from the latest `samples` entries of `bucket`. Entries stored
+           before remain uncompressed, entries are decompressed when they
+           are returned only. Entries that would not get smaller are
+           stored uncompressed. Call again to rebuild the dictionary from
+           the current entries, pass `level` None to stop compressing new
+           entries. The fields of compressed buckets cannot be indexed
+           (see `set_indexed_fields`), as their indexes cannot read the
+           compressed data.'''
+        bucket = bucket.lower()
+        if level is not None and (not isinstance(level, int) or
+                                  isinstance(level, bool) or
+                                  not 1 <= level <= 9):
+            raise ValueError('level must be an integer from 1 to 9')
+        if not isinstance(samples, int) or samples < 0:
+            raise ValueError('samples must be a non-negative integer')
+        if level is None:
+            with self._pool.transaction() as conn:
+                conn.execute('UPDATE blanketdb_compression SET level=NULL ' +
+                             'WHERE bucket=?;', (bucket,))
+            return
+        dictionary = _train_dictionary(
+            entry['data'].encode('utf8')
+            for entry in self.query(bucket, limit=samples, raw=True)) \
+            if samples else b''
+        with self._pool.transaction() as conn:
+            if conn.execute('SELECT 1 FROM blanketdb_field_index ' +
+                            'WHERE bucket=? LIMIT 1;', (bucket,)).fetchone():
+                raise ValueError('Buckets with indexed fields cannot be ' +
+                                 'compressed')
+            dictionary_id = conn.execute(
+                'INSERT INTO blanketdb_dictionary (bucket, dictionary) ' +
+                'VALUES (?, ?);', (bucket, dictionary)).lastrowid \
+                if dictionary else 0
+            conn.execute('INSERT OR REPLACE INTO blanketdb_compression ' +
+                         'VALUES (?, ?, ?);', (bucket, dictionary_id, level))
+
+    def compression_info(self, bucket: str,
+                         samples: int = 1000) -> Dict[str, Any]:
+        '''Describe the compression of `bucket`, i.e. the level of new
+           entries (None if not compressed), the size of the current
+           dictionary and, for the latest `samples` entries, how many are
+           compressed, the size of their JSON text ("raw_bytes") and as
+           stored ("stored_bytes") and the ratio of both.'''
+        bucket = bucket.lower()
+        if not isinstance(samples, int) or samples < 0:
+            raise ValueError('samples must be a non-negative integer')
+        key = self._bucket_key(bucket)
+        raw_bytes = stored_bytes = compressed = sampled = 0
+        with self._pool.connection() as conn:
+            row = conn.execute('SELECT level, length(d.dictionary) ' +
+                               'FROM blanketdb_compression AS c ' +
+                               'LEFT JOIN blanketdb_dictionary AS d ' +
+                               'ON d.id=c.dictionary WHERE c.bucket=?;',
+                               (bucket,)).fetchone()
+            for table in self._tables():
+                for data, in conn.execute('SELECT data FROM ' + table +
+                                          ' WHERE bucket=? ' +
+                                          'ORDER BY rowid DESC LIMIT ?;',
+                                          (key, samples - sampled)):
+                    if isinstance(data, bytes):
+                        compressed += 1
+                        stored_bytes += len(data)
+                        data = self._inflate(data, conn)
+                    else:
+                        stored_bytes += len(data.encode('utf8'))
+                    raw_bytes += len(data.encode('utf8'))
+                    sampled += 1
+                if sampled >= samples:
+                    break
+        return dict(bucket=bucket,
+                    level=row[0] if row else None,
+                    dictionary_bytes=(row[1] or 0) if row else 0,
+                    sampled_entries=sampled,
+                    compressed_entries=compressed,
+                    raw_bytes=raw_bytes,
+                    stored_bytes=stored_bytes,
+                    ratio=raw_bytes / stored_bytes if stored_bytes else None)
+
+    def enforce_retention(self, chunk_size: int = 1000,
+                          pause: float = 0.05) -> Dict[str, int]:
+        '''Delete expired entries of all buckets with a retention policy.
+           Entries are deleted in transactions of at most `chunk_size`
+           entries, pausing `pause` seconds in between, such that writers
+           are never locked out for long. Afterwards, free pages are given
+           back to the file system in chunks of `chunk_size` pages (for
+           databases created with this version of BlanketDB) and the WAL
+           is checkpointed. In partitioned databases, partitions (except
+           the newest one) only holding expired entries are dropped
+           instead.
+           Return the number of deleted entries per bucket.'''
+        policies = self.retention_policies()
+        deleted = dict((bucket, 0) for bucket in policies)
+        cutoffs = dict((bucket, self.now() - timedelta(
+            seconds=policy['max_age'])) for bucket, policy in policies.items()
+            if policy['max_age'] is not None)
+        self._drop_expired(cutoffs, deleted)
+        for bucket, policy in policies.items():
+            n = 0
+            key = self._bucket_key(bucket)
+            if bucket in cutoffs:
+                cutoff = cutoffs[bucket]
+                for table in self._tables(before=cutoff):
+                    n += self._delete_chunked(bucket, table,
+                                              'bucket=? AND timestamp<?',
+                                              (key, _epoch_us(cutoff)
+                                               if self._compact else cutoff),
+                                              chunk_size, pause)
+            if policy['max_rows'] is not None:
+                offset = policy['max_rows']  # type: int
+                with self._pool.connection() as conn:
+                    for table in self._tables():
+                        row = conn.execute('SELECT rowid FROM ' + table +
+                                           ' WHERE bucket=? ORDER BY rowid ' +
+                                           'DESC LIMIT 1 OFFSET ?;',
+                                           (key, offset)).fetchone()
+                        if row:
+                            break
+                        offset -= conn.execute('SELECT count(*) FROM ' +
+                                               table + ' WHERE bucket=?;',
+                                               (key,)).fetchone()[0]
+                if row:
+                    for table in self._tables(before_id=row[0] + 1):
+                        n += self._delete_chunked(bucket, table,
+                                                  'bucket=? AND rowid<=?',
+                                                  (key, row[0]),
+                                                  chunk_size, pause)
+            deleted[bucket] += n
+        if self._partition and any(deleted.values()):
+            # partitions emptied by deleting entries
+            self._drop_expired(cutoffs, deleted)
+        for bucket, n in deleted.items():
+            if n:
+                self._metrics.deleted(n)
+                self._invalidate(bucket)
+        if any(deleted.values()):
+            with self._pool.connection() as conn:
+                incremental = conn.execute('PRAGMA auto_vacuum;') \
+                                  .fetchone()[0] == 2
+            while incremental:
+                with self._pool.transaction() as conn:
+                    # executescript runs the pragma to completion
+                    conn.executescript('PRAGMA incremental_vacuum({});'
+                                       .format(int(chunk_size)))
+                    free = conn.execute('PRAGMA freelist_count;') \
+                               .fetchone()[0]
+                if not free:
+                    break
+                time.sleep(pause)
+            self.checkpoint()
+        return deleted
+
+    def _drop_expired(self, cutoffs: Dict[str, datetime],
+                      deleted: Dict[str, int]) -> None:
+        '''Drop the partitions (except the newest one) which are empty or
+           end before the `cutoffs` of all buckets they hold entries of,
+           adding the number of dropped entries per bucket to `deleted`.'''
+        if not self._partition:
+            return
+        keys = dict((self._bucket_key(bucket), bucket) for bucket in cutoffs)
+        end = max((_epoch_us(cutoff) for cutoff in cutoffs.values()),
+                  default=0)
+        with self._pool.connection() as conn:
+            partitions = conn.execute(
+                'SELECT name, end_time FROM blanketdb_partition ' +
+                'WHERE first_id<(SELECT max(first_id) ' +
+                'FROM blanketdb_partition) ORDER BY first_id;').fetchall()
+        for name, end_time in partitions:
+            with self._pool.transaction() as conn:
+                if end_time > end:
+                    if conn.execute('SELECT 1 FROM ' + name +
+                                    ' LIMIT 1;').fetchone():
+                        continue
+                    counts = []  # type: List[Tuple[Any, int]]
+                else:
+                    # counted from the bucket index, the entries themselves
+                    # are not read
+                    counts = conn.execute('SELECT bucket, count(*) FROM ' +
+                                          name +
+                                          ' GROUP BY bucket;').fetchall()
+                if all(key in keys and
+                       _epoch_us(cutoffs[keys[key]]) >= end_time
+                       for key, _ in counts):
+                    self._drop_partition(conn, name)
+                    for key, n in counts:
+                        deleted[keys[key]] += n
+                        self._count_deletion(conn, keys[key])
+
+    def _count_deletion(self, conn: sqlite3.Connection,
+                        bucket: Optional[str]) -> None:
+        '''Count a deletion of entries of `bucket` (of any bucket if None)
+           using `conn` within the transaction deleting them.'''
+        conn.execute('INSERT INTO blanketdb_deletion VALUES (?, 1) ' +
+                     'ON CONFLICT (bucket) DO UPDATE SET n=n+1;',
+                     (bucket or '',))
+
+    def _delete_chunked(self, bucket: str, table: str, condition: str,
+                        params: Tuple[Any, ...],
+                        chunk_size: int, pause: float) -> int:
+        '''Delete entries of `bucket` matching `condition` from `table` in
+           transactions of at most `chunk_size` entries, sleeping `pause`
+           seconds in between.'''
+        sql = 'DELETE FROM ' + table + ' WHERE rowid IN ' + \
+              '(SELECT rowid FROM ' + table + ' WHERE ' + condition + \
+              ' ORDER BY rowid LIMIT ?);'
+        total = 0
+        while True:
+            with self._pool.transaction() as conn:
+                n = conn.execute(sql, params + (chunk_size,)).rowcount
+                if n:
+                    self._count_deletion(conn, bucket)
+            total += n
+            if n < chunk_size:
+                return total
+            time.sleep(pause)
+
+    def rollup(self, bucket: str,
+               interval: Union[str, int],
+               field: Optional[str] = None,
+               funcs: Optional[Iterable[str]] = None,
+               since: Optional[DateLike] = None,
+               before: Optional[DateLike] = None) -> List[Dict[str, Any]]:
+        '''Read the rollups of `bucket` for `interval` (which must have
+           been configured using `configure_rollup`), optionally restricted
+           to a single `field` and bins starting in [`since`, `before`).
+           Return one dict per field and bin holding field name, start of
+           the bin under "bin" and a value per function of `funcs`
+           (defaulting to the configured functions).
+           Raise `KeyError` if no matching rollup is configured.'''
+        bucket = bucket.lower()
+        seconds = _parse_interval(interval)
+        with self._pool.connection() as conn:
+            specs = [spec for spec in self._rollup_specs(conn, bucket)
+                     if spec[1] == seconds and
+                     (not field or spec[0] == field)]
+        if not specs:
+            raise KeyError('No rollup configured for bucket "{}", '
+                           'interval {}s and field {}'
+                           .format(bucket, seconds, field or '*'))
+        funcs = [func.lower() for func in (funcs or specs[0][2])]
+        for func in funcs:
+            if func not in _AGGREGATE_FUNCTIONS:
+                raise ValueError('Unknown aggregate function "{}"'
+                                 .format(func))
+        sql = 'SELECT field, bin, ' + \
+              ', '.join(_ROLLUP_FUNCTIONS[func] for func in funcs) + \
+              ' FROM blanketdb_rollup ' + \
+              'WHERE bucket=? AND interval=? AND field IN (' + \
+              ', '.join('?' for _ in specs) + ')'
+        params = [bucket, seconds]  # type: List[Any]
+        params += [spec[0] for spec in specs]
+        since = _parse_dt(since)
+        if since:
+            sql += ' AND bin * interval >= ' + \
+                   'CAST(strftime(\'%s\', ?) AS INTEGER)'
+            params.append(since)
+        before = _parse_dt(before)
+        if before:
+            sql += ' AND bin * interval < ' + \
+                   'CAST(strftime(\'%s\', ?) AS INTEGER)'
+            params.append(before)
+        with self._pool.connection() as conn:
+            c = conn.execute(sql + ' ORDER BY field, bin;', params)
+            return [dict(zip(funcs, values), field=field,
+                         bin=_EPOCH + timedelta(seconds=n * seconds))
+                    for field, n, *values in c]
 
     def store(self, data: Any, bucket: str = 'default') -> Dict[str, Any]:
         '''Serialize `data` to json and store it under `bucket`.'''
-        entry_id = None
         bucket = bucket.lower()
         timestamp = self.now()
-        with self.connection as conn:
-            c = conn.cursor()
-            c.execute('INSERT INTO blanketdb VALUES (?, ?, ?);',
-                      (bucket, timestamp, _serialize_json(data, indent=None)))
-            entry_id = c.lastrowid
+        row = (bucket, timestamp, _serialize_json(data, indent=None))
+        if self._compact:
+            self._bucket_id(bucket, create=True)
+        start = time.perf_counter()
+        # a thread already holding a connection commits on its own, the
+        # writer might otherwise wait for that connection's slot forever
+        if self._writer and not self._pool.held():
+            entry_id = self._writer.submit(row).result()
+        else:
+            with self._pool.transaction() as conn:
+                entry_id = self._insert(conn, row)
+        self._metrics.written(bucket, 1, time.perf_counter() - start)
+        self._invalidate(bucket)
+        self._notifier.notify(bucket, entry_id)
         return dict(id=entry_id, bucket=bucket,
                     timestamp=timestamp.isoformat(), data=data)
 
+    def store_many(self, items: Iterable[Any],
+                   bucket: str = 'default') -> Dict[str, Any]:
+        '''Serialize each of `items` to json and store all of them under
+           `bucket` in a single transaction. Return the range of IDs
+           assigned instead of the stored entries.'''
+        bucket = bucket.lower()
+        timestamp = self.now()
+        rows = [(bucket, timestamp, _serialize_json(item, indent=None))
+                for item in items]
+        first_id = last_id = None
+        if self._compact:
+            self._bucket_id(bucket, create=True)
+        start = time.perf_counter()
+        with self._pool.transaction() as conn:
+            table = self._partition_table(conn, timestamp) \
+                if self._partition and rows else self._table
+            compress = self._compressor(conn, bucket)
+            conn.executemany('INSERT INTO ' + table +
+                             ' (bucket, timestamp, data) VALUES (?, ?, ?);',
+                             [self._stored_row(row, compress)
+                              for row in rows])
+            if rows:
+                # rowids assigned within one transaction are consecutive
+                last_id = conn.execute('SELECT last_insert_rowid();') \
+                              .fetchone()[0]
+                first_id = last_id - len(rows) + 1
+            self._update_rollups(conn, rows)
+        self._metrics.written(bucket, len(rows), time.perf_counter() - start)
+        if last_id is not None:
+            self._invalidate(bucket)
+            self._notifier.notify(bucket, last_id)
+        return dict(bucket=bucket, timestamp=timestamp.isoformat(),
+                    first_id=first_id, last_id=last_id,
+                    number_of_entries=len(rows))
+
+    def _invalidate(self, bucket: Optional[str]) -> None:
+        '''Drop cached responses after a write to `bucket` (or to any
+           bucket if None).'''
+        if self._cache is not None:
+            self._cache.invalidate(bucket)
+
+    def cache_info(self) -> Dict[str, int]:
+        '''Return hits, misses, number of responses and size (in bytes)
+           of the response cache as well as its maximum size.'''
+        cache = self._cache
+        if cache is None:
+            return dict(hits=0, misses=0, responses=0, size=0, max_size=0)
+        return dict(hits=cache.hits, misses=cache.misses,
+                    responses=len(cache._entries), size=cache.size,
+                    max_size=cache.max_size)
+
+    def wait(self, bucket: Optional[str] = None,
+             since_id: int = 0,
+             timeout: Optional[float] = None) -> bool:
+        '''Wait until an entry with ID `since_id` or higher exists in
+           `bucket` (any bucket if None), at most `timeout` seconds.
+           Return whether such an entry exists. Waiting threads are woken
+           up by writes of this `BlanketDB` instance, they only query
+           the database repeatedly if `poll_interval` is set.'''
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        try:
+            while True:
+                if self._exists(bucket, since_id):
+                    return True
+                if self._notifier.wait(bucket.lower() if bucket else None,
+                                       since_id,
+                                       _poll_step(deadline,
+                                                  self.poll_interval)):
+                    return True
+                if self.poll_interval is None or \
+                        deadline is not None and \
+                        time.monotonic() >= deadline:
+                    return False
+        finally:
+            self._metrics.waited(time.monotonic() - start)
+
     def store_dict(self,
                    bucket: str = 'default',
                    **kwargs: Dict[str, Any]) -> Dict[str, Any]:
@@ -155,85 +2636,482 @@ class BlanketDB:
         '''Get a stored entry by its `entry_id`.
            Return None if no entry exists for that ID.
         '''
-        with self.connection as conn:
-            c = conn.execute('SELECT rowid, * FROM blanketdb WHERE rowid=?;',
-                             (entry_id,))
-            res = c.fetchone()
-            if res:
-                id, bucket, timestamp, data = res
-                return dict(id=id, bucket=bucket,
-                            timestamp=timestamp, data=json.loads(data))
-            else:
-                return None
+        row = self._row(entry_id)
+        return _row_entry(row) if row else None
+
+    def _row(self, entry_id: int) -> Optional[_EntryRow]:
+        '''Get the row of a stored entry by its `entry_id` (see `_rows`).'''
+        start = time.perf_counter()
+        row = None
+        with self._pool.connection() as conn:
+            for table in self._tables(entry_id, before_id=entry_id + 1):
+                row = conn.execute('SELECT ' + self._meta + ', data FROM ' +
+                                   table + ' WHERE rowid=?;',
+                                   (entry_id,)).fetchone()
+            if row:
+                row = self._inflated(conn, row)
+        self._metrics.read(1 if row else 0, time.perf_counter() - start)
+        return cast(Optional[_EntryRow], row)
+
+    def _select(self, bucket: Optional[str] = None,
+                since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                limit: int = -1, newest_first: bool = True,
+                where: Optional[str] = None,
+                fields: Optional[Fields] = None) -> List[_Statement]:
+        '''Build SELECT statements and parameters for `query`, one per
+           table to read (see `_tables`) in the order of the results.'''
+        data = self._data_sql(bucket) if where or fields else 'data'
+        clause, params = self._filter(bucket, since_id, since,
+                                      before_id, before, where, data)
+        if fields:
+            data = _projection_sql(fields, data) + ' AS data'
+        return [('SELECT ' + self._meta + ', ' + data +
+                 ' FROM ' + table + clause +
+                 ' ORDER BY rowid ' + ('DESC' if newest_first else 'ASC') +
+                 ' LIMIT ?', params + [limit])
+                for table in self._tables(since_id, since, before_id, before,
+                                          newest_first)]
+
+    def _rows(self, statements: List[_Statement]) -> Iterator[_EntryRow]:
+        '''Execute the `statements` of `_select` one after another and
+           lazily return the rows, i.e. ID, bucket, timestamp and the
+           JSON text of the data (decompressed only here, i.e. for the
+           rows actually returned). Their LIMIT (the last parameter)
+           applies to the rows of all statements.'''
+        with self._pool.connection() as conn:
+            seconds = 0.0
+            n = 0
+            try:
+                for sql, params in statements:
+                    limit = params[-1]
+                    if 0 <= limit <= n:
+                        break
+                    start = time.perf_counter()
+                    c = conn.execute(sql, params[:-1] +
+                                     [limit - n if limit >= 0 else limit])
+                    seconds += time.perf_counter() - start
+                    while True:
+                        start = time.perf_counter()
+                        rows = c.fetchmany(256)
+                        seconds += time.perf_counter() - start
+                        n += len(rows)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield self._inflated(conn, row)
+            finally:
+                self._metrics.read(n, seconds)
 
-    def query(self, bucket: str = None,
+    def query(self, bucket: Optional[str] = None,
               since_id: Optional[int] = None,
               since: Optional[DateLike] = None,
               before_id: Optional[int] = None,
               before: Optional[DateLike] = None,
-              limit: int = -1, newest_first: bool = True) \
-            -> Iterable[Dict[str, Any]]:
+              limit: int = -1, newest_first: bool = True,
+              raw: bool = False,
+              where: Optional[str] = None,
+              fields: Optional[Fields] = None) -> Iterable[Dict[str, Any]]:
         '''Query this `BlanketDB` instance using various optional filters.
            `since` and `since_id` are inclusive, `before` and `before` are
-           exclusive regarding the specified value.'''
-        is_bucket_requested = bool(bucket)
-        if is_bucket_requested:
-            bucket = bucket.lower() if bucket else ''
-        if since_id is None:
-            since_id = 0
-        since = _parse_dt(since)
-        before = _parse_dt(before)
-        with self.connection as conn:
-            c = conn.execute(BlanketDB._QUERY,
-                             (not is_bucket_requested, bucket,
-                              since_id, since,
-                              not before_id, before_id, not before, before,
-                              1 if newest_first else -1, limit))
-            for id, bucket, timestamp, data in c.fetchall():
-                yield dict(id=id, bucket=bucket,
-                           timestamp=timestamp, data=json.loads(data))
+           exclusive regarding the specified value. `where` filters on
+           fields of the data like `device == "x" and temp > 30` (see
+           `set_indexed_fields` to answer such filters using an index).
+           If `fields` (dotted field names) are given, only these fields
+           of the data are read from the database.
+           If `raw`, the data of the entries is returned as stored JSON
+           text without decoding.'''
+        for row in self._rows(self._select(bucket, since_id, since,
+                                           before_id, before, limit,
+                                           newest_first, where, fields)):
+            yield _row_entry(row, raw)
+
+    def _exists(self, bucket: Optional[str] = None,
+                since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                where: Optional[str] = None) -> bool:
+        '''Return whether any entry matches the filters.'''
+        clause, params = self._filter(bucket, since_id, since,
+                                      before_id, before, where)
+        start = time.perf_counter()
+        with self._pool.connection() as conn:
+            exists = any(conn.execute('SELECT 1 FROM ' + table + clause +
+                                      ' LIMIT 1;', params).fetchone()
+                         for table in self._tables(since_id, since,
+                                                   before_id, before))
+        self._metrics.read(0, time.perf_counter() - start)
+        return exists
+
+    def _page_rows(self, cursor: Dict[str, Any],
+                   fields: Optional[Fields] = None) -> Iterator[_EntryRow]:
+        '''Query the rows of the page described by `cursor` (see
+           `_paginate`).'''
+        newest_first = cursor['newest_first']
+        since_id, before_id = _edge_bounds(cursor['since_id'],
+                                           cursor['before_id'],
+                                           cursor['edge'], cursor['older'])
+        # pages towards the first entry are read starting at the edge,
+        # i.e. in reverse order, and sorted afterwards
+        reverse = cursor['edge'] is not None \
+            and cursor['older'] != newest_first
+        rows = self._rows(self._select(cursor['bucket'], since_id,
+                                       cursor['since'], before_id,
+                                       cursor['before'], cursor['limit'],
+                                       newest_first != reverse,
+                                       cursor['where'], fields))
+        if reverse:
+            return iter(sorted(rows, key=lambda row: row[0],
+                               reverse=newest_first))
+        return rows
+
+    def _paginate(self, cursor: Dict[str, Any],
+                  fields: Optional[Fields] = None) \
+            -> Tuple[Iterator[_EntryRow],
+                     Callable[[], Dict[str, Optional[str]]]]:
+        '''Query the page of entries described by `cursor`, i.e. the
+           filters of `query` and the entries older (or newer) than the
+           entry with ID "edge" (if not None). Return an iterator over
+           the rows (see `_rows`) and a function returning the "next" and
+           "prev" cursors (None if there are no further entries) after the
+           rows have been consumed. Only `fields` of the data are read if
+           given.'''
+        bucket = cursor['bucket']
+        since_id, since = cursor['since_id'], cursor['since']
+        before_id, before = cursor['before_id'], cursor['before']
+        newest_first = cursor['newest_first']
+        rows = self._page_rows(cursor, fields)
+        ids = []  # type: List[int]
+
+        def track() -> Iterator[_EntryRow]:
+            for row in rows:
+                ids[1:] = [row[0]]
+                yield row
+
+        def cursors() -> Dict[str, Optional[str]]:
+            result = dict(next=None, prev=None)  # type: Dict[str, Any]
+            if not ids:
+                return result
+            for name, edge, older in (('next', ids[-1], newest_first),
+                                      ('prev', ids[0], not newest_first)):
+                beyond_since_id, beyond_before_id = _edge_bounds(
+                    since_id, before_id, edge, older)
+                if self._exists(bucket, beyond_since_id, since,
+                                beyond_before_id, before, cursor['where']):
+                    result[name] = _encode_cursor(
+                        dict(cursor, edge=edge, older=older))
+            return result
+        return track(), cursors
+
+    def page(self, bucket: Optional[str] = None,
+             since_id: Optional[int] = None,
+             since: Optional[DateLike] = None,
+             before_id: Optional[int] = None,
+             before: Optional[DateLike] = None,
+             limit: int = 100, newest_first: bool = True,
+             cursor: Optional[str] = None,
+             where: Optional[str] = None,
+             fields: Optional[Fields] = None) -> Dict[str, Any]:
+        '''Query the first page of at most `limit` entries using the
+           filters of `query`, or the page described by `cursor`. Return
+           a dict holding the "entries" and the opaque "next" and "prev"
+           cursors to pass as `cursor` for the neighbouring pages (None
+           if there are no entries beyond this page). Every page is read
+           using an index range, i.e. deep pages cost the same as the
+           first one. Like `meta` in the HTTP API, `fields` is not part
+           of the cursor and can be given for every page.'''
+        if cursor is not None:
+            page_cursor = _decode_cursor(cursor)
+        else:
+            page_cursor = dict(bucket=bucket, since_id=since_id,
+                               since=_resolved_dt(since),
+                               before_id=before_id,
+                               before=_resolved_dt(before),
+                               where=where, limit=limit,
+                               newest_first=newest_first,
+                               edge=None, older=False)
+            if where:
+                _where_sql(where)  # raises ValueError if invalid
+        rows, cursors = self._paginate(page_cursor, fields)
+        result = dict(entries=[_row_entry(row)
+                               for row in rows])  # type: Dict[str, Any]
+        result.update(cursors())
+        return result
+
+    def aggregate(self, bucket: Optional[str] = None,
+                  field: str = 'value',
+                  interval: Union[str, int] = '1h',
+                  funcs: Iterable[str] = ('avg',),
+                  since: Optional[DateLike] = None,
+                  before: Optional[DateLike] = None) \
+            -> List[Dict[str, Any]]:
+        '''Aggregate the values of the (dotted) `field` of the entries'
+           data per time bin of length `interval` (e.g. "1h" or "15min")
+           using the aggregate functions `funcs` (any of avg, min, max,
+           sum and count), ignoring non-numeric values. Return one dict
+           per non-empty bin, holding the start of the bin under "bin" and
+           a value per function.'''
+        seconds = _parse_interval(interval)
+        funcs = [func.lower() for func in funcs]
+        for func in funcs:
+            if func not in _AGGREGATE_FUNCTIONS:
+                raise ValueError('Unknown aggregate function "{}"'
+                                 .format(func))
+        where, params = self._filter(bucket, None, since, None, before)
+        data = self._data_sql(bucket)
+        # bins of several partitions are merged like rollups
+        bins = dict()  # type: Dict[int, List[Any]]
+        with self._pool.connection() as conn:
+            for table in self._tables(since=since, before=before):
+                c = conn.execute(
+                    'SELECT ' + _SCHEMA_SECONDS[self._schema] + ' / ? ' +
+                    'AS bin, count(value), sum(value), min(value), ' +
+                    'max(value) FROM (SELECT timestamp, ' +
+                    'json_extract(' + data + ', ?) AS value FROM ' + table +
+                    where +
+                    ') WHERE typeof(value) IN (\'integer\', \'real\') ' +
+                    'GROUP BY bin;', [seconds, _json_path(field)] + params)
+                for n, *values in c:
+                    if n in bins:
+                        count, total, minimum, maximum = bins[n]
+                        values = [count + values[0], total + values[1],
+                                  min(minimum, values[2]),
+                                  max(maximum, values[3])]
+                    bins[n] = values
+        result = []
+        for n, (count, total, minimum, maximum) in sorted(bins.items()):
+            values = dict(avg=total / count, min=minimum, max=maximum,
+                          sum=total, count=count)
+            result.append(dict(((func, values[func]) for func in funcs),
+                               bin=_EPOCH + timedelta(seconds=n * seconds)))
+        return result
+
+    def explain(self, bucket: Optional[str] = None,
+                since_id: Optional[int] = None,
+                since: Optional[DateLike] = None,
+                before_id: Optional[int] = None,
+                before: Optional[DateLike] = None,
+                limit: int = -1, newest_first: bool = True,
+                where: Optional[str] = None) -> List[str]:
+        '''Return the SQLite query plan of `query` called with
+           the same arguments (one string per plan step).'''
+        with self._pool.connection() as conn:
+            return [row[-1] for sql, params in self._select(
+                        bucket, since_id, since, before_id, before, limit,
+                        newest_first, where)
+                    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql,
+                                            params).fetchall()]
 
     def __iter__(self) -> Iterable[Dict[str, Any]]:
         '''Iterate over all entries stored in this `BlanketDB` instance.'''
-        with self.connection as conn:
-            c = conn.execute('SELECT rowid, * FROM blanketdb;')
-            for id, bucket, timestamp, data in c.fetchall():
-                yield dict(id=id, bucket=bucket,
-                           timestamp=timestamp, data=json.loads(data))
+        with self._pool.connection() as conn:
+            for table in self._tables(newest_first=False):
+                c = conn.execute('SELECT ' + self._meta + ', data FROM ' +
+                                 table + ';')
+                for row in c:
+                    yield _row_entry(self._inflated(conn, row))
 
     def __delitem__(self, entry_id: int) -> None:
         '''Delete an entry by its `entry_id`.'''
-        with self.connection as conn:
-            conn.execute('DELETE FROM blanketdb WHERE rowid=?;', (entry_id,))
+        start = time.perf_counter()
+        row = None
+        with self._pool.transaction() as conn:
+            for table in self._tables(entry_id, before_id=entry_id + 1):
+                row = conn.execute('SELECT ' + self._meta + ' FROM ' +
+                                   table + ' WHERE rowid=?;',
+                                   (entry_id,)).fetchone()
+                conn.execute('DELETE FROM ' + table + ' WHERE rowid=?;',
+                             (entry_id,))
+                if row:
+                    self._count_deletion(conn, row[1])
+                    break
+        if row:
+            self._metrics.deleted(1, time.perf_counter() - start)
+            self._invalidate(row[1])
 
-    def delete(self, bucket: str = None,
+    def delete(self, bucket: Optional[str] = None,
                since_id: Optional[int] = None,
                since: Optional[DateLike] = None,
                before_id: Optional[int] = None,
-               before: Optional[DateLike] = None) \
+               before: Optional[DateLike] = None,
+               where: Optional[str] = None) \
             -> Any:
         '''Delete entries from this `BlanketDB` instance
            using various filters. `since` and `since_id` are inclusive,
            `before` and `before` are exclusive regarding the specified value.
+           `where` filters on fields of the data like in `query`.
         '''
-        is_bucket_requested = bool(bucket)
-        if is_bucket_requested:
-            bucket = bucket.lower() if bucket else ''
-        if since_id is None:
-            since_id = 0
-        since = _parse_dt(since)
-        before = _parse_dt(before)
-        with self.connection as conn:
-            conn.execute(BlanketDB._DELETE, (not is_bucket_requested, bucket,
-                         since_id, since,
-                         not before_id, before_id, not before, before))
-            return conn.execute('select changes();').fetchone()[0]
+        clause, params = self._filter(bucket, since_id, since,
+                                      before_id, before, where)
+        start = time.perf_counter()
+        n = 0
+        with self._pool.transaction() as conn:
+            for table in self._tables(since_id, since, before_id, before):
+                conn.execute('DELETE FROM ' + table + clause + ';', params)
+                n += conn.execute('select changes();').fetchone()[0]
+            if n:
+                self._count_deletion(conn, bucket.lower() if bucket
+                                     else None)
+        if n:
+            self._metrics.deleted(n, time.perf_counter() - start)
+            self._invalidate(bucket.lower() if bucket else None)
+        return n
+
+    def _stream_since_id(self, bucket: Optional[str],
+                         env: Dict[str, Any],
+                         qs: Dict[str, Any]) -> int:
+        '''Determine the first ID to stream for a request to `_stream`:
+           the ID after the Last-Event-ID header if given, otherwise the
+           `since_id` query parameter, otherwise the ID of the next entry
+           to be stored.'''
+        if 'HTTP_LAST_EVENT_ID' in env:
+            try:
+                return int(env['HTTP_LAST_EVENT_ID']) + 1
+            except ValueError:
+                pass
+        if 'since_id' in qs:
+            return int(qs['since_id'])
+        return 1 + max((entry['id'] for entry in self.query(bucket, limit=1)),
+                       default=0)
+
+    def _stream_events(self, bucket: Optional[str], since_id: int,
+                       show_meta: bool, limit: int,
+                       heartbeat: float) -> Iterable[bytes]:
+        '''Yield entries of `bucket` with IDs from `since_id` on as
+           server-sent events as soon as they are stored, sending a comment
+           as heartbeat after `heartbeat` seconds without entries.
+           Stop after `limit` events unless `limit` is negative.'''
+        while True:
+            for row in self._rows(self._select(bucket, since_id,
+                                               limit=limit,
+                                               newest_first=False)):
+                yield _sse_event(row, show_meta)
+                since_id = row[0] + 1
+                if limit > 0:
+                    limit -= 1
+                    if limit == 0:
+                        return
+            if not self.wait(bucket, since_id, heartbeat):
+                yield _SSE_HEARTBEAT
 
     def __call__(self,
                  env: Dict[str, Any],
                  start_response: 'StartResponse') \
             -> Iterable[bytes]:
         '''WSGI conform callable method.'''
+        def respond(env: Dict[str, Any],
+                    start_response: 'StartResponse') -> Iterable[bytes]:
+            return _encode_response(self._respond, env, start_response)
+        if self.profiling_dir is not None and self.profiling_token:
+            directory, token = self.profiling_dir, self.profiling_token
+            return self._metrics.instrument(
+                lambda env, start_response: _profiled(
+                    respond, env, start_response, directory, token),
+                env, start_response)
+        return self._metrics.instrument(respond, env, start_response)
+
+    def metrics(self) -> str:
+        '''Render request, row and SQLite metrics as well as sizes of the
+           database file, WAL, response cache and connection pool in the
+           Prometheus text format. Metrics are collected per process.'''
+        extra = []  # type: List[Tuple[str, str, str, List[Any]]]
+        if self._file is not None:
+            sizes = []  # type: List[Tuple[_Labels, Any]]
+            for file, suffix in (('database', ''), ('wal', '-wal')):
+                try:
+                    sizes.append(((('file', file),),
+                                  os.path.getsize(self._file + suffix)))
+                except OSError:
+                    sizes.append(((('file', file),), 0))
+            extra.append(('blanketdb_file_size_bytes', 'gauge',
+                          'Size of the database file and WAL', sizes))
+        cache = self.cache_info()
+        extra.append(('blanketdb_cache_requests_total', 'counter',
+                      'Response cache lookups by result',
+                      [((('result', 'hit'),), cache['hits']),
+                       ((('result', 'miss'),), cache['misses'])]))
+        extra.append(('blanketdb_cache_size_bytes', 'gauge',
+                      'Size of cached responses', [((), cache['size'])]))
+        extra.append(('blanketdb_cache_responses', 'gauge',
+                      'Number of cached responses',
+                      [((), cache['responses'])]))
+        with self._pool._lock:
+            idle, in_use = len(self._pool._idle), len(self._pool._held)
+        extra.append(('blanketdb_pool_connections', 'gauge',
+                      'Connections of the pool by state (of at most {})'
+                      .format(self._pool.size),
+                      [((('state', 'idle'),), idle),
+                       ((('state', 'in_use'),), in_use)]))
+        return self._metrics.render(extra)
+
+    def _query_chunks(self, head: Dict[str, Any], cursor: Dict[str, Any],
+                      fmt: str, show_meta: bool,
+                      fields: Optional[Fields] = None) -> Iterable[bytes]:
+        '''Serialize the page of entries described by `cursor` in format
+           `fmt`, starting JSON responses with the fields of `head`.'''
+        tail = dict(number_of_entries=0,
+                    last_id=None)  # type: Dict[str, Any]
+        rows, cursors = self._paginate(cursor, fields)
+        if fmt == 'ndjson':
+            return _buffered(_ndjson_lines(rows, show_meta))
+        if fmt == 'csv':
+            return _buffered(_csv_lines(rows, show_meta))
+        if fmt == 'columnar':
+            return _columnar_chunks(rows, show_meta)
+
+        def tracked() -> Iterable[_EntryRow]:
+            for row in rows:
+                tail['number_of_entries'] += 1
+                if tail['last_id'] is None or row[0] > tail['last_id']:
+                    tail['last_id'] = row[0]
+                yield row
+        if fmt == 'compact':
+            return _buffered(_compact_envelope(
+                head, (_raw_entry(row, show_meta) for row in tracked()),
+                lambda: dict(tail, **cursors())))
+        return _stream_envelope(
+            head, (_raw_entry(row, show_meta, indent=2)
+                   for row in tracked()),
+            lambda: dict(tail, **cursors()))
+
+    def _etag(self, env: Dict[str, Any], cursor: Dict[str, Any],
+              fmt: str) -> str:
+        '''Compute the ETag of a query response without reading its
+           entries: the highest ID of the bucket (a single index seek)
+           changes with every entry stored and the number of deletions
+           (see `_count_deletion`) with every entry deleted, the request
+           and its resolved time bounds determine the selection and
+           representation of the entries. The tag is weak, as it does not
+           change with the content coding (see `_encode_response`).'''
+        bucket = cursor['bucket'].lower() if cursor['bucket'] else None
+        clause = ' WHERE bucket=?' if bucket else ''
+        params = [self._bucket_key(bucket)] if bucket else []
+        start = time.perf_counter()
+        last_id = None
+        with self._pool.connection() as conn:
+            for table in self._tables():
+                last_id = conn.execute('SELECT max(rowid) FROM ' + table +
+                                       clause + ';', params).fetchone()[0]
+                if last_id is not None:
+                    break
+            deletions = conn.execute(
+                'SELECT total(n) FROM blanketdb_deletion' +
+                (' WHERE bucket IN (?, \'\');' if bucket else ';'),
+                [bucket] if bucket else []).fetchone()[0]
+        self._metrics.read(0, time.perf_counter() - start)
+        key = _serialize_json([last_id, deletions, cursor['since'],
+                               cursor['before'], env.get('PATH_INFO'),
+                               env.get('QUERY_STRING'), fmt], indent=None)
+        return 'W/"' + hashlib.sha1(key.encode('utf8')).hexdigest() + '"'
+
+    def _respond(self,
+                 env: Dict[str, Any],
+                 start_response: 'StartResponse') \
+            -> Iterable[bytes]:
+        '''Respond to a request, see `__call__`.'''
         def start_json_response(status: int,
                                 headers: List[Any] = [('Content-Type',
                                                        'application/json')]) \
@@ -259,8 +3137,21 @@ class BlanketDB:
             before = qs.get('before', None)
             assert before is None or isinstance(before, (str, datetime, date))
             before = _parse_dt(before)
+            if self._compact or self._partition:
+                for value in (since, before):
+                    if value:
+                        _epoch_us(value)  # raises ValueError if invalid
             limit = int(str(qs.get('limit', -1)))
             newest_first = bool(qs.get('newest_first', True))
+            wait = float(qs.get('wait', 0))
+            where = str(qs['where']) if 'where' in qs else None
+            if where:
+                _where_sql(where)  # raises ValueError if invalid
+            fields = str(qs['fields']) if 'fields' in qs else None
+            if fields:
+                _projection_sql(fields)  # raises ValueError if invalid
+            cursor = _decode_cursor(str(qs['cursor'])) \
+                if 'cursor' in qs else None
         except Exception as e:
             start_json_response(400)
             yield _j(message='An error occured while' +
@@ -268,6 +3159,7 @@ class BlanketDB:
                      parameters=qs)
             return
 
+        bucket = None  # type: Optional[str]
         if method == 'GET':
             if path.startswith('/_entry/'):
                 try:
@@ -278,33 +3170,166 @@ class BlanketDB:
                                      ' a valid integer ID',
                              path=path)
                     return
-                entry = self[entry_id]
-                if entry:
+                row = self._row(entry_id)
+                if row:
                     start_json_response(200)
-                    yield _j(entry if show_meta else entry['data'])
+                    yield _raw_entry(row, show_meta, indent=2).encode('utf8')
                 else:
                     start_json_response(404)
                     yield _j(message='Entry does not exist', id=entry_id)
-            else:
+            elif path == '/_metrics':
+                start_response(_HTTP_STATUS_CODES[200],
+                               [('Content-Type', _METRICS_CONTENT_TYPE)])
+                yield self.metrics().encode('utf8')
+            elif path == '/_aggregate' or path.endswith('/_aggregate'):
+                bucket = path[1:-len('/_aggregate')] or None
+                field = str(qs.get('field', 'value'))
+                interval = qs.get('interval', '1h')
+                funcs = str(qs.get('fn', 'avg')).split(',')
+                try:
+                    bins = self.aggregate(bucket, field, interval, funcs,
+                                          since, before)
+                except ValueError as e:
+                    start_json_response(400)
+                    yield _j(message=str(e), parameters=qs)
+                    return
                 start_json_response(200)
-                bucket = path[1:]  # type: Optional[str]
-                if not bucket:
-                    bucket = None  # make it a little more explicit
-                entries = list(self.query(bucket, since_id, since,
-                               before_id, before, limit, newest_first))
-                last_id = max((entry['id'] for entry in entries), default=None)
-                entries = [entry if show_meta else entry['data']
-                           for entry in entries]
                 yield _j(bucket_requested=bucket,
-                         since_id=since_id,
+                         field=field,
+                         interval=_parse_interval(interval),
+                         functions=funcs,
                          since=since if since else None,
-                         before_id=before_id,
                          before=before if before else None,
-                         number_of_entries=len(entries),
-                         last_id=last_id,
-                         limit=limit if limit > -1 else None,
-                         newest_first=newest_first,
-                         entries=entries)
+                         number_of_bins=len(bins),
+                         bins=bins)
+            elif '/_rollup/' in path:
+                bucket, _, interval = path[1:].rpartition('/_rollup/')
+                bucket = bucket or 'default'
+                field_requested = str(qs['field']) if 'field' in qs \
+                    else None
+                funcs_requested = str(qs['fn']).split(',') if 'fn' in qs \
+                    else None
+                try:
+                    bins = self.rollup(bucket, interval, field_requested,
+                                       funcs_requested, since, before)
+                except KeyError as e:
+                    start_json_response(404)
+                    yield _j(message=e.args[0], path=path)
+                    return
+                except ValueError as e:
+                    start_json_response(400)
+                    yield _j(message=str(e), parameters=qs)
+                    return
+                start_json_response(200)
+                yield _j(bucket_requested=bucket,
+                         field=field_requested,
+                         interval=_parse_interval(interval),
+                         since=since if since else None,
+                         before=before if before else None,
+                         number_of_bins=len(bins),
+                         bins=bins)
+            elif path == '/_compression' or path.endswith('/_compression'):
+                bucket = path[1:-len('/_compression')] or 'default'
+                try:
+                    info = self.compression_info(
+                        bucket, int(str(qs.get('samples', 1000))))
+                except ValueError as e:
+                    start_json_response(400)
+                    yield _j(message=str(e), parameters=qs)
+                    return
+                start_json_response(200)
+                yield _j(info)
+            elif path == '/_stream' or path.endswith('/_stream'):
+                bucket = path[1:-len('/_stream')] or None
+                since_id = self._stream_since_id(bucket, env, qs)
+                start_response(_HTTP_STATUS_CODES[200], _SSE_HEADERS)
+                yield from self._stream_events(bucket, since_id, show_meta,
+                                               limit, wait or 15)
+            else:
+                bucket = path[1:]
+                if not bucket:
+                    bucket = None  # make it a little more explicit
+                if cursor is None:
+                    cursor = dict(bucket=bucket, since_id=since_id,
+                                  since=_resolved_dt(since),
+                                  before_id=before_id,
+                                  before=_resolved_dt(before),
+                                  where=where, limit=limit,
+                                  newest_first=newest_first,
+                                  edge=None, older=False)
+                elif cursor['bucket'] != bucket:
+                    start_json_response(400)
+                    yield _j(message='The cursor belongs to another bucket',
+                             bucket_requested=bucket,
+                             cursor_bucket=cursor['bucket'])
+                    return
+                elif 'limit' in qs:
+                    cursor['limit'] = limit
+                try:
+                    fmt = _negotiate_format(qs, env)
+                except ValueError as e:
+                    start_json_response(400)
+                    yield _j(message=str(e), parameters=qs)
+                    return
+                if wait:
+                    self.wait(bucket, since_id or 0, wait)
+                if_none_match = str(env.get('HTTP_IF_NONE_MATCH', ''))
+                cache_key = (path, fmt, tuple(sorted(
+                    (key, str(value)) for key, value in qs.items()
+                    if key != 'wait')))
+                cached = self._cache.get(cache_key) if self._cache else None
+                if cached is not None:
+                    etag, body = cached
+                    if _etag_matches(etag, if_none_match):
+                        start_response(_HTTP_STATUS_CODES[304],
+                                       [('ETag', etag)])
+                        return
+                    start_json_response(200, [('Content-Type',
+                                               _EXPORT_FORMATS[fmt]),
+                                              ('ETag', etag)])
+                    yield body
+                    return
+                token = self._cache.token(bucket) if self._cache else None
+                etag = self._etag(env, cursor, fmt)
+                if _etag_matches(etag, if_none_match):
+                    start_response(_HTTP_STATUS_CODES[304], [('ETag', etag)])
+                    return
+                start_json_response(200, [('Content-Type',
+                                           _EXPORT_FORMATS[fmt]),
+                                          ('ETag', etag)])
+                head = dict(bucket_requested=bucket,
+                            since_id=cursor['since_id'],
+                            since=cursor['since'] if 'cursor' in qs
+                            else since or None,
+                            before_id=cursor['before_id'],
+                            before=cursor['before'] if 'cursor' in qs
+                            else before or None,
+                            where=cursor['where'],
+                            fields=[field.strip() for field
+                                    in fields.split(',')] if fields
+                            else None,
+                            limit=cursor['limit']
+                            if cursor['limit'] > -1 else None,
+                            newest_first=cursor['newest_first'])
+                chunks = self._query_chunks(head, cursor, fmt, show_meta,
+                                            fields)
+                if self._cache is None or token is None:
+                    yield from chunks
+                    return
+                body_chunks = []  # type: List[bytes]
+                size = 0
+                for chunk in chunks:
+                    if size <= self._cache.max_size:
+                        body_chunks.append(chunk)
+                        size += len(chunk)
+                    yield chunk
+                # relative times move with the clock, such responses are
+                # only reused within the freshness window
+                relative = any(not isinstance(_parse_dt(qs[key]), str)
+                               for key in ('since', 'before') if key in qs)
+                self._cache.put(cache_key, bucket, token,
+                                self.cache_freshness if relative else None,
+                                etag, b''.join(body_chunks))
 
         elif method == 'POST':
             if path == '/_entry' or path.startswith('/_entry/'):
@@ -313,13 +3338,37 @@ class BlanketDB:
                                  ' for this path',
                          path=path, method=method)
                 return
-            try:
-                request_body_size = int(env.get('CONTENT_LENGTH', 0))
-            except ValueError:
-                request_body_size = 0
-            request_body = env['wsgi.input'].read(request_body_size)
-            bucket = 'default' if path == '/' else path[1:]
+            request_body = _read_body(env)
             content_type = env.get('CONTENT_TYPE', 'application/json').lower()
+            if path == '/_batch' or path.endswith('/_batch'):
+                path = path[:-len('/_batch')] or '/'
+                bucket = 'default' if path == '/' else path[1:]
+                try:
+                    if content_type.startswith('application/json'):
+                        items = json.loads(request_body.decode('utf8'))
+                        if not isinstance(items, list):
+                            raise ValueError('Expected a JSON array')
+                    elif content_type.startswith('application/x-ndjson'):
+                        items = [json.loads(line) for line
+                                 in request_body.decode('utf8').splitlines()
+                                 if line.strip()]
+                    else:
+                        start_json_response(415)
+                        yield _j(message='Supported media types for batches' +
+                                         ' are application/json' +
+                                         ' and application/x-ndjson',
+                                 media_type=content_type)
+                        return
+                except ValueError as e:
+                    start_json_response(400)
+                    yield _j(message='An error occured while' +
+                                     ' parsing the request body: ' + str(e))
+                    return
+                stored = self.store_many(items, bucket=bucket)
+                start_json_response(201)
+                yield _j(stored)
+                return
+            bucket = 'default' if path == '/' else path[1:]
             if content_type.startswith('application/json'):
                 if request_body == b'':
                     data = None
@@ -348,11 +3397,11 @@ class BlanketDB:
                                      ' a valid integer ID',
                              path=path)
                     return
-                entry = self[entry_id]
-                if entry:
+                row = self._row(entry_id)
+                if row:
                     start_json_response(200)
                     del self[entry_id]
-                    yield _j(entry)
+                    yield _raw_entry(row, True, indent=2).encode('utf8')
                 else:
                     start_json_response(404)
                     yield _j(message='Entry does not exist', id=entry_id)
@@ -360,38 +3409,784 @@ class BlanketDB:
                 bucket = path[1:]
                 if not bucket:
                     bucket = None  # make it a little more explicit
-                n = self.delete(bucket, since_id, since, before_id, before)
+                n = self.delete(bucket, since_id, since, before_id, before,
+                                where)
                 start_json_response(200)
                 yield _j(bucket_requested=bucket,
                          since_id=since_id,
                          since=since if since else None,
                          before_id=before_id,
                          before=before if before else None,
+                         where=where,
                          number_of_entries_deleted=n)
 
+        elif method == 'PUT' and (path == '/_rollup'
+                                  or path.endswith('/_rollup')):
+            bucket = path[1:-len('/_rollup')] or 'default'
+            try:
+                spec = json.loads(_read_body(env).decode('utf8') or '{}')
+                assert isinstance(spec, dict), 'Expected a JSON object'
+                fields = spec.get('fields', [])
+                intervals = spec.get('intervals', ['1min', '1h', '1d'])
+                funcs = spec.get('funcs', ['avg', 'min', 'max'])
+                for name, value, types in (('fields', fields, (str,)),
+                                           ('intervals', intervals,
+                                            (str, int)),
+                                           ('funcs', funcs, (str,))):
+                    assert isinstance(value, list) and all(
+                        isinstance(item, types)
+                        and not isinstance(item, bool) for item in value), \
+                        'Expected a list of ' + name
+                self.configure_rollup(bucket, fields, intervals, funcs)
+            except (ValueError, AssertionError, AttributeError) as e:
+                start_json_response(400)
+                yield _j(message='Invalid rollup specification: ' + str(e))
+                return
+            start_json_response(200)
+            yield _j(bucket=bucket, fields=fields,
+                     intervals=[_parse_interval(i) for i in intervals],
+                     funcs=funcs)
+
+        elif method == 'PUT' and (path == '/_retention'
+                                  or path.endswith('/_retention')):
+            bucket = path[1:-len('/_retention')] or 'default'
+            try:
+                policy = json.loads(_read_body(env).decode('utf8') or '{}')
+                assert isinstance(policy, dict), 'Expected a JSON object'
+                self.set_retention(bucket, policy.get('max_age'),
+                                   policy.get('max_rows'))
+            except (ValueError, AssertionError, TypeError) as e:
+                start_json_response(400)
+                yield _j(message='Invalid retention policy: ' + str(e))
+                return
+            policy = self.retention_policies().get(
+                bucket, dict(max_age=None, max_rows=None))
+            start_json_response(200)
+            yield _j(bucket=bucket, **policy)
+
+        elif method == 'PUT' and (path == '/_indexes'
+                                  or path.endswith('/_indexes')):
+            bucket = path[1:-len('/_indexes')] or 'default'
+            try:
+                spec = json.loads(_read_body(env).decode('utf8') or '{}')
+                assert isinstance(spec, dict), 'Expected a JSON object'
+                fields = spec.get('fields', [])
+                assert isinstance(fields, list) and \
+                    all(isinstance(field, str) for field in fields), \
+                    'Expected a list of fields'
+                self.set_indexed_fields(bucket, fields)
+            except (ValueError, AssertionError) as e:
+                start_json_response(400)
+                yield _j(message='Invalid index specification: ' + str(e))
+                return
+            start_json_response(200)
+            yield _j(bucket=bucket,
+                     fields=self.indexed_fields().get(bucket, []))
+
+        elif method == 'PUT' and (path == '/_compression'
+                                  or path.endswith('/_compression')):
+            bucket = path[1:-len('/_compression')] or 'default'
+            try:
+                spec = json.loads(_read_body(env).decode('utf8') or '{}')
+                assert isinstance(spec, dict), 'Expected a JSON object'
+                samples = spec.get('samples', 1000)
+                self.set_compression(bucket, spec.get('level', 6), samples)
+            except (ValueError, AssertionError) as e:
+                start_json_response(400)
+                yield _j(message='Invalid compression specification: ' +
+                                 str(e))
+                return
+            start_json_response(200)
+            yield _j(self.compression_info(bucket, samples))
+
         else:
             start_json_response(405)
             yield _j(message='The HTTP method is not allowed for this path',
                      path=path, method=method)
 
 
+class BlanketDBASGI:
+    '''ASGI application serving the same routes as the WSGI callable of
+       `db`. SQLite work runs on an executor with at most `max_workers`
+       threads, while long polling and server-sent events wait for new
+       entries without occupying a thread. If `max_pending` is given,
+       requests are rejected with 503 Service Unavailable while that many
+       requests are waiting for or running on the executor.'''
+
+    def __init__(self, db: BlanketDB, max_workers: int = 8,
+                 max_pending: Optional[int] = None) -> None:
+        self.db = db
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._waiters = []  # type: List[Tuple[Optional[str], int, Any]]
+        db._notifier.listeners.append(self._on_store)
+
+    def _on_store(self, bucket: str, last_id: int) -> None:
+        '''Notifier listener, called by the thread having stored.'''
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._wake, bucket, last_id)
+            except RuntimeError:  # loop closed in the meantime
+                pass
+
+    def _wake(self, bucket: str, last_id: int) -> None:
+        for waiter in self._waiters:
+            waiter_bucket, since_id, event = waiter
+            if waiter_bucket in (None, bucket) and since_id <= last_id:
+                event.set()
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        '''Run `func` on the executor.'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def wait(self, bucket: Optional[str] = None,
+                   since_id: int = 0,
+                   timeout: Optional[float] = None) -> bool:
+        '''Asynchronous version of `BlanketDB.wait`.'''
+        bucket = bucket.lower() if bucket else None
+        waiter = (bucket, max(since_id, 1), asyncio.Event())
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._waiters.append(waiter)
+        try:
+            while True:
+                if await self._run(self.db.wait, bucket, since_id, 0):
+                    return True
+                try:
+                    await asyncio.wait_for(
+                        waiter[2].wait(),
+                        _poll_step(deadline, self.db.poll_interval))
+                    return True
+                except asyncio.TimeoutError:
+                    if self.db.poll_interval is None or \
+                            deadline is not None and \
+                            time.monotonic() >= deadline:
+                        return False
+        finally:
+            self._waiters.remove(waiter)
+
+    async def __call__(self,
+                       scope: Dict[str, Any],
+                       receive: Callable[[], Awaitable[Dict[str, Any]]],
+                       send: Callable[[Dict[str, Any]], Awaitable[None]]) \
+            -> None:
+        '''ASGI conform callable method.'''
+        self._loop = asyncio.get_event_loop()
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    if self._on_store in self.db._notifier.listeners:
+                        self.db._notifier.listeners.remove(self._on_store)
+                    self._executor.shutdown()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        body = []  # type: List[bytes]
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        env = _asgi_environ(scope, b''.join(body))
+        path = env['PATH_INFO'].lower()
+        qs = _parse_form(env['QUERY_STRING'])
+        try:
+            wait = float(qs.get('wait', 0))
+            since_id = int(qs.get('since_id', 0))
+            limit = int(qs.get('limit', -1))
+        except (TypeError, ValueError):
+            # let the WSGI callable respond with an error
+            await self._call_wsgi(env, send)
+            return
+        if env['REQUEST_METHOD'] == 'GET' \
+                and (path == '/_stream' or path.endswith('/_stream')):
+            bucket = path[1:-len('/_stream')] or None
+            since_id = await self._run(self.db._stream_since_id,
+                                       bucket, env, qs)
+            await self._stream_events(send, bucket, since_id,
+                                      bool(qs.get('meta', True)),
+                                      limit, wait or 15)
+            return
+        if env['REQUEST_METHOD'] == 'GET' and wait > 0 \
+                and not path.startswith('/_entry/') \
+                and not path.endswith('/_aggregate') \
+                and not path.endswith('/_compression') \
+                and '/_rollup/' not in path:
+            await self.wait(path[1:] or None, since_id, wait)
+            env['QUERY_STRING'] = urllib.parse.urlencode(
+                [(k, v) for k, v in urllib.parse.parse_qsl(
+                    env['QUERY_STRING']) if k != 'wait'])
+        await self._call_wsgi(env, send)
+
+    async def _stream_events(self,
+                             send: Callable[[Dict[str, Any]],
+                                            Awaitable[None]],
+                             bucket: Optional[str], since_id: int,
+                             show_meta: bool, limit: int,
+                             heartbeat: float) -> None:
+        '''Asynchronous version of `BlanketDB._stream_events`.'''
+        def read_events(since_id: int, limit: int) -> List[Tuple[int, bytes]]:
+            return [(row[0], _sse_event(row, show_meta))
+                    for row in self.db._rows(self.db._select(
+                        bucket, since_id, limit=limit,
+                        newest_first=False))]
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': _asgi_headers(_SSE_HEADERS)})
+        while True:
+            batch = 1000 if limit < 0 else min(limit, 1000)
+            events = await self._run(read_events, since_id, batch)
+            for entry_id, event in events:
+                await send({'type': 'http.response.body', 'body': event,
+                            'more_body': True})
+                since_id = entry_id + 1
+                if limit > 0:
+                    limit -= 1
+                    if limit == 0:
+                        await send({'type': 'http.response.body'})
+                        return
+            if len(events) < batch \
+                    and not await self.wait(bucket, since_id, heartbeat):
+                await send({'type': 'http.response.body',
+                            'body': _SSE_HEARTBEAT, 'more_body': True})
+
+    async def _call_wsgi(self, env: Dict[str, Any],
+                         send: Callable[[Dict[str, Any]], Awaitable[None]]) \
+            -> None:
+        '''Run the WSGI callable of `db` for `env` on the executor, passing
+           chunks of the response to `send` as they are produced.'''
+        if self.max_pending is not None and \
+                self._pending >= self.max_pending:
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': _asgi_headers(_UNAVAILABLE_HEADERS)})
+            await send({'type': 'http.response.body',
+                        'body': _j(message=_UNAVAILABLE_MESSAGE)})
+            return
+        self._pending += 1
+        try:
+            await self._produce_wsgi(env, send)
+        finally:
+            self._pending -= 1
+
+    async def _produce_wsgi(self, env: Dict[str, Any],
+                            send: Callable[[Dict[str, Any]],
+                                           Awaitable[None]]) -> None:
+        loop = asyncio.get_event_loop()
+        chunks = asyncio.Queue(8)  # type: asyncio.Queue[Any]
+        aborted = threading.Event()
+        response = []  # type: List[Any]
+
+        def start_response(status: str, headers: List[Tuple[str, str]],
+                           exc_info: Any = None) -> Callable[[bytes], None]:
+            response[:] = [int(status.split()[0]), headers]
+            return lambda data: None
+
+        def produce() -> None:
+            app_iter = self.db(env, start_response)
+            try:
+                for chunk in app_iter:
+                    asyncio.run_coroutine_threadsafe(
+                        chunks.put(chunk), loop).result()
+                    if aborted.is_set():
+                        break
+            except BaseException as e:
+                asyncio.run_coroutine_threadsafe(chunks.put(e), loop).result()
+            finally:
+                getattr(app_iter, 'close', lambda: None)()
+            asyncio.run_coroutine_threadsafe(chunks.put(None), loop).result()
+
+        producer = loop.run_in_executor(self._executor, produce)
+        started = False
+        try:
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, BaseException):
+                    if started:
+                        raise chunk
+                    logging.getLogger(__name__).error(
+                        'Error handling request', exc_info=chunk)
+                    response[:] = [500, [('Content-Type',
+                                          'application/json')]]
+                    chunk = _j(message='Internal server error')
+                if not started:
+                    started = True
+                    await send({'type': 'http.response.start',
+                                'status': response[0],
+                                'headers': _asgi_headers(response[1])})
+                if chunk is None:
+                    await send({'type': 'http.response.body'})
+                    break
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+        finally:
+            aborted.set()
+            while not producer.done():  # unblock the producer
+                while not chunks.empty():
+                    chunks.get_nowait()
+                await asyncio.sleep(0.001)
+
+
+def _asgi_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    '''Build a WSGI environment from an ASGI http `scope`.'''
+    env = {'REQUEST_METHOD': scope['method'],
+           'SCRIPT_NAME': scope.get('root_path', ''),
+           'PATH_INFO': scope['path'],
+           'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+           'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+           'CONTENT_LENGTH': str(len(body)),
+           'wsgi.input': io.BytesIO(body),
+           'wsgi.url_scheme': scope.get('scheme', 'http')}
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        if name == 'CONTENT_TYPE':
+            env[name] = value.decode('latin1')
+        elif name != 'CONTENT_LENGTH':
+            env['HTTP_' + name] = value.decode('latin1')
+    return env
+
+
+def _asgi_headers(headers: List[Tuple[str, str]]) -> List[List[bytes]]:
+    '''Convert WSGI response `headers` to ASGI headers.'''
+    return [[name.lower().encode('latin1'), value.encode('latin1')]
+            for name, value in headers]
+
+
+class _Connections:
+    '''Connections of an asyncio HTTP server, tracked to shut it down
+       gracefully.'''
+
+    def __init__(self) -> None:
+        self.tasks = set()  # type: Set[asyncio.Task[None]]
+        self.idle = set()  # type: Set[asyncio.StreamWriter]
+        self.closing = False
+
+    def close_idle(self) -> None:
+        '''Close connections waiting for a request, and all connections
+           as soon as their current request is complete.'''
+        self.closing = True
+        for writer in list(self.idle):
+            writer.close()
+
+
+async def _serve_http_connection(app: BlanketDBASGI,
+                                 reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter,
+                                 connections: Optional[_Connections] = None) \
+        -> None:
+    '''Serve HTTP/1.1 requests (with keep-alive) of one connection.'''
+    connections = connections or _Connections()
+    try:
+        while not connections.closing:
+            connections.idle.add(writer)
+            try:
+                request_line = await reader.readline()
+            finally:
+                connections.idle.discard(writer)
+            if not request_line.strip():
+                break
+            method, target, version = \
+                request_line.decode('latin1').split()
+            headers = []  # type: List[Tuple[bytes, bytes]]
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.partition(b':')
+                headers.append((name.strip().lower(), value.strip()))
+            header = dict(headers)
+            if header.get(b'expect', b'').lower() == b'100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            if header.get(b'transfer-encoding', b'').lower() == b'chunked':
+                body = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if not size:
+                        await reader.readline()  # trailers not supported
+                        break
+                    body += (await reader.readexactly(size + 2))[:-2]
+            else:
+                body = await reader.readexactly(
+                    int(header.get(b'content-length', 0)))
+            # HTTP/1.0 clients get the response body until the connection
+            # is closed instead of chunked transfer encoding
+            keep_alive = version == 'HTTP/1.1' \
+                and header.get(b'connection', b'').lower() != b'close'
+            chunked = version == 'HTTP/1.1'
+            path, _, query = target.partition('?')
+            scope = {'type': 'http',
+                     'asgi': {'version': '3.0'},
+                     'http_version': version[5:],
+                     'method': method.upper(),
+                     'scheme': 'http',
+                     'path': urllib.parse.unquote(path),
+                     'raw_path': path.encode('latin1'),
+                     'query_string': query.encode('latin1'),
+                     'root_path': '',
+                     'headers': headers,
+                     'client': writer.get_extra_info('peername'),
+                     'server': writer.get_extra_info('sockname')}
+            received = [False]
+            # whether the response has a body (using chunked encoding)
+            has_body, framed = [True], [chunked]
+
+            async def receive() -> Dict[str, Any]:
+                if received[0]:
+                    await asyncio.Future()  # wait until cancelled
+                received[0] = True
+                return {'type': 'http.request', 'body': body}
+
+            async def send(message: Dict[str, Any]) -> None:
+                if message['type'] == 'http.response.start':
+                    status = HTTPStatus(message['status'])
+                    # 1xx, 204 and 304 responses end after the headers
+                    has_body[0] = status.value >= 200 \
+                        and status.value not in (204, 304)
+                    framed[0] = chunked and has_body[0]
+                    writer.write('HTTP/1.1 {} {}\r\n'.format(
+                        status.value, status.phrase).encode('latin1'))
+                    for name, value in message.get('headers', []):
+                        writer.write(name + b': ' + value + b'\r\n')
+                    writer.write((b'Transfer-Encoding: chunked\r\n'
+                                  if framed[0] else b'') +
+                                 (b'' if keep_alive
+                                  else b'Connection: close\r\n') +
+                                 b'\r\n')
+                elif message['type'] == 'http.response.body':
+                    data = message.get('body', b'') if has_body[0] else b''
+                    if data and framed[0]:
+                        writer.write('{:x}\r\n'.format(len(data))
+                                     .encode('latin1') + data + b'\r\n')
+                    elif data:
+                        writer.write(data)
+                    if framed[0] and not message.get('more_body', False):
+                        writer.write(b'0\r\n\r\n')
+                await writer.drain()
+            await app(scope, receive, send)
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve_asgi(app: BlanketDBASGI,
+               host: Optional[str] = None,
+               port: Optional[int] = None,
+               sock: Optional[socket.socket] = None,
+               graceful_timeout: float = 30.0) -> None:
+    '''Serve `app` over HTTP/1.1 on `host` and `port` (or the listening
+       socket `sock`) using an asyncio event loop until interrupted or
+       terminated. On shutdown, idle connections are closed and requests
+       in progress are given `graceful_timeout` seconds to complete.'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    connections = _Connections()
+
+    def connected(reader: asyncio.StreamReader,
+                  writer: asyncio.StreamWriter) -> None:
+        task = loop.create_task(
+            _serve_http_connection(app, reader, writer, connections))
+        connections.tasks.add(task)
+        task.add_done_callback(connections.tasks.discard)
+    server = loop.run_until_complete(
+        asyncio.start_server(connected, host, port, sock=sock))
+    if threading.current_thread() is threading.main_thread():
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        except NotImplementedError:
+            pass  # not supported on Windows
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        connections.close_idle()
+        if connections.tasks:
+            _, pending = loop.run_until_complete(
+                asyncio.wait(list(connections.tasks),
+                             timeout=graceful_timeout))
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+
+
+class _PooledWSGIServer(WSGIServer):
+    '''WSGI server accepting connections on the listening socket `sock`
+       and handling them with `threads` threads. At most `max_queue`
+       accepted connections wait for a thread, further connections are
+       rejected with 503 Service Unavailable.'''
+
+    def __init__(self, sock: socket.socket, app: Any,
+                 threads: int, max_queue: int) -> None:
+        WSGIServer.__init__(self, sock.getsockname()[:2],
+                            WSGIRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name, self.server_port = sock.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self._requests = queue.Queue(max_queue)  # type: queue.Queue[Any]
+        self._threads = [threading.Thread(target=self._work, daemon=True,
+                                          name='blanketdb-http-{}'.format(i))
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                request.sendall(
+                    'HTTP/1.0 {}\r\n'.format(_HTTP_STATUS_CODES[503])
+                    .encode('latin1') +
+                    b''.join('{}: {}\r\n'.format(*header).encode('latin1')
+                             for header in _UNAVAILABLE_HEADERS) +
+                    b'\r\n' + _j(message=_UNAVAILABLE_MESSAGE))
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _work(self) -> None:
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self, graceful_timeout: float = 30.0) -> None:
+        '''Close the listening socket after handling queued connections,
+           giving them `graceful_timeout` seconds to complete.'''
+        deadline = time.monotonic() + graceful_timeout
+        for _ in self._threads:
+            self._requests.put(None)
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        WSGIServer.server_close(self)
+
+
+def _listen(interface: str, port: int) -> socket.socket:
+    '''Open a listening TCP socket on `interface` and `port`.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+def _serve_worker(args: Any, sock: socket.socket, slot: int) -> None:
+    '''Serve requests accepted on the listening socket `sock` with a
+       `BlanketDB` instance configured by the command line `args` until
+       interrupted or terminated. Only the worker in `slot` 0 enforces
+       retention policies.'''
+    db = BlanketDB(args.file, pool_size=args.threads, profile=args.profile,
+                   commit_latency=args.commit_latency,
+                   commit_rows=args.commit_rows,
+                   retention_interval=args.retention_interval
+                   if slot == 0 else None,
+                   retention_chunk_size=args.retention_chunk_size,
+                   retention_pause=args.retention_pause,
+                   poll_interval=1.0 if args.workers > 1 else None,
+                   cache_size=args.cache_size,
+                   cache_freshness=args.cache_freshness,
+                   slow_request_threshold=args.slow_request_threshold,
+                   profiling_dir=args.profiling_dir,
+                   profiling_token=args.profiling_token,
+                   schema=args.schema, partition=args.partition)
+    try:
+        if args.server == 'asyncio':
+            serve_asgi(BlanketDBASGI(db, args.threads, args.max_queue),
+                       sock=sock)
+            return
+        httpd = _PooledWSGIServer(sock, db, args.threads, args.max_queue)
+        # shutdown blocks until serve_forever returns, i.e. it must not
+        # be called by the thread running serve_forever
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(
+            target=httpd.shutdown).start())
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+    finally:
+        db.close()
+
+
+def _prefork(workers: int, serve: Callable[[int], None],
+             graceful_timeout: float = 30.0) -> None:
+    '''Run `serve` in `workers` forked processes, passing their slot
+       number, and restart workers exiting unexpectedly. SIGHUP replaces
+       all workers one by one, SIGTERM and SIGINT shut them down
+       gracefully, killing workers still running after
+       `graceful_timeout` seconds.'''
+    processes = dict()  # type: Dict[int, int]
+    signals = []  # type: List[int]
+
+    def spawn(slot: int) -> None:
+        # signals must not reach the handlers of the master in the child
+        handled = {signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+        signal.pthread_sigmask(signal.SIG_BLOCK, handled)
+        pid = os.fork()
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, handled)
+        else:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, handled)
+            code = 0
+            try:
+                serve(slot)
+            except BaseException:
+                logging.getLogger(__name__).exception(
+                    'Worker %d failed', os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        processes[pid] = slot
+
+    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, _: signals.append(signum))
+    for slot in range(workers):
+        spawn(slot)
+    retired = dict()  # type: Dict[int, float]
+    stopping = False
+    while processes:
+        while signals:
+            signum = signals.pop(0)
+            if signum == signal.SIGHUP and not stopping:
+                for pid, slot in list(processes.items()):
+                    if pid not in retired:
+                        spawn(slot)
+                        os.kill(pid, signal.SIGTERM)
+                        retired[pid] = time.monotonic() + graceful_timeout
+            elif signum != signal.SIGHUP and not stopping:
+                stopping = True
+                for pid in processes:
+                    if pid not in retired:
+                        os.kill(pid, signal.SIGTERM)
+                        retired[pid] = time.monotonic() + graceful_timeout
+        for pid, deadline in retired.items():
+            if pid in processes and time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            time.sleep(0.1)
+            continue
+        slot = processes.pop(pid)
+        if retired.pop(pid, None) is None and not stopping:
+            logging.getLogger(__name__).warning(
+                'Worker %d exited unexpectedly, restarting it', pid)
+            time.sleep(1.0)  # do not spin if workers fail on startup
+            spawn(slot)
+
+
 def cli() -> None:
     from argparse import ArgumentParser
     parser = ArgumentParser(description='Start a BlanketDB instance ' +
-                                        'using wsgiref.simple_server.')
+                                        'using wsgiref.simple_server ' +
+                                        'or an asyncio HTTP server.')
     parser.add_argument('-i', '--interface', help='Interface to listen on',
                         default='localhost', type=str)
     parser.add_argument('-p', '--port', help='Port to listen on',
                         default=8080, type=int)
     parser.add_argument('-f', '--file', help='Database file to use',
                         default='db.sqlite', type=str)
+    parser.add_argument('--server', help='HTTP server to use',
+                        default='wsgiref', choices=['wsgiref', 'asyncio'])
+    parser.add_argument('--profile', help='Durability/performance profile',
+                        default='safe', choices=sorted(_PROFILES))
+    parser.add_argument('--schema', help='Storage layout of a new ' +
+                        'database file (default: text)',
+                        default=None, choices=sorted(_SCHEMAS))
+    parser.add_argument('--partition', help='Store the entries of a new ' +
+                        'database file in one table per period',
+                        default=None, choices=sorted(_PARTITION_FORMATS))
+    parser.add_argument('--commit-latency', help='Commit single entries ' +
+                        'in groups, delaying each by at most this ' +
+                        'number of seconds', default=None, type=float)
+    parser.add_argument('--commit-rows', help='Maximum number of entries ' +
+                        'per group commit', default=256, type=int)
+    parser.add_argument('--retention-interval', help='Enforce retention ' +
+                        'policies every this number of seconds',
+                        default=None, type=float)
+    parser.add_argument('--retention-chunk-size', help='Maximum number of ' +
+                        'entries deleted per transaction when enforcing ' +
+                        'retention policies', default=1000, type=int)
+    parser.add_argument('--retention-pause', help='Seconds to pause ' +
+                        'between deletions when enforcing retention ' +
+                        'policies', default=0.05, type=float)
+    parser.add_argument('--workers', help='Number of worker processes ' +
+                        'sharing the listening socket (send SIGHUP to ' +
+                        'replace them gracefully)', default=1, type=int)
+    parser.add_argument('--threads', help='Number of threads (and ' +
+                        'database connections) per worker process',
+                        default=4, type=int)
+    parser.add_argument('--max-queue', help='Maximum number of requests ' +
+                        'waiting for a thread per worker process before ' +
+                        'responding 503 Service Unavailable',
+                        default=64, type=int)
+    parser.add_argument('--cache-size', help='Maximum size in bytes of ' +
+                        'cached query responses (0 disables the cache)',
+                        default=0, type=int)
+    parser.add_argument('--cache-freshness', help='Seconds to reuse ' +
+                        'cached responses to queries with relative times',
+                        default=1.0, type=float)
+    parser.add_argument('--slow-request-threshold', help='Log requests ' +
+                        'taking at least this many seconds with their ' +
+                        'rows and time per phase', default=None, type=float)
+    parser.add_argument('--profiling-dir', help='Directory for cProfile ' +
+                        'dumps of requests passing the profiling token',
+                        default=None, type=str)
+    parser.add_argument('--profiling-token', help='Secret enabling ' +
+                        'profiling of a request in the X-BlanketDB-Profile ' +
+                        'header or the _profile query parameter (default: ' +
+                        'environment variable BLANKETDB_PROFILING_TOKEN)',
+                        default=os.environ.get('BLANKETDB_PROFILING_TOKEN'),
+                        type=str)
     args = parser.parse_args()
-    from wsgiref.simple_server import make_server
+    if args.workers < 1 or args.threads < 1 or args.max_queue < 1:
+        parser.error('--workers, --threads and --max-queue ' +
+                     'must be positive')
+    if args.workers > 1 and args.cache_size > 0:
+        parser.error('--cache-size requires a single worker, as writes ' +
+                     'of other workers would not invalidate the cache')
+    if args.profiling_dir is not None and not args.profiling_token:
+        parser.error('--profiling-dir requires a profiling token')
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        parser.error('--workers requires os.fork')
+    sock = _listen(args.interface, args.port)
     msg = 'Starting BlanketDB at http://{interface}:{port} using ' + \
-          'database file "{file}"'
-    print(msg.format_map(vars(args)))
-    httpd = make_server(args.interface, args.port, BlanketDB(args.file))
-    httpd.serve_forever()
+          'database file "{file}" with {workers} worker(s)'
+    print(msg.format_map(vars(args)), flush=True)
+    try:
+        if args.workers == 1:
+            _serve_worker(args, sock, 0)
+        else:
+            _prefork(args.workers,
+                     lambda slot: _serve_worker(args, sock, slot))
+    finally:
+        sock.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Test benchmarks of BlanketDB.'''
+
+
+import unittest
+from argparse import Namespace
+
+from benchmarks.benchmark import run, compare, percentiles
+
+
+class TestBenchmark(unittest.TestCase):
+    '''Test benchmarks of BlanketDB.'''
+
+    def test_run_small_benchmark(self):
+        '''Run all benchmarks on a tiny dataset'''
+        args = Namespace(buckets=2, rows=300, single_rows=50, batch_size=100,
+                         payload_size=50, spread=3600, window=600, limit=10,
+                         queries=5, profile='fast', schema='compact',
+                         partition='day', compression=6, seed=1,
+                         tmpdir=None)
+        results = run(args)
+        self.assertEqual(50, results['store_single']['rows'])
+        self.assertEqual(250, results['store_batch']['rows'])
+        self.assertEqual(5, results['wsgi_get']['n'])
+        self.assertGreater(results['file_size']['bytes'], 0)
+        self.assertEqual(250, results['compression']['compressed_rows'])
+        self.assertGreater(results['retention_delete']['rows'], 0)
+        self.assertEqual(results['export_python']['rows'],
+                         results['export_wsgi_columnar']['rows'])
+        lines = compare(results, results)
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.endswith('(+0.0%)'), line)
+
+    def test_percentiles(self):
+        '''Test summarizing latencies'''
+        summary = percentiles([i / 1000 for i in range(1, 101)])
+        self.assertEqual(51, summary['p50_ms'])
+        self.assertEqual(100, summary['max_ms'])
+        self.assertEqual(100, summary['n'])
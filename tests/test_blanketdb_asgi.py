@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Test ASGI application and asyncio HTTP server of BlanketDB.'''
+
+
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import unittest
+from datetime import datetime
+
+from blanketdb import BlanketDB, BlanketDBASGI, _serve_http_connection
+
+
+class TestBlanketDBASGI(unittest.TestCase):
+    '''Test ASGI application of BlanketDB.'''
+
+    def setUp(self):
+        self.next_date = datetime(2022, 7, 15)
+        self.db = BlanketDB(':memory:', lambda: self.next_date)
+        self.app = BlanketDBASGI(self.db, max_workers=2)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.db.close()
+
+    def request(self, method, path, query=b'', body=b'', headers=()):
+        '''Call the ASGI application and collect status and body.'''
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query,
+                 'headers': [(b'content-type', b'application/json')] +
+                 list(headers)}
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        self.assertEqual('http.response.start', messages[0]['type'])
+        self.assertFalse(messages[-1].get('more_body', False))
+        return messages[0]['status'], \
+            b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_same_routes_as_wsgi(self):
+        '''Test that responses equal those of the WSGI callable'''
+        status, body = self.request('POST', '/testbucket', body=b'{"a": 1}')
+        self.assertEqual(201, status)
+        self.assertEqual(dict(id=1, bucket='testbucket',
+                              timestamp='2022-07-15T00:00:00',
+                              data=dict(a=1)), json.loads(body.decode()))
+        status, body = self.request('GET', '/testbucket')
+        self.assertEqual(200, status)
+        self.assertEqual(1, json.loads(body.decode())['number_of_entries'])
+        self.assertEqual(404, self.request('GET', '/_entry/2')[0])
+        self.assertEqual(400, self.request('GET', '/',
+                                           query=b'limit=abc')[0])
+        self.assertEqual(405, self.request('PUT', '/testbucket')[0])
+
+    def test_store_after_loop_closed(self):
+        '''Test storing after the event loop of the app has been closed'''
+        self.request('GET', '/')
+        self.loop.close()
+        self.assertEqual(1, self.db.store(1, 'a')['id'])
+        self.db._notifier.listeners.append(lambda bucket, last_id: 1 / 0)
+        self.assertEqual(2, self.db.store(2, 'a')['id'])
+
+    def test_lifespan_shutdown(self):
+        '''Test unregistering the app on lifespan shutdown'''
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            pass
+        self.loop.run_until_complete(
+            self.app({'type': 'lifespan'}, receive, send))
+        self.assertNotIn(self.app._on_store, self.db._notifier.listeners)
+
+    def test_long_poll_and_stream(self):
+        '''Test waiting for entries without occupying executor threads'''
+        self.loop.call_later(0.05, self.db.store, dict(a=1), 'testbucket')
+        status, body = self.request('GET', '/testbucket',
+                                    query=b'since_id=1&wait=10')
+        resp = json.loads(body.decode())
+        self.assertEqual(1, resp['number_of_entries'])
+        for i in range(2, 5):
+            self.loop.call_later(0.01 * i, self.db.store, dict(a=i),
+                                 'testbucket')
+        status, body = self.request('GET', '/testbucket/_stream',
+                                    query=b'limit=3&meta=false&wait=0.01')
+        self.assertEqual(200, status)
+        events = [e for e in body.split(b'\n\n') if e.startswith(b'id')]
+        self.assertEqual([b'id: 2\nevent: entry\ndata: {"a": 2}',
+                          b'id: 3\nevent: entry\ndata: {"a": 3}',
+                          b'id: 4\nevent: entry\ndata: {"a": 4}'], events)
+
+    def serve_http(self):
+        '''Serve the ASGI application using the asyncio HTTP server in a
+           thread, return its port and a function stopping it.'''
+        started = threading.Event()
+        loop = asyncio.new_event_loop()
+        servers = []
+
+        def serve():
+            asyncio.set_event_loop(loop)
+            servers.append(loop.run_until_complete(asyncio.start_server(
+                lambda r, w: _serve_http_connection(self.app, r, w),
+                '127.0.0.1', 0)))
+            started.set()
+            loop.run_forever()
+            servers[0].close()
+            # let connection handlers finish
+            loop.run_until_complete(
+                asyncio.gather(*asyncio.all_tasks(loop)))
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        started.wait()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        return servers[0].sockets[0].getsockname()[1], stop
+
+    def test_http_server(self):
+        '''Test serving the ASGI application over HTTP with keep-alive'''
+        port, stop = self.serve_http()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            for i in range(3):
+                conn.request('POST', '/testbucket', json.dumps(dict(a=i)),
+                             {'Content-Type': 'application/json'})
+                resp = conn.getresponse()
+                self.assertEqual(201, resp.status)
+                self.assertEqual(i + 1, json.loads(resp.read())['id'])
+            conn.request('GET', '/testbucket?limit=2')
+            resp = conn.getresponse()
+            self.assertEqual(200, resp.status)
+            self.assertEqual('application/json',
+                             resp.getheader('Content-Type'))
+            self.assertEqual(2, json.loads(resp.read())['number_of_entries'])
+            conn.close()
+        finally:
+            stop()
+
+    def test_http_server_not_modified(self):
+        '''Test that 304 responses end after the headers on the wire'''
+        self.db.store(dict(a=1), 'testbucket')
+        etag = self.db._etag(dict(PATH_INFO='/testbucket', QUERY_STRING=''),
+                             dict(bucket='testbucket', since=None,
+                                  before=None), 'json')
+        port, stop = self.serve_http()
+        try:
+            with socket.create_connection(('127.0.0.1', port),
+                                          timeout=5) as sock:
+                request = 'GET /testbucket HTTP/1.1\r\nHost: x\r\n' + \
+                    'If-None-Match: {}\r\n\r\n'.format(etag)
+                sock.sendall(request.encode('latin1') * 2)
+                data = b''
+                while data.count(b'\r\n\r\n') < 2:
+                    chunk = sock.recv(65536)
+                    self.assertTrue(chunk)
+                    data += chunk
+            first, second, rest = data.split(b'\r\n\r\n')
+            for head in (first, second):
+                self.assertTrue(head.startswith(b'HTTP/1.1 304 '), head)
+                self.assertNotIn(b'transfer-encoding', head.lower())
+            self.assertEqual(b'', rest)
+        finally:
+            stop()
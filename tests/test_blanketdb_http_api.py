@@ -5,11 +5,20 @@
 
 
 import unittest
+import base64
+import io
+import json
+import os
+import pstats
+import tempfile
+import time
+import zlib
 from datetime import datetime, timedelta
 
+from webob import Request
 from webtest import TestApp
 
-from blanketdb import BlanketDB
+from blanketdb import BlanketDB, read_columnar
 
 
 class TestBlanketDBHttpApi(unittest.TestCase):
@@ -134,3 +143,536 @@ class TestBlanketDBHttpApi(unittest.TestCase):
         self.app.delete('/', status=200)  # deletes all, not default bucket
         self.assertEqual(0, self.app.get('/', status=200)
                                     .json['number_of_entries'])
+
+    def test_streaming_query_response(self):
+        '''Test that query responses are streamed entry by entry'''
+        for i in range(5):
+            self.app.post_json('/testbucket', dict(number=i), status=201)
+        env = dict(PATH_INFO='/testbucket', REQUEST_METHOD='GET',
+                   QUERY_STRING='meta=false&newest_first=false')
+        chunks = self.db(env, lambda status, headers: None)
+        head = next(chunks)
+        self.assertIn(b'"bucket_requested": "testbucket"', head)
+        rest = list(chunks)
+        self.assertEqual(6, len(rest))
+        resp = json.loads((head + b''.join(rest)).decode('utf8'))
+        self.assertEqual([dict(number=i) for i in range(5)],
+                         resp['entries'])
+        self.assertEqual(5, resp['number_of_entries'])
+        self.assertEqual(5, resp['last_id'])
+
+    def test_batch_requests(self):
+        '''Test batch creation of entries'''
+        resp = self.app.post_json('/testbucket/_batch',
+                                  [dict(number=i) for i in range(3)],
+                                  status=201)
+        self.assertEqual(dict(bucket='testbucket', first_id=1, last_id=3,
+                              number_of_entries=3,
+                              timestamp=self.next_date.isoformat()),
+                         resp.json)
+        ndjson = '{"number": 3}\n{"number": 4}\n'
+        resp = self.app.post('/_batch', ndjson, status=201,
+                             content_type='application/x-ndjson')
+        self.assertEqual('default', resp.json['bucket'])
+        self.assertEqual(4, resp.json['first_id'])
+        self.assertEqual(5, resp.json['last_id'])
+        self.assertEqual(3, self.app.get('/testbucket', status=200)
+                                    .json['number_of_entries'])
+        self.app.post_json('/testbucket/_batch', dict(a=1), status=400)
+        self.app.post('/testbucket/_batch', '[1, 2', status=400,
+                      content_type='application/json')
+        self.app.post('/testbucket/_batch', dict(a=1), status=415)
+
+    def test_aggregate_requests(self):
+        '''Test aggregation of entries by time bins'''
+        for i in range(6):
+            self.app.post_json('/testbucket', dict(temp=i), status=201)
+            self.next_date += timedelta(minutes=20)
+        resp = self.app.get('/testbucket/_aggregate',
+                            dict(field='temp', interval='1h',
+                                 fn='avg,min,max'), status=200)
+        self.assertEqual(3600, resp.json['interval'])
+        self.assertEqual(2, resp.json['number_of_bins'])
+        self.assertEqual(dict(bin='2022-07-15T00:00:00', avg=1, min=0, max=2),
+                         resp.json['bins'][0])
+        self.assertEqual(1, self.app.get('/_aggregate',
+                                         dict(field='temp', interval='1d'),
+                                         status=200)
+                                    .json['number_of_bins'])
+        self.app.get('/testbucket/_aggregate', dict(fn='median'), status=400)
+        self.app.get('/testbucket/_aggregate', dict(interval='x'), status=400)
+
+    def test_rollup_requests(self):
+        '''Test configuring and reading rollups'''
+        resp = self.app.put_json('/testbucket/_rollup',
+                                 dict(fields=['temp'], intervals=['1h'],
+                                      funcs=['max']), status=200)
+        self.assertEqual([3600], resp.json['intervals'])
+        for i in range(6):
+            self.app.post_json('/testbucket', dict(temp=i), status=201)
+            self.next_date += timedelta(minutes=20)
+        resp = self.app.get('/testbucket/_rollup/1h', status=200)
+        self.assertEqual([dict(field='temp', bin='2022-07-15T00:00:00',
+                               max=2),
+                          dict(field='temp', bin='2022-07-15T01:00:00',
+                               max=5)], resp.json['bins'])
+        resp = self.app.get('/testbucket/_rollup/1h', dict(fn='count'),
+                            status=200)
+        self.assertEqual([3, 3], [b['count'] for b in resp.json['bins']])
+        self.app.get('/testbucket/_rollup/1d', status=404)
+        self.app.get('/testbucket/_rollup/1h', dict(fn='median'), status=400)
+        self.app.put_json('/testbucket/_rollup', dict(fields=['a b']),
+                          status=400)
+        self.app.put_json('/testbucket/_rollup', [], status=400)
+        for spec in [dict(fields='temp', intervals=['1h']),
+                     dict(fields=['temp'], intervals='1h'),
+                     dict(fields=['temp'], funcs='max'),
+                     dict(fields=['temp'], intervals=[True])]:
+            self.app.put_json('/testbucket/_rollup', spec, status=400)
+        self.assertEqual(['temp'], [b['field'] for b in self.app.get(
+            '/testbucket/_rollup/1h', status=200).json['bins']][:1])
+
+    def test_retention_requests(self):
+        '''Test configuring retention policies'''
+        resp = self.app.put_json('/testbucket/_retention',
+                                 dict(max_age='30d', max_rows=1000),
+                                 status=200)
+        self.assertEqual(dict(bucket='testbucket', max_age=30 * 24 * 3600,
+                              max_rows=1000), resp.json)
+        resp = self.app.put_json('/testbucket/_retention', dict(),
+                                 status=200)
+        self.assertEqual(dict(bucket='testbucket', max_age=None,
+                              max_rows=None), resp.json)
+        self.app.put_json('/testbucket/_retention', dict(max_age='x'),
+                          status=400)
+        self.app.put_json('/testbucket/_retention', dict(max_rows='x'),
+                          status=400)
+
+    def test_where_requests(self):
+        '''Test filtering on fields of the data'''
+        for i in range(5):
+            self.app.post_json('/testbucket', dict(device='sensor{}'
+                                                   .format(i % 2), temp=i),
+                               status=201)
+        resp = self.app.get('/testbucket', dict(where='device == "sensor0"',
+                                                limit=2, meta='false'),
+                            status=200)
+        self.assertEqual('device == "sensor0"', resp.json['where'])
+        self.assertEqual([dict(device='sensor0', temp=4),
+                          dict(device='sensor0', temp=2)],
+                         resp.json['entries'])
+        resp = self.app.get('/testbucket', dict(cursor=resp.json['next'],
+                                                meta='false'), status=200)
+        self.assertEqual([dict(device='sensor0', temp=0)],
+                         resp.json['entries'])
+        self.assertIsNone(resp.json['next'])
+        resp = self.app.get('/testbucket', dict(where='temp > 10'),
+                            status=200)
+        self.assertEqual(0, resp.json['number_of_entries'])
+        resp = self.app.get('/testbucket', dict(where='temp >'), status=400)
+        self.assertIn('where', resp.json['message'])
+        resp = self.app.delete('/testbucket?where=temp+%3E%3D+3',
+                               status=200)
+        self.assertEqual(2, resp.json['number_of_entries_deleted'])
+        self.assertEqual(3, self.app.get('/testbucket')
+                         .json['number_of_entries'])
+        self.app.delete('/testbucket?where=temp+%3E', status=400)
+
+    def test_fields_requests(self):
+        '''Test responses holding selected fields of the data only'''
+        for i in range(3):
+            self.app.post_json('/testbucket', dict(temp=i, hum=40 + i,
+                                                   meta=dict(device='d'),
+                                                   note='x' * 100),
+                               status=201)
+        resp = self.app.get('/testbucket', dict(fields='temp,meta.device',
+                                                meta='false', limit=2),
+                            status=200)
+        self.assertEqual(['temp', 'meta.device'], resp.json['fields'])
+        self.assertEqual([dict(temp=2, meta=dict(device='d')),
+                          dict(temp=1, meta=dict(device='d'))],
+                         resp.json['entries'])
+        resp = self.app.get('/testbucket', dict(cursor=resp.json['next'],
+                                                fields='hum'), status=200)
+        self.assertEqual([dict(hum=40)],
+                         [entry['data'] for entry in resp.json['entries']])
+        resp = self.app.get('/testbucket', dict(fields='hum', format='csv'),
+                            status=200)
+        self.assertEqual(['id,bucket,timestamp,data.hum'],
+                         resp.text.splitlines()[:1])
+        resp = self.app.get('/testbucket', dict(fields='no-field'),
+                            status=400)
+        self.assertIn('no-field', resp.json['message'])
+
+    def test_index_requests(self):
+        '''Test configuring indexes on fields of the data'''
+        resp = self.app.put_json('/testbucket/_indexes',
+                                 dict(fields=['device', 'reading.temp']),
+                                 status=200)
+        self.assertEqual(dict(bucket='testbucket',
+                              fields=['device', 'reading.temp']), resp.json)
+        self.assertTrue(any('blanketdb_field_' in step for step in
+                            self.db.explain('testbucket',
+                                            where='device == "x"')))
+        resp = self.app.put_json('/testbucket/_indexes', dict(),
+                                 status=200)
+        self.assertEqual(dict(bucket='testbucket', fields=[]), resp.json)
+        self.app.put_json('/testbucket/_indexes', dict(fields='device'),
+                          status=400)
+        self.app.put_json('/testbucket/_indexes', dict(fields=['a-b']),
+                          status=400)
+
+    def test_compression_requests(self):
+        '''Test configuring and reporting the compression of a bucket'''
+        for i in range(5):
+            self.app.post_json('/testbucket', dict(device='sensor0', temp=i))
+        resp = self.app.put_json('/testbucket/_compression',
+                                 dict(level=6, samples=5), status=200)
+        self.assertEqual(dict(bucket='testbucket', level=6,
+                              compressed_entries=0, sampled_entries=5),
+                         {key: resp.json[key] for key in
+                          ('bucket', 'level', 'compressed_entries',
+                           'sampled_entries')})
+        self.assertGreater(resp.json['dictionary_bytes'], 0)
+        self.app.post_json('/testbucket', dict(device='sensor0', temp=5))
+        resp = self.app.get('/testbucket/_compression?samples=2', status=200)
+        self.assertEqual(1, resp.json['compressed_entries'])
+        self.assertEqual(2, resp.json['sampled_entries'])
+        self.assertGreater(resp.json['ratio'], 1)
+        resp = self.app.get('/testbucket', status=200)
+        self.assertEqual(dict(device='sensor0', temp=5),
+                         resp.json['entries'][0]['data'])
+        resp = self.app.put_json('/testbucket/_compression',
+                                 dict(level=None), status=200)
+        self.assertIsNone(resp.json['level'])
+        self.app.put_json('/testbucket/_compression', dict(level=0),
+                          status=400)
+        self.app.put_json('/testbucket/_compression', dict(samples='x'),
+                          status=400)
+        self.app.put_json('/testbucket/_compression', [], status=400)
+        self.app.put_json('/testbucket/_indexes', dict(fields=['device']),
+                          status=400)
+        self.app.get('/testbucket/_compression?samples=x', status=400)
+
+    def test_cursor_requests(self):
+        '''Test paging through a bucket using cursors'''
+        for i in range(5):
+            self.app.post_json('/testbucket', dict(number=i), status=201)
+        self.app.post_json('/otherbucket', dict(number=-1), status=201)
+        resp = self.app.get('/testbucket', dict(limit=2, meta='false'),
+                            status=200)
+        self.assertEqual([dict(number=4), dict(number=3)],
+                         resp.json['entries'])
+        self.assertIsNone(resp.json['prev'])
+        resp = self.app.get('/testbucket', dict(cursor=resp.json['next'],
+                                                meta='false'), status=200)
+        self.assertEqual([dict(number=2), dict(number=1)],
+                         resp.json['entries'])
+        self.assertEqual(2, resp.json['limit'])
+        prev = resp.json['prev']
+        resp = self.app.get('/testbucket', dict(cursor=resp.json['next']),
+                            status=200)
+        self.assertEqual([1], [e['id'] for e in resp.json['entries']])
+        self.assertIsNone(resp.json['next'])
+        resp = self.app.get('/testbucket', dict(cursor=prev, limit=1),
+                            status=200)
+        self.assertEqual([4], [e['id'] for e in resp.json['entries']])
+        self.app.get('/otherbucket', dict(cursor=prev), status=400)
+        self.app.get('/testbucket', dict(cursor='e30'), status=400)
+        cursor = json.loads(base64.urlsafe_b64decode(prev + '==='))
+        for key, value in [('limit', None), ('older', 1),
+                           ('newest_first', 'yes'), ('since', 5)]:
+            invalid = base64.urlsafe_b64encode(
+                json.dumps(dict(cursor, **{key: value})).encode('utf8'))
+            self.app.get('/testbucket', dict(cursor=invalid.decode('ascii')),
+                         status=400)
+
+    def test_export_formats(self):
+        '''Test compact JSON, NDJSON, CSV and columnar exports'''
+        self.app.post_json('/testbucket', dict(a=1, n=dict(x='y', z=[1, 2])),
+                           status=201)
+        self.app.post_json('/testbucket', 5, status=201)
+        resp = self.app.get('/testbucket', dict(format='compact'),
+                            status=200)
+        self.assertEqual('application/json', resp.content_type)
+        self.assertNotIn('\n', resp.text)
+        self.assertEqual(self.app.get('/testbucket').json, resp.json)
+        resp = self.app.get('/testbucket',
+                            dict(format='compact', meta='false'), status=200)
+        self.assertEqual([5, dict(a=1, n=dict(x='y', z=[1, 2]))],
+                         resp.json['entries'])
+        self.assertEqual(2, resp.json['last_id'])
+        resp = self.app.get('/testbucket', dict(format='ndjson'), status=200)
+        self.assertEqual('application/x-ndjson', resp.content_type)
+        lines = [json.loads(line) for line in resp.text.splitlines()]
+        self.assertEqual([2, 1], [entry['id'] for entry in lines])
+        resp = self.app.get('/testbucket', dict(format='csv', meta='false'),
+                            status=200)
+        self.assertEqual('text/csv', resp.content_type)
+        self.assertEqual(['data,a,n.x,n.z', '5,,,', ',1,y,"[1, 2]"'],
+                         resp.text.splitlines())
+        resp = self.app.get('/testbucket', dict(format='csv'), status=200)
+        self.assertEqual('id,bucket,timestamp,data,data.a,data.n.x,data.n.z',
+                         resp.text.splitlines()[0])
+        resp = self.app.get('/testbucket', dict(format='columnar'),
+                            status=200)
+        columns = read_columnar(io.BytesIO(resp.body))
+        self.assertEqual([2, 1], columns['id'])
+        self.assertEqual(['testbucket'] * 2, columns['bucket'])
+        self.assertEqual([self.next_date] * 2, columns['timestamp'])
+        self.assertEqual([5, dict(a=1, n=dict(x='y', z=[1, 2]))],
+                         columns['data'])
+        self.app.get('/testbucket', dict(format='xml'), status=400)
+
+    def test_export_format_negotiation(self):
+        '''Test selecting the export format by Accept header'''
+        def content_type(accept):
+            return self.app.get('/', headers={'Accept': accept},
+                                status=200).content_type
+        self.assertEqual('application/json', content_type('*/*'))
+        self.assertEqual('text/csv', content_type('text/csv'))
+        self.assertEqual('application/x-ndjson',
+                         content_type('text/csv;q=0.5, application/x-ndjson'))
+        self.assertEqual('application/vnd.blanketdb.columnar',
+                         content_type('application/vnd.blanketdb.columnar'))
+        resp = self.app.get('/', dict(format='ndjson'),
+                            headers={'Accept': 'text/csv'}, status=200)
+        self.assertEqual('application/x-ndjson', resp.content_type)
+
+    def test_compressed_responses(self):
+        '''Test gzip and deflate encoding of responses'''
+        def get(accept_encoding):
+            # call the application directly, as webtest decodes responses
+            status, headers, app_iter = Request.blank(
+                '/testbucket', headers={'Accept-Encoding': accept_encoding}) \
+                .call_application(self.db)
+            self.assertEqual('200 OK', status)
+            return dict(headers), b''.join(app_iter)
+        for i in range(20):
+            self.app.post_json('/testbucket', dict(number=i), status=201)
+        headers, plain = get('identity')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual('Accept-Encoding', headers['Vary'])
+        for accept, encoding, wbits in [('gzip', 'gzip', 31),
+                                        ('deflate, gzip', 'gzip', 31),
+                                        ('gzip;q=0.5, deflate', 'deflate',
+                                         15)]:
+            headers, body = get(accept)
+            self.assertEqual(encoding, headers['Content-Encoding'])
+            self.assertEqual(plain, zlib.decompress(body, wbits))
+            self.assertLess(len(body), len(plain))
+        headers, body = get('gzip;q=0, br')
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_conditional_requests(self):
+        '''Test ETags and 304 responses for unchanged query results'''
+        self.app.post_json('/testbucket', dict(number=0), status=201)
+        resp = self.app.get('/testbucket', dict(limit=5), status=200)
+        etag = resp.headers['ETag']
+        self.app.get('/testbucket', dict(limit=5),
+                     headers={'If-None-Match': etag}, status=304)
+        self.app.get('/testbucket', dict(limit=5),
+                     headers={'If-None-Match': '"x", ' + etag}, status=304)
+        # the tag does not change with the content coding, i.e. it is weak
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(etag, self.app.get(
+            '/testbucket', dict(limit=5),
+            headers={'Accept-Encoding': 'gzip'}).headers['ETag'])
+        self.app.get('/testbucket', dict(limit=5),
+                     headers={'If-None-Match': etag[2:]}, status=304)
+        for params in [dict(limit=6), dict(limit=5, format='ndjson')]:
+            self.assertNotEqual(etag, self.app.get('/testbucket', params)
+                                .headers['ETag'])
+        self.app.post_json('/otherbucket', dict(number=1), status=201)
+        self.app.get('/testbucket', dict(limit=5),
+                     headers={'If-None-Match': etag}, status=304)
+        self.app.post_json('/testbucket', dict(number=2), status=201)
+        resp = self.app.get('/testbucket', dict(limit=5),
+                            headers={'If-None-Match': etag}, status=200)
+        self.assertEqual(2, resp.json['number_of_entries'])
+        etag = resp.headers['ETag']
+        self.app.delete('/_entry/1', status=200)
+        resp = self.app.get('/testbucket', dict(limit=5),
+                            headers={'If-None-Match': etag}, status=200)
+        self.assertEqual(1, resp.json['number_of_entries'])
+        # deleting the oldest entries leaves the highest ID as it is
+        self.app.post_json('/testbucket', dict(number=3), status=201)
+        for delete in [lambda: self.app.delete('/testbucket?before_id=4'),
+                       lambda: self.app.delete('/?before_id=5'),
+                       lambda: (self.db.set_retention('testbucket',
+                                                      max_rows=1),
+                                self.db.enforce_retention(pause=0))]:
+            self.app.post_json('/testbucket', dict(number=4), status=201)
+            etag = self.app.get('/testbucket', status=200).headers['ETag']
+            delete()
+            self.app.get('/testbucket', headers={'If-None-Match': etag},
+                         status=200)
+        # relative times are resolved to the current time
+        etag = self.app.get('/testbucket', dict(since='1h')).headers['ETag']
+        self.assertNotEqual(etag, self.app.get(
+            '/testbucket', dict(since='1h')).headers['ETag'])
+
+    def test_response_cache(self):
+        '''Test caching query responses until their bucket is written to'''
+        db = BlanketDB(':memory:', lambda: self.next_date, cache_size=10000)
+        app = TestApp(db)
+        app.post_json('/testbucket', dict(number=0), status=201)
+        first = app.get('/testbucket', dict(limit=5), status=200)
+        self.assertEqual(first.body, app.get('/testbucket', dict(limit=5),
+                                             status=200).body)
+        app.get('/testbucket', dict(limit=5),
+                headers={'If-None-Match': first.headers['ETag']}, status=304)
+        self.assertEqual(dict(hits=2, misses=1, responses=1,
+                              size=len(first.body), max_size=10000),
+                         db.cache_info())
+        app.get('/', status=200)
+        app.post_json('/otherbucket', dict(number=1), status=201)
+        self.assertEqual(1, db.cache_info()['responses'])
+        for write in [lambda: app.post_json('/testbucket', 1),
+                      lambda: app.post_json('/testbucket/_batch', [2, 3]),
+                      lambda: app.delete('/_entry/3'),
+                      lambda: app.delete('/testbucket?since_id=4')]:
+            app.get('/testbucket', dict(limit=5), status=200)
+            self.assertEqual(1, db.cache_info()['responses'])
+            write()
+            self.assertEqual(0, db.cache_info()['responses'])
+        self.assertEqual([1],
+                         [e['id'] for e in app.get('/testbucket', dict(
+                             limit=5, newest_first='false')).json['entries']])
+        app.get('/testbucket', dict(limit=5000), status=200)
+        self.assertLessEqual(db.cache_info()['size'], 10000)
+        for _ in range(100):
+            app.post_json('/bigbucket', dict(text='x' * 100), status=201)
+        app.get('/bigbucket', status=200)
+        self.assertLessEqual(db.cache_info()['size'], 10000)
+
+    def test_response_cache_freshness(self):
+        '''Test reusing responses to relative queries only for a while'''
+        db = BlanketDB(':memory:', cache_size=10000, cache_freshness=0.05)
+        app = TestApp(db)
+        app.post_json('/testbucket', dict(number=0), status=201)
+        app.get('/testbucket', dict(since='1h'), status=200)
+        app.get('/testbucket', dict(since='1h'), status=200)
+        self.assertEqual(1, db.cache_info()['hits'])
+        time.sleep(0.1)
+        app.get('/testbucket', dict(since='1h'), status=200)
+        self.assertEqual(1, db.cache_info()['hits'])
+
+    def test_metrics(self):
+        '''Test metrics in Prometheus text format'''
+        self.app.post_json('/testbucket', dict(number=0), status=201)
+        self.app.post_json('/testbucket/_batch', [1, 2], status=201)
+        self.app.get('/testbucket', status=200)
+        self.app.get('/_entry/1', status=200)
+        self.app.get('/_entry/99', status=404)
+        self.app.delete('/_entry/1', status=200)
+        resp = self.app.get('/_metrics', status=200)
+        self.assertEqual('text/plain', resp.content_type)
+        lines = resp.text.splitlines()
+        for line in [
+                'blanketdb_requests_total{method="POST",'
+                'route="/{bucket}",status="201"} 1',
+                'blanketdb_requests_total{method="POST",'
+                'route="/{bucket}/_batch",status="201"} 1',
+                'blanketdb_requests_total{method="GET",'
+                'route="/_entry",status="404"} 1',
+                'blanketdb_request_duration_seconds_count{method="GET",'
+                'route="/_entry"} 2',
+                'blanketdb_request_duration_seconds_bucket{method="GET",'
+                'route="/_entry",le="+Inf"} 2',
+                'blanketdb_rows_written_total{bucket="testbucket"} 3',
+                'blanketdb_rows_read_total 5',
+                'blanketdb_rows_deleted_total 1',
+                'blanketdb_cache_requests_total{result="hit"} 0',
+                'blanketdb_pool_connections{state="in_use"} 0']:
+            self.assertIn(line, lines)
+        self.assertTrue(any(line.startswith(
+            'blanketdb_response_bytes_total{route="/{bucket}"} ')
+            for line in lines))
+        self.assertIn('blanketdb_requests_total{method="GET",'
+                      'route="/_metrics",status="200"} 1',
+                      self.app.get('/_metrics').text.splitlines())
+
+    def test_slow_request_log(self):
+        '''Test logging of slow requests with rows and time per phase'''
+        self.db._metrics.slow_threshold = 0.0
+        self.app.post_json('/testbucket/_batch', [1, 2, 3], status=201)
+        with self.assertLogs('blanketdb.slow') as logs:
+            self.app.get('/testbucket?limit=2&meta=false&_profile=secret',
+                         status=200)
+        message = logs.records[0].getMessage()
+        self.assertTrue(message.startswith('Slow request '))
+        slow = json.loads(message[len('Slow request '):])
+        self.assertEqual('GET', slow['method'])
+        self.assertEqual('/{bucket}', slow['route'])
+        self.assertEqual('/testbucket', slow['path'])
+        self.assertEqual(dict(limit=['2'], meta=['false']), slow['params'])
+        self.assertEqual('200', slow['status'])
+        self.assertEqual(dict(read=2, written=0, deleted=0), slow['rows'])
+        self.assertEqual({'total', 'wait', 'sqlite', 'send', 'python'},
+                         set(slow['ms']))
+        self.assertGreaterEqual(slow['ms']['total'], slow['ms']['sqlite'])
+        # time waiting for new entries does not make requests slow
+        self.db._metrics.slow_threshold = 0.5
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('blanketdb.slow'):
+                self.app.get('/testbucket?since_id=4&wait=0.6', status=200)
+
+    def test_profiling(self):
+        '''Test cProfile dumps of requests passing the profiling token'''
+        with tempfile.TemporaryDirectory() as directory:
+            db = BlanketDB(':memory:', profiling_dir=directory,
+                           profiling_token='secret')
+            app = TestApp(db)
+            app.post_json('/testbucket', dict(number=1), status=201)
+            resp = app.get('/testbucket', status=200)
+            self.assertNotIn('X-BlanketDB-Profile-File', resp.headers)
+            resp = app.get('/testbucket?_profile=wrong', status=200)
+            self.assertNotIn('X-BlanketDB-Profile-File', resp.headers)
+            self.assertEqual([], os.listdir(directory))
+            resp = app.get('/testbucket?_profile=secret', status=200)
+            self.assertEqual(1, resp.json['number_of_entries'])
+            name = resp.headers['X-BlanketDB-Profile-File']
+            self.assertTrue(name.endswith('-GET_bucket.prof'))
+            stats = pstats.Stats(os.path.join(directory, name))
+            self.assertTrue(any(func[2] == '_respond'
+                                for func in stats.stats))
+            resp = app.get('/testbucket',
+                           headers={'X-BlanketDB-Profile': 'secret'},
+                           status=200)
+            self.assertIn('X-BlanketDB-Profile-File', resp.headers)
+            self.assertEqual(2, len(os.listdir(directory)))
+        with self.assertRaises(ValueError):
+            BlanketDB(':memory:', profiling_dir='profiles')
+
+
+class TestBlanketDBHttpApiCompact(TestBlanketDBHttpApi):
+    '''Test HTTP API of BlanketDB using the compact schema.'''
+
+    def setUp(self):
+        self.next_date = datetime(2022, 7, 15)
+        self.db = BlanketDB(':memory:', lambda: self.next_date,
+                            schema='compact')
+        self.app = TestApp(self.db)
+
+    def test_invalid_timestamp_requests(self):
+        '''Test filtering by timestamps which cannot be compared'''
+        self.app.get('/?since=not%20a%20date', status=400)
+        self.app.delete('/?before=not%20a%20date', status=400)
+        self.app.get('/?since=2022-07', status=200)
+
+
+class TestBlanketDBHttpApiPartitioned(TestBlanketDBHttpApi):
+    '''Test HTTP API of BlanketDB storing entries in daily partitions.'''
+
+    def setUp(self):
+        self.next_date = datetime(2022, 7, 15)
+        self.db = BlanketDB(':memory:', lambda: self.next_date,
+                            partition='day')
+        self.app = TestApp(self.db)
+
+    def test_index_requests(self):
+        '''Test configuring indexes on fields of the data'''
+        # query plans only cover existing partitions
+        self.db.store_dict(bucket='testbucket', device='x')
+        super().test_index_requests()
@@ -4,6 +4,11 @@
 '''Test Python API of BlanketDB.'''
 
 
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from datetime import datetime, timedelta
 
@@ -65,6 +70,15 @@ class TestBlanketDBPythonApi(unittest.TestCase):
             self.assertLess(i, entry['data']['number'])
             i = entry['data']['number']
 
+    def test_raw_query_from_python(self):
+        '''Test querying the stored JSON text of entries'''
+        self.db.store_dict(bucket='testbucket', a=[1, 2], b='x')
+        entry, = self.db.query(bucket='testbucket', raw=True)
+        self.assertEqual('{"a": [1, 2], "b": "x"}', entry['data'])
+        self.assertEqual(self.next_date, entry['timestamp'])
+        self.assertEqual(dict(a=[1, 2], b='x'),
+                         json.loads(entry['data']))
+
     def test_delete_from_python(self):
         '''Test `BlanketDB.delete` method using Python API'''
         for i in range(10):
@@ -84,3 +98,517 @@ class TestBlanketDBPythonApi(unittest.TestCase):
         self.assertEqual(1, len(list(self.db)))
         self.db.delete()
         self.assertEqual(0, len(list(self.db)))
+
+    def test_query_plan_uses_indexes(self):
+        '''Test that bucket/limit queries do not scan the whole table'''
+        for i in range(10):
+            self.db.store_dict(bucket='testbucket{}'.format(i % 2), number=i)
+            self.next_date += timedelta(seconds=4)
+        for kwargs in [dict(bucket='testbucket0'),
+                       dict(bucket='testbucket0', limit=3),
+                       dict(bucket='testbucket0', newest_first=False),
+                       dict(bucket='testbucket0', since_id=3, before_id=8),
+                       dict(bucket='testbucket1', since='2022-07-15'),
+                       dict(since_id=3, limit=2)]:
+            plan = self.db.explain(**kwargs)
+            self.assertTrue(plan)
+            for step in plan:
+                self.assertFalse(step.startswith('SCAN'),
+                                 '{} for {}'.format(step, kwargs))
+        self.assertEqual(5, len(list(self.db.query(bucket='testbucket0'))))
+        self.assertEqual(2, len(list(self.db.query(bucket='testbucket1',
+                                                   since_id=3,
+                                                   before_id=8))))
+
+    def test_where_from_python(self):
+        '''Test filtering on fields of the data'''
+        for i in range(12):
+            self.db.store(dict(device='sensor{}'.format(i % 3), temp=i,
+                               meta=dict(ok=i % 2 == 0)), 'testbucket')
+        self.db.store(dict(device='sensor1', temp='hot'), 'testbucket')
+        self.db.store(dict(device='sensor1', temp=20), 'otherbucket')
+
+        def ids(where, bucket='testbucket', **kwargs):
+            return [entry['id'] for entry
+                    in self.db.query(bucket, where=where, **kwargs)]
+        self.assertEqual([13, 12, 9, 6, 3], ids('device == "sensor2" ' +
+                                                'or temp == "hot"'))
+        self.assertEqual([12, 11, 10], ids('temp >= 9'))
+        self.assertEqual([13], ids('temp > "a"'))
+        self.assertEqual([6, 5, 3, 2],
+                         ids('device in ["sensor1", "sensor2"] ' +
+                             'and not (temp > 5 or temp == "hot")'))
+        self.assertEqual([11, 9, 7, 5, 3, 1], ids('meta.ok == true'))
+        self.assertEqual([13], ids('meta.ok == null'))
+        self.assertEqual([14, 13, 11], ids('device == "sensor1" and ' +
+                                           'temp != 7 and temp != 4',
+                                           bucket=None, since_id=8))
+        self.assertEqual([11, 12], ids('temp > 9', newest_first=False))
+        page = self.db.page('testbucket', limit=2, where='temp < 5')
+        self.assertEqual([5, 4], [entry['id'] for entry in page['entries']])
+        page = self.db.page(cursor=page['next'])
+        self.assertEqual([3, 2], [entry['id'] for entry in page['entries']])
+        self.assertEqual(4, self.db.delete('testbucket', where='temp < 4'))
+        self.assertEqual([], ids('temp < 4'))
+        for where in ['temp >', 'temp > true', '(temp > 1', 'temp ~ 1',
+                      '1 == temp', 'and == 1', 'temp > 1 temp', 'x in []',
+                      'x in [null]', 'x == 1' + ' or x == 1' * 40,
+                      'x == 1 or x' * 1000, '(' * 20 + 'x == 1' + ')' * 20,
+                      "x == 'a'"]:
+            with self.assertRaises(ValueError, msg=where):
+                ids(where)
+        with self.assertRaises(ValueError):
+            self.db.page('testbucket', where='temp >')
+
+    def test_fields_from_python(self):
+        '''Test reading selected fields of the data only'''
+        self.db.store(dict(temp=21.5, hum=40, ok=False, note='x' * 100,
+                           meta=dict(device='sensor1', place='roof')),
+                      'testbucket')
+        entry, = self.db.query('testbucket',
+                               fields='temp, ok,meta.device,missing')
+        self.assertEqual(dict(temp=21.5, ok=False,
+                              meta=dict(device='sensor1'), missing=None),
+                         entry['data'])
+        self.assertEqual(datetime(2022, 7, 15), entry['timestamp'])
+        entry, = self.db.query('testbucket', fields=['meta.device', 'meta'],
+                               raw=True)
+        self.assertEqual('{"meta":{"device":"sensor1","place":"roof"}}',
+                         entry['data'])
+        page = self.db.page('testbucket', fields=['hum'])
+        self.assertEqual([dict(hum=40)],
+                         [entry['data'] for entry in page['entries']])
+        for fields in (['no-field'], ['x{}'.format(i) for i in range(51)]):
+            with self.assertRaises(ValueError):
+                list(self.db.query('testbucket', fields=fields))
+
+    def test_indexed_fields(self):
+        '''Test indexes on fields of the data per bucket'''
+        for i in range(10):
+            self.db.store(dict(device='sensor{}'.format(i % 3),
+                               reading=dict(temp=i)), 'testbucket')
+            self.db.store(dict(device='sensor{}'.format(i % 3)),
+                          'otherbucket')
+        self.db.set_indexed_fields('testbucket', ['device', 'reading.temp'])
+        self.assertEqual(dict(testbucket=['device', 'reading.temp']),
+                         self.db.indexed_fields())
+        for where in ['device == "sensor1"', 'reading.temp == 3']:
+            plan = self.db.explain('testbucket', where=where)
+            self.assertTrue(any('blanketdb_field_' in step for step in plan),
+                            '{} for {}'.format(plan, where))
+        # the index only holds entries of its bucket
+        self.assertEqual([19, 13, 7, 1], [entry['id'] for entry in
+                         self.db.query('testbucket',
+                                       where='device == "sensor0"')])
+        self.assertEqual([20, 14, 8, 2], [entry['id'] for entry in
+                         self.db.query('otherbucket',
+                                       where='device == "sensor0"')])
+        self.db.set_indexed_fields('testbucket', ['device'])
+        self.assertEqual(dict(testbucket=['device']),
+                         self.db.indexed_fields())
+        self.assertFalse(any(
+            'blanketdb_field_' in step for step in self.db.explain(
+                'testbucket', where='reading.temp == 3')))
+        self.db.set_indexed_fields('testbucket', [])
+        self.assertEqual(dict(), self.db.indexed_fields())
+        with self.assertRaises(ValueError):
+            self.db.set_indexed_fields('testbucket', ['no-field'])
+
+    def test_page_from_python(self):
+        '''Test paging through a bucket using cursors'''
+        for i in range(10):
+            self.db.store_dict(bucket='testbucket{}'.format(i % 2), number=i)
+        page = self.db.page(bucket='testbucket0', limit=2)
+        self.assertEqual([9, 7], [e['id'] for e in page['entries']])
+        self.assertIsNone(page['prev'])
+        pages = [page]
+        while pages[-1]['next']:
+            pages.append(self.db.page(cursor=pages[-1]['next']))
+        self.assertEqual([[9, 7], [5, 3], [1]],
+                         [[e['id'] for e in p['entries']] for p in pages])
+        page = self.db.page(cursor=pages[-1]['prev'])
+        self.assertEqual([5, 3], [e['id'] for e in page['entries']])
+        page = self.db.page(cursor=page['prev'])
+        self.assertEqual([9, 7], [e['id'] for e in page['entries']])
+        self.assertIsNone(page['prev'])
+        page = self.db.page(bucket='testbucket1', since_id=3, limit=3,
+                            newest_first=False)
+        self.assertEqual([4, 6, 8], [e['id'] for e in page['entries']])
+        page = self.db.page(cursor=page['next'])
+        self.assertEqual([10], [e['id'] for e in page['entries']])
+        self.assertIsNone(page['next'])
+        page = self.db.page(cursor=page['prev'])
+        self.assertEqual([4, 6, 8], [e['id'] for e in page['entries']])
+        self.assertIsNone(page['prev'])
+        with self.assertRaises(ValueError):
+            self.db.page(cursor='invalid')
+
+    def test_page_with_relative_time(self):
+        '''Test paging through entries since a relative time'''
+        db = BlanketDB(':memory:')
+        for i in range(5):
+            db.store_dict(bucket='testbucket', number=i)
+        pages = [db.page(bucket='testbucket', since='1h', limit=3)]
+        while pages[-1]['next']:
+            pages.append(db.page(cursor=pages[-1]['next']))
+        self.assertEqual([[5, 4, 3], [2, 1]],
+                         [[e['id'] for e in p['entries']] for p in pages])
+
+    def test_store_many_from_python(self):
+        '''Test storing of multiple items in one transaction'''
+        self.db.store_dict(x='first')
+        stored = self.db.store_many([dict(number=i) for i in range(5)],
+                                    bucket='TestBucket')
+        self.assertEqual('testbucket', stored['bucket'])
+        self.assertEqual(5, stored['number_of_entries'])
+        self.assertEqual(2, stored['first_id'])
+        self.assertEqual(6, stored['last_id'])
+        entries = list(self.db.query(bucket='testbucket', newest_first=False))
+        self.assertEqual(list(range(2, 7)), [e['id'] for e in entries])
+        self.assertEqual([dict(number=i) for i in range(5)],
+                         [e['data'] for e in entries])
+        empty = self.db.store_many([])
+        self.assertEqual(0, empty['number_of_entries'])
+        self.assertIsNone(empty['first_id'])
+
+    def test_profiles(self):
+        '''Test durability/performance profiles of SQLite connections'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for profile, synchronous in [('safe', 2), ('balanced', 1),
+                                         ('fast', 0)]:
+                db = BlanketDB(os.path.join(tmpdir, profile + '.sqlite'),
+                               profile=profile)
+                db.store_dict(x=profile)
+                with db._pool.connection() as conn:
+                    self.assertEqual('wal', conn.execute(
+                        'PRAGMA journal_mode;').fetchone()[0])
+                    self.assertEqual(synchronous, conn.execute(
+                        'PRAGMA synchronous;').fetchone()[0])
+                self.assertEqual(0, db.checkpoint('truncate')[0])
+                self.assertEqual(1, len(list(db)))
+                db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        with self.assertRaises(ValueError):
+            BlanketDB(':memory:', profile='unknown')
+
+    def test_aggregate_from_python(self):
+        '''Test `BlanketDB.aggregate` method using Python API'''
+        for i in range(12):
+            self.db.store_dict(bucket='testbucket', temp=i, meta=dict(n=-i))
+            self.next_date += timedelta(minutes=10)
+        self.db.store_dict(bucket='testbucket', other='no temp')
+        self.db.store_dict(bucket='otherbucket', temp=100)
+        bins = self.db.aggregate('testbucket', 'temp', '1h',
+                                 ['avg', 'min', 'max', 'count'])
+        self.assertEqual([dict(bin=datetime(2022, 7, 15, 0), avg=2.5,
+                               min=0, max=5, count=6),
+                          dict(bin=datetime(2022, 7, 15, 1), avg=8.5,
+                               min=6, max=11, count=6)], bins)
+        bins = self.db.aggregate('testbucket', 'meta.n', '30min', ['sum'],
+                                 since=datetime(2022, 7, 15, 0, 30))
+        self.assertEqual([-12, -21, -30], [b['sum'] for b in bins])
+        self.assertEqual(100, self.db.aggregate(field='temp', interval='1d',
+                                                funcs=['max'])[0]['max'])
+        with self.assertRaises(ValueError):
+            self.db.aggregate('testbucket', 'temp', '1h', ['median'])
+        with self.assertRaises(ValueError):
+            self.db.aggregate('testbucket', 'temp\')', '1h')
+        with self.assertRaises(ValueError):
+            self.db.aggregate('testbucket', 'temp', 'forever')
+
+    def test_rollup_from_python(self):
+        '''Test rollups maintained at ingest time using Python API'''
+        self.db.store_dict(bucket='testbucket', temp=-10)
+        self.next_date += timedelta(minutes=10)
+        self.db.configure_rollup('TestBucket', ['temp', 'meta.hum'],
+                                 ['30min', '1h'])
+        self.assertEqual([dict(field='temp', bin=datetime(2022, 7, 15),
+                               avg=-10, min=-10, max=-10)],
+                         self.db.rollup('testbucket', '1h'))
+        for i in range(5):
+            self.db.store_dict(bucket='testbucket', temp=i,
+                               meta=dict(hum=10 * i))
+            self.next_date += timedelta(minutes=10)
+        self.db.store_many([dict(temp=5), dict(temp='n/a'), dict(x=1)],
+                           bucket='testbucket')
+        self.db.store_dict(bucket='otherbucket', temp=100)
+        bins = self.db.rollup('testbucket', '1h', 'temp',
+                              ['count', 'sum', 'min', 'max'])
+        self.assertEqual([dict(field='temp', bin=datetime(2022, 7, 15, 0),
+                               count=6, sum=0, min=-10, max=4),
+                          dict(field='temp', bin=datetime(2022, 7, 15, 1),
+                               count=1, sum=5, min=5, max=5)], bins)
+        aggregated = self.db.aggregate('testbucket', 'temp', '30min',
+                                       ['avg', 'min', 'max'])
+        rolled_up = self.db.rollup('testbucket', '30min', 'temp')
+        self.assertEqual(aggregated,
+                         [dict((k, v) for k, v in b.items() if k != 'field')
+                          for b in rolled_up])
+        self.assertEqual([5, 30],
+                         [b['avg'] for b in self.db.rollup('testbucket',
+                                                           '30min',
+                                                           'meta.hum')])
+        self.assertEqual(1, len(self.db.rollup('testbucket', '1h', 'temp',
+                                               since='2022-07-15 01:00')))
+        self.db.delete(bucket='testbucket')
+        self.assertEqual(2, len(self.db.rollup('testbucket', '1h', 'temp')))
+        with self.assertRaises(KeyError):
+            self.db.rollup('testbucket', '1d')
+        with self.assertRaises(KeyError):
+            self.db.rollup('otherbucket', '1h')
+        self.db.configure_rollup('testbucket', [])
+        with self.assertRaises(KeyError):
+            self.db.rollup('testbucket', '1h')
+        # a single field, interval or function instead of a list
+        self.db.configure_rollup('testbucket', 'temp', '1h', 'max')
+        self.db.store_dict(bucket='testbucket', temp=7)
+        self.assertEqual([dict(field='temp', bin=datetime(2022, 7, 15, 1),
+                               max=7)], self.db.rollup('testbucket', '1h'))
+
+    def test_retention_from_python(self):
+        '''Test retention policies using Python API'''
+        for i in range(10):
+            self.db.store_dict(bucket='testbucket', number=i)
+            self.db.store_dict(bucket='otherbucket', number=i)
+            self.next_date += timedelta(days=1)
+        self.db.store_dict(bucket='keepbucket', number=0)
+        self.db.set_retention('TestBucket', max_age='5d')
+        self.db.set_retention('otherbucket', max_rows=3)
+        self.assertEqual(dict(testbucket=dict(max_age=5 * 24 * 3600,
+                                              max_rows=None),
+                              otherbucket=dict(max_age=None, max_rows=3)),
+                         self.db.retention_policies())
+        deleted = self.db.enforce_retention(chunk_size=2, pause=0)
+        self.assertEqual(dict(testbucket=5, otherbucket=7), deleted)
+        self.assertEqual([9, 8, 7, 6, 5],
+                         [e['data']['number'] for e
+                          in self.db.query(bucket='testbucket')])
+        self.assertEqual([9, 8, 7],
+                         [e['data']['number'] for e
+                          in self.db.query(bucket='otherbucket')])
+        self.assertEqual(1, len(list(self.db.query(bucket='keepbucket'))))
+        self.assertEqual(dict(testbucket=0, otherbucket=0),
+                         self.db.enforce_retention())
+        self.db.set_retention('testbucket')
+        self.assertEqual(['otherbucket'], list(self.db.retention_policies()))
+        with self.assertRaises(ValueError):
+            self.db.set_retention('testbucket', max_age='eternity')
+
+    def test_background_retention(self):
+        '''Test enforcing retention policies by a background thread'''
+        db = BlanketDB(':memory:', retention_interval=0.01)
+        db.store_many([dict(number=i) for i in range(5)])
+        db.set_retention('default', max_rows=2)
+        for _ in range(100):
+            if len(list(db)) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, len(list(db)))
+        db.close()
+
+    def test_compression_from_python(self):
+        '''Test compressing the data of the entries of a bucket'''
+        for i in range(10):
+            self.db.store(dict(device='sensor{}'.format(i % 3), temp=i,
+                               ok=i % 2 == 0), 'testbucket')
+        self.db.store_dict(bucket='otherbucket', number=0)
+        self.db.set_compression('testbucket', level=9, samples=5)
+        self.db.store_many([dict(device='sensor{}'.format(i % 3), temp=i,
+                                 ok=i % 2 == 0) for i in range(10, 15)],
+                           'testbucket')
+        self.db.store(dict(device='sensor0', temp=15, ok=False),
+                      'testbucket')
+        info = self.db.compression_info('testbucket')
+        self.assertEqual(9, info['level'])
+        self.assertGreater(info['dictionary_bytes'], 0)
+        self.assertEqual(16, info['sampled_entries'])
+        self.assertEqual(6, info['compressed_entries'])
+        self.assertLess(info['stored_bytes'], info['raw_bytes'])
+        self.assertEqual(info['raw_bytes'] / info['stored_bytes'],
+                         info['ratio'])
+        self.assertEqual(5, self.db.compression_info(
+            'testbucket', samples=5)['compressed_entries'])
+        # compressed and uncompressed entries coexist
+        entries = list(self.db.query('testbucket'))
+        self.assertEqual(list(range(15, -1, -1)),
+                         [entry['data']['temp'] for entry in entries])
+        self.assertEqual(dict(device='sensor0', temp=15, ok=False),
+                         self.db[entries[0]['id']]['data'])
+        self.assertEqual('{"device": "sensor0", "temp": 15, "ok": false}',
+                         next(iter(self.db.query('testbucket', raw=True)))
+                         ['data'])
+        self.assertEqual(17, len(list(self.db)))
+        self.assertEqual([14, 12, 10, 8, 6, 4, 2, 0],
+                         [entry['data']['temp'] for entry in self.db.query(
+                             where='ok == true and temp >= 0')])
+        self.assertEqual([dict(temp=15), dict(temp=14)],
+                         [entry['data'] for entry in self.db.query(
+                             'testbucket', limit=2, fields='temp')])
+        self.assertEqual([dict(bin=datetime(2022, 7, 15), count=16,
+                               sum=120)],
+                         self.db.aggregate('testbucket', 'temp', '1d',
+                                           ['count', 'sum']))
+        self.db.configure_rollup('testbucket', ['temp'], ['1d'], ['max'])
+        self.assertEqual(15, self.db.rollup('testbucket', '1d')[0]['max'])
+        self.assertEqual(5, self.db.delete('testbucket',
+                                           where='device == "sensor2"'))
+        # entries not getting smaller stay uncompressed
+        self.db.set_compression('otherbucket', samples=0)
+        self.db.store_dict(bucket='otherbucket', number=1)
+        self.assertEqual(0, self.db.compression_info(
+            'otherbucket')['compressed_entries'])
+        with self.assertRaises(ValueError):
+            self.db.set_indexed_fields('testbucket', ['device'])
+        self.db.set_compression('testbucket', level=None)
+        self.db.store_dict(bucket='testbucket', temp=16)
+        info = self.db.compression_info('testbucket', samples=1)
+        self.assertEqual((None, 0), (info['level'],
+                                     info['compressed_entries']))
+        self.db.set_indexed_fields('indexedbucket', ['device'])
+        with self.assertRaises(ValueError):
+            self.db.set_compression('indexedbucket')
+        with self.assertRaises(ValueError):
+            self.db.set_compression('testbucket', level=10)
+        with self.assertRaises(ValueError):
+            self.db.compression_info('testbucket', samples=-1)
+        self.assertEqual(dict(bucket='nobucket', level=None,
+                              dictionary_bytes=0, sampled_entries=0,
+                              compressed_entries=0, raw_bytes=0,
+                              stored_bytes=0, ratio=None),
+                         self.db.compression_info('nobucket'))
+
+
+class TestBlanketDBPythonApiCompact(TestBlanketDBPythonApi):
+    '''Test Python API of BlanketDB using the compact schema.'''
+
+    def setUp(self):
+        self.next_date = datetime(2022, 7, 15)
+        self.db = BlanketDB(':memory:', lambda: self.next_date,
+                            schema='compact')
+
+    def test_schema(self):
+        '''Test storing bucket IDs and integer timestamps'''
+        stored = self.db.store_dict(bucket='TestBucket', x=1)
+        self.db.store_dict(bucket='otherbucket', x=2)
+        self.assertEqual(self.next_date, self.db[stored['id']]['timestamp'])
+        self.assertEqual('testbucket', self.db[stored['id']]['bucket'])
+        with self.db._pool.connection() as conn:
+            self.assertEqual([(1, 'testbucket'), (2, 'otherbucket')],
+                             conn.execute('SELECT * FROM blanketdb_bucket;')
+                             .fetchall())
+            self.assertEqual((1, 1, 'integer'), conn.execute(
+                'SELECT id, bucket, typeof(timestamp) ' +
+                'FROM blanketdb_entry;').fetchone())
+        self.assertEqual(1, len(list(self.db.query(
+            'testbucket', since='2022-07-15', before='2022-07-15 00:00:01'))))
+        self.assertEqual(0, len(list(self.db.query('unknownbucket'))))
+        self.assertEqual(0, self.db.delete('unknownbucket'))
+        with self.assertRaises(ValueError):
+            list(self.db.query(since='not a date'))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'compact.sqlite')
+            BlanketDB(filename, schema='compact').close()
+            db = BlanketDB(filename)
+            db.store_dict(x=1)
+            self.assertEqual(1, len(list(db.query('default'))))
+            db.close()
+            with self.assertRaises(ValueError):
+                BlanketDB(filename, schema='text')
+        finally:
+            shutil.rmtree(tmpdir)
+        with self.assertRaises(ValueError):
+            BlanketDB(':memory:', schema='unknown')
+
+
+class TestBlanketDBPythonApiPartitioned(TestBlanketDBPythonApi):
+    '''Test Python API of BlanketDB storing entries in daily partitions.'''
+
+    def setUp(self):
+        self.next_date = datetime(2022, 7, 15)
+        self.db = BlanketDB(':memory:', lambda: self.next_date,
+                            partition='day')
+
+    def test_partitions(self):
+        '''Test pruning and dropping of daily partitions'''
+        for day in range(5):
+            for i in range(3):
+                self.db.store_dict(bucket='testbucket', day=day, number=i)
+                self.db.store_dict(bucket='otherbucket', day=day, number=i)
+                self.next_date += timedelta(hours=1)
+            self.next_date += timedelta(hours=21)
+        tables = ['blanketdb_202207{}'.format(day)
+                  for day in range(19, 14, -1)]
+        self.assertEqual(tables, self.db._tables())
+        self.assertEqual(tables[2:4], self.db._tables(
+            since='2022-07-16 12:00', before=datetime(2022, 7, 18)))
+        self.assertEqual(tables[1:3], self.db._tables(since_id=13,
+                                                      before_id=25))
+        self.assertEqual([30, 29, 28, 27],
+                         [e['id'] for e in self.db.query(limit=4)])
+        self.assertEqual([6, 8, 10], [e['id'] for e in self.db.query(
+            'otherbucket', since_id=5, before_id=12, newest_first=False)])
+        page = self.db.page('testbucket', limit=4)
+        pages = [page]
+        while pages[-1]['next']:
+            pages.append(self.db.page(cursor=pages[-1]['next']))
+        self.assertEqual(list(range(29, 0, -2)),
+                         [e['id'] for p in pages for e in p['entries']])
+        self.assertEqual([29, 27, 25, 23], [e['id'] for e in self.db.page(
+            cursor=pages[1]['prev'])['entries']])
+        self.assertEqual(dict(day=1, number=0), self.db[7]['data'])
+        del self.db[7]
+        self.assertIsNone(self.db[7])
+        # a clock going back extends the newest partition
+        self.next_date = datetime(2022, 7, 16, 12)
+        stored = self.db.store_dict(bucket='testbucket', late=True)
+        self.assertEqual(31, stored['id'])
+        self.assertEqual([31], [e['id'] for e in self.db.query(
+            since='2022-07-16 12:00', before='2022-07-16 13:00')])
+        self.assertEqual(14, len(self.db.aggregate('testbucket', 'number',
+                                                   '1h', ['count'])))
+        self.next_date = datetime(2022, 7, 20)
+        self.db.set_retention('testbucket', max_age='2d')
+        # the late entry is expired, too
+        self.assertEqual(dict(testbucket=9), self.db.enforce_retention())
+        self.assertEqual(tables, self.db._tables())
+        self.db.set_retention('otherbucket', max_age='3d')
+        self.assertEqual(dict(testbucket=0, otherbucket=6),
+                         self.db.enforce_retention())
+        self.assertEqual(tables[:3], self.db._tables())
+        self.assertEqual([29, 27, 25, 23, 21, 19],
+                         [e['id'] for e in self.db.query('testbucket')])
+        self.db.set_retention('otherbucket', max_rows=1)
+        self.assertEqual(dict(testbucket=0, otherbucket=8),
+                         self.db.enforce_retention())
+        self.assertEqual([30], [e['id'] for e in self.db.query('otherbucket')])
+        self.assertEqual(tables[:2], self.db._tables())
+        # the newest partition is never dropped, its IDs continue
+        self.db.delete()
+        self.db.enforce_retention()
+        self.assertEqual(tables[:1], self.db._tables())
+        self.assertEqual(32, self.db.store_dict(x=1)['id'])
+        self.assertEqual(['blanketdb_20220720'] + tables[:1],
+                         self.db._tables())
+        with self.assertRaises(ValueError):
+            BlanketDB(':memory:', partition='week')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'partitioned.sqlite')
+            db = BlanketDB(filename, schema='compact', partition='month')
+            db.store_dict(x=1)
+            db.close()
+            db = BlanketDB(filename)
+            self.assertEqual(['blanketdb_entry_' + datetime.now()
+                              .strftime('%Y%m')], db._tables())
+            db.close()
+            with self.assertRaises(ValueError):
+                BlanketDB(filename, partition='day')
+            BlanketDB(os.path.join(tmpdir, 'plain.sqlite')).close()
+            with self.assertRaises(ValueError):
+                BlanketDB(os.path.join(tmpdir, 'plain.sqlite'),
+                          partition='day')
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Test the multi-threaded and multi-process server mode of BlanketDB.'''
+
+
+import http.client
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from blanketdb import _PooledWSGIServer, _listen
+
+
+class TestPooledWSGIServer(unittest.TestCase):
+    '''Test the thread pool WSGI server of BlanketDB.'''
+
+    def test_backpressure(self):
+        '''Test that connections exceeding the queue get 503'''
+        entered, release = threading.Event(), threading.Event()
+
+        def app(env, start_response):
+            entered.set()
+            release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'done']
+        httpd = _PooledWSGIServer(_listen('127.0.0.1', 0), app,
+                                  threads=1, max_queue=1)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        port = httpd.socket.getsockname()[1]
+        conns = []
+        try:
+            for i in range(3):
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                  timeout=5)
+                conn.request('GET', '/')
+                conns.append(conn)
+                if i == 0:
+                    entered.wait(5)
+                else:
+                    time.sleep(0.2)  # let the server accept in order
+            resp = conns[2].getresponse()
+            self.assertEqual(503, resp.status)
+            self.assertEqual('1', resp.getheader('Retry-After'))
+            self.assertIn('message', json.loads(resp.read().decode()))
+            release.set()
+            for conn in conns[:2]:
+                resp = conn.getresponse()
+                self.assertEqual(200, resp.status)
+                self.assertEqual(b'done', resp.read())
+        finally:
+            release.set()
+            for conn in conns:
+                conn.close()
+            httpd.shutdown()
+            httpd.server_close()
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+class TestPreforkServer(unittest.TestCase):
+    '''Test the pre-forking command line server of BlanketDB.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        script = os.path.join(os.path.dirname(__file__), '..', 'blanketdb.py')
+        self.proc = subprocess.Popen(
+            [sys.executable, script, '-i', '127.0.0.1', '-p', str(self.port),
+             '-f', os.path.join(self.tmpdir, 'db.sqlite'),
+             '--workers', '2', '--threads', '2'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def tearDown(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, method, path, body=None):
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                  timeout=5)
+                conn.request(method, path, body,
+                             {'Content-Type': 'application/json'})
+                resp = conn.getresponse()
+                result = resp.status, json.loads(resp.read().decode())
+                conn.close()
+                return result
+            except ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def test_workers_reload_and_shutdown(self):
+        '''Test serving by several workers, SIGHUP and SIGTERM'''
+        for i in range(4):
+            status, entry = self.request('POST', '/testbucket',
+                                         json.dumps(dict(a=i)))
+            self.assertEqual(201, status)
+            self.assertEqual(i + 1, entry['id'])
+        status, result = self.request('GET', '/testbucket')
+        self.assertEqual(4, result['number_of_entries'])
+        self.proc.send_signal(signal.SIGHUP)
+        for _ in range(4):
+            status, result = self.request('GET', '/testbucket')
+            self.assertEqual(200, status)
+            self.assertEqual(4, result['number_of_entries'])
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.proc.wait(10))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Test concurrent use of BlanketDB from many threads.'''
+
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from webtest import TestApp
+
+from blanketdb import BlanketDB
+
+
+class TestBlanketDBThreading(unittest.TestCase):
+    '''Test concurrent use of BlanketDB from many threads.'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = BlanketDB(os.path.join(self.tmpdir, 'db.sqlite'),
+                            pool_size=4)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_concurrent_web_requests(self):
+        '''Hammer the WSGI callable from many threads'''
+        n_threads, n_requests = 16, 20
+        errors = []
+
+        def worker(i):
+            app = TestApp(self.db)
+            bucket = '/bucket{}'.format(i % 4)
+            try:
+                for j in range(n_requests):
+                    app.post_json(bucket, dict(thread=i, number=j),
+                                  status=201)
+                    app.get(bucket, dict(limit=5), status=200)
+                app.post_json(bucket + '/_batch', [dict(thread=i)] * 5,
+                              status=201)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        entries = list(self.db)
+        self.assertEqual(n_threads * (n_requests + 5), len(entries))
+        self.assertEqual(len(entries), len(set(e['id'] for e in entries)))
+        self.assertLessEqual(len(self.db._pool._idle), 4)
+
+    def test_nested_use_within_thread(self):
+        '''Test writing while iterating a query with a single connection'''
+        db = BlanketDB(':memory:')
+        for i in range(3):
+            db.store_dict(number=i)
+        for entry in db.query(bucket='default', newest_first=False):
+            db.store(entry['data'], bucket='copy')
+        self.assertEqual(3, len(list(db.query(bucket='copy'))))
+        self.assertEqual(1, len(db._pool._idle))
+
+    def test_nested_use_with_group_commit(self):
+        '''Test writing while iterating a query with group commit'''
+        db = BlanketDB(':memory:', commit_latency=0.01)
+        for i in range(3):
+            db.store_dict(number=i)
+        done = threading.Event()
+
+        def copy():
+            for entry in db.query(bucket='default', newest_first=False):
+                db.store(entry['data'], bucket='copy')
+            done.set()
+        threading.Thread(target=copy, daemon=True).start()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(3, len(list(db.query(bucket='copy'))))
+        db.close()
+
+    def test_invalid_pool_size(self):
+        '''Test rejecting pools without connections'''
+        with self.assertRaises(ValueError):
+            BlanketDB(':memory:', pool_size=0)
+        with self.assertRaises(ValueError):
+            BlanketDB(os.path.join(self.tmpdir, 'db.sqlite'), pool_size=-1)
+
+    def test_group_commit(self):
+        '''Test committing entries stored concurrently in groups'''
+        db = BlanketDB(os.path.join(self.tmpdir, 'group.sqlite'),
+                       commit_latency=0.2, commit_rows=8)
+        n_threads = 20
+        barrier = threading.Barrier(n_threads)
+        stored = []
+
+        def worker(i):
+            barrier.wait()
+            stored.append(db.store(dict(number=i), bucket='Group'))
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(n_threads, len(set(s['id'] for s in stored)))
+        for entry in stored:
+            self.assertEqual('group', entry['bucket'])
+            self.assertEqual(entry['data'], db[entry['id']]['data'])
+        self.assertGreaterEqual(db._writer.commits, 3)
+        self.assertLess(db._writer.commits, n_threads)
+        db.close()
+        with self.assertRaises(RuntimeError):
+            db.store(dict(number=0))
+
+    def test_long_poll(self):
+        '''Test waiting for new entries of a bucket'''
+        app = TestApp(self.db)
+        app.post_json('/testbucket', dict(number=0), status=201)
+        self.assertTrue(self.db.wait('testbucket', 1, timeout=0))
+        self.assertFalse(self.db.wait('testbucket', 2, timeout=0.01))
+        timer = threading.Timer(0.1, self.db.store, (dict(number=1),),
+                                dict(bucket='testbucket'))
+        timer.start()
+        start = time.monotonic()
+        resp = app.get('/testbucket', dict(since_id=2, wait=10), status=200)
+        timer.join()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(1, resp.json['number_of_entries'])
+        self.assertEqual(2, resp.json['last_id'])
+        resp = app.get('/testbucket', dict(since_id=3, wait=0.01),
+                       status=200)
+        self.assertEqual(0, resp.json['number_of_entries'])
+
+    def test_wait_for_other_instance(self):
+        '''Test waiting for entries stored by another instance'''
+        self.db.poll_interval = 0.05
+        other = BlanketDB(os.path.join(self.tmpdir, 'db.sqlite'))
+        try:
+            self.assertFalse(self.db.wait('testbucket', 1, 0.1))
+            timer = threading.Timer(0.1, other.store, (dict(a=1),),
+                                    dict(bucket='testbucket'))
+            timer.start()
+            start = time.monotonic()
+            self.assertTrue(self.db.wait('testbucket', 1, 5))
+            self.assertLess(time.monotonic() - start, 5)
+            timer.join()
+        finally:
+            other.close()
+
+    def test_server_sent_events(self):
+        '''Test streaming entries as server-sent events'''
+        self.db.store_dict(bucket='testbucket', number=0)
+        env = dict(PATH_INFO='/testbucket/_stream', REQUEST_METHOD='GET',
+                   QUERY_STRING='limit=3&meta=false&wait=0.01')
+        events = self.db(env, lambda status, headers: None)
+        self.assertEqual(b': heartbeat\n\n', next(events))
+        self.db.store_many([dict(number=1), dict(number=2)], 'testbucket')
+        self.db.store_dict(bucket='otherbucket', number=-1)
+        timer = threading.Timer(0.1, self.db.store, (dict(number=3),),
+                                dict(bucket='testbucket'))
+        timer.start()
+        events = [event for event in events if not event.startswith(b':')]
+        timer.join()
+        self.assertEqual([b'id: 2\nevent: entry\ndata: {"number": 1}\n\n',
+                          b'id: 3\nevent: entry\ndata: {"number": 2}\n\n',
+                          b'id: 5\nevent: entry\ndata: {"number": 3}\n\n'],
+                         events)
+        env = dict(PATH_INFO='/testbucket/_stream', REQUEST_METHOD='GET',
+                   QUERY_STRING='limit=1', HTTP_LAST_EVENT_ID='2')
+        event = next(self.db(env, lambda status, headers: None))
+        self.assertTrue(event.startswith(b'id: 3\n'))
@@ -8,7 +8,8 @@ import unittest
 import json
 
 from datetime import datetime, date, timedelta
-from blanketdb import _parse_form, _parse_dt, _serialize_json, _j
+from blanketdb import _parse_form, _parse_dt, _resolved_dt, \
+    _serialize_json, _j, _stream_envelope, _raw_entry, _raw_line
 
 
 def is_close(dt1, dt2, max_diff_sec=10):
@@ -76,6 +77,19 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertTrue(is_close(datetime.now() - timedelta(seconds=20),
                         _parse_dt('20 sec')))
 
+    def test_resolved_date(self):
+        self.assertIsNone(_resolved_dt(None))
+        self.assertIsNone(_resolved_dt(''))
+        self.assertEqual('2025-02-03', _resolved_dt('2025-02-03'))
+        self.assertEqual('2025-02-03 04:05:06',
+                         _resolved_dt(datetime(2025, 2, 3, 4, 5, 6)))
+        self.assertEqual(date.today().isoformat(), _resolved_dt('today'))
+        resolved = _resolved_dt('2h')
+        self.assertEqual(resolved, _resolved_dt(resolved))
+        self.assertTrue(is_close(datetime.now() - timedelta(hours=2),
+                        datetime.strptime(resolved[:19],
+                                          '%Y-%m-%d %H:%M:%S')))
+
     def test_serialize_json(self):
         '''Test function for serializing json with dates'''
         self.assertEqual('{}', _serialize_json({}))
@@ -90,3 +104,27 @@ class TestHelperFunctions(unittest.TestCase):
         # avoid indent comparison by decoding json again
         self.assertEqual(dict(a=2, b=3),
                          json.loads(_j(a=2, b=3).decode('utf8')))
+
+    def test_stream_envelope(self):
+        '''Test function for serializing json envelopes chunk by chunk'''
+        for entries in [[], [1], [dict(a=1), dict(b=[2, 3])]]:
+            chunks = list(_stream_envelope(dict(x=1),
+                                           map(json.dumps, entries),
+                                           lambda: dict(n=len(entries))))
+            self.assertEqual(len(entries) + 2, len(chunks))
+            self.assertEqual(dict(x=1, entries=entries, n=len(entries)),
+                             json.loads(b''.join(chunks).decode('utf8')))
+
+    def test_raw_entry(self):
+        '''Test function for splicing stored data into entries'''
+        row = (3, 'b"ucket', datetime(2022, 7, 15), '{"a": [1, 2]}')
+        entry = dict(id=3, bucket='b"ucket', timestamp='2022-07-15T00:00:00',
+                     data=dict(a=[1, 2]))
+        self.assertEqual(entry, json.loads(_raw_entry(row, True)))
+        self.assertEqual('{\n  "id": 3,\n  "bucket": "b\\"ucket",\n'
+                         '  "timestamp": "2022-07-15T00:00:00",\n'
+                         '  "data": {"a": [1, 2]}\n}',
+                         _raw_entry(row, True, indent=2))
+        self.assertEqual('{"a": [1, 2]}', _raw_entry(row, False, indent=2))
+        self.assertNotIn('\n', _raw_line(
+            row[:3] + ('{\n  "a": 1\n}',), True))